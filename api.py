@@ -1,8 +1,42 @@
+import asyncio
+import csv
+import hashlib
+import hmac
+import heapq
+import inspect
+import io
+import json
+import logging
+import os
+import re
+import secrets
+import shutil
+import sqlite3
+import threading
+import time as relogio
 import uuid
-from typing import Annotated, List
-from sqlmodel import Field, Session, SQLModel, create_engine, select
-from fastapi import Depends, FastAPI, HTTPException, Query
-from datetime import date, datetime, time
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from functools import cache
+from itertools import islice
+from operator import itemgetter
+from contextvars import ContextVar
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Annotated, Generic, List, Optional, TypeVar
+from urllib.request import pathname2url
+from pydantic import BaseModel, ValidationError, create_model
+from sqlalchemy import Column, Date, Index, Integer, MetaData, Table, and_, case, delete, event, func, insert, literal, or_, text, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, selectinload
+from sqlmodel import Field, Relationship, Session, SQLModel, create_engine, select
+from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import APIRoute
+from fastapi.responses import Response, StreamingResponse
+from datetime import date, datetime, time, timedelta, timezone
 from enum import Enum
 
 
@@ -14,16 +48,38 @@ class TipoUsuario(str, Enum):
 
 
 # Tabelas da base de dados
+# versao serve de bloqueio otimista: começa em 1 e cada UPDATE incrementa-a
 
 class Usuario(SQLModel, table=True):
+    # poucos valores distintos: com (tipo, id) o filtro também dá a ordem do cursor
+    __table_args__ = (
+        Index("ix_usuario_tipo_usuario_id", "tipo_usuario", "id"),
+    )
+
     id: uuid.UUID = Field(default_factory=uuid.uuid7, primary_key=True)
     username: str = Field(index=True, unique=True, nullable=False)
-    senha_has: str = Field(index=True, unique=True, nullable=False)
+    senha_has: str = Field(nullable=False)  # scrypt$n$r$p$sal$chave (ver Senhas e sessões)
     email: str = Field(index=True, unique=True, nullable=False)
-    tipo_usuario: TipoUsuario = Field(index=True, nullable=False)
+    tipo_usuario: TipoUsuario = Field(nullable=False)
+    versao: int = Field(default=1, nullable=False)
+
+
+class UsuarioPublico(SQLModel):
+    """O usuário como a API o devolve: sem senha_has, que é uma credencial."""
+    id: uuid.UUID
+    username: str
+    email: str
+    tipo_usuario: TipoUsuario
+    versao: int
     
 
 class Paciente(SQLModel, table=True):
+    # índices das listas (filtros e ?sort=): o id no fim mantém a ordem do cursor
+    __table_args__ = (
+        Index("ix_paciente_nome_id", "nome", "id"),
+        Index("ix_paciente_data_registro_id", "data_registro", "id"),
+    )
+
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     nome: str = Field(nullable=False)
     idade: int =  Field(nullable=False)
@@ -33,383 +89,3429 @@ class Paciente(SQLModel, table=True):
     endereco: str = Field(nullable=False)
     email: str = Field(unique=True)
     data_registro: datetime =  Field(nullable=False)
-    usuario_id: uuid.UUID = Field(foreign_key="usuario.id", nullable=False)
+    usuario_id: uuid.UUID = Field(foreign_key="usuario.id", index=True, nullable=False)
+    versao: int = Field(default=1, nullable=False)
+
+    # relações só de leitura, usadas para carregar o histórico com selectinload;
+    # viewonly evita que apagar um paciente tente pôr a NULL as FKs dos filhos
+    marcacoes: List["Marcacao"] = Relationship(sa_relationship_kwargs={"viewonly": True})
+    consultas: List["Consulta"] = Relationship(sa_relationship_kwargs={"viewonly": True})
+    pagamentos: List["Pagamento"] = Relationship(sa_relationship_kwargs={"viewonly": True})
 
 
 
 class Medico(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_medico_nome_medico_id", "nome_medico", "id"),
+    )
+
     id: uuid.UUID = Field(default_factory=uuid.uuid7, primary_key=True)
     nome_medico: str = Field(nullable=False)
-    especialidade: str = Field(nullable=False)
+    especialidade: str = Field(index=True, nullable=False)
     telefone: str = Field(nullable=False)
     email: str = Field(index=True, unique=True, nullable=False)
-    usuario_id: uuid.UUID = Field(foreign_key="usuario.id", nullable=False)
+    usuario_id: uuid.UUID = Field(foreign_key="usuario.id", index=True, nullable=False)
+    versao: int = Field(default=1, nullable=False)
 
 
 
 class Funcionario(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_funcionario_nome_funcionario_id", "nome_funcionario", "id"),
+    )
+
     id: uuid.UUID = Field(default_factory=uuid.uuid7, primary_key=True)
     nome_funcionario: str = Field(nullable=False)
-    cargo: str = Field(nullable=False)
+    cargo: str = Field(index=True, nullable=False)
     telefone: str = Field(nullable=False)
     email: str = Field(index=True, unique=True, nullable=False)
-    usuario_id: uuid.UUID = Field(foreign_key="usuario.id", nullable=False)
+    usuario_id: uuid.UUID = Field(foreign_key="usuario.id", index=True, nullable=False)
+    versao: int = Field(default=1, nullable=False)
      
   
 
 
+ESTADO_MARCACAO_CANCELADA = "cancelada"
+ESTADO_MARCACAO_CONCLUIDA = "concluida"
+ESTADO_MARCACAO_FALTOU = "faltou"
+# marcações que ainda não aconteceram (ou que ninguém fechou depois do dia)
+ESTADOS_MARCACAO_PENDENTES = ("agendada", "confirmada")
+
+
 class Marcacao(SQLModel, table=True):
+    # um médico não pode ter duas marcações ativas no mesmo dia e hora; as
+    # canceladas ficam fora do índice para libertar o horário
+    __table_args__ = (
+        Index(
+            "ix_marcacao_medico_data_hora",
+            "medico_id",
+            "data_marcacao",
+            "hora_marcacao",
+            unique=True,
+            sqlite_where=text(f"estado_marcacao != '{ESTADO_MARCACAO_CANCELADA}'"),
+        ),
+        # o índice parcial só serve consultas que excluam as canceladas; a
+        # agenda de um médico (?medico_id=&data_marcacao=) usa este
+        Index("ix_marcacao_medico_data_hora_id", "medico_id", "data_marcacao", "hora_marcacao", "id"),
+        Index("ix_marcacao_data_hora_id", "data_marcacao", "hora_marcacao", "id"),
+        Index("ix_marcacao_estado_id", "estado_marcacao", "id"),
+        # ?medico_id= sem data: com poucos médicos o SQLite prefere percorrer
+        # a PK pela ordem do cursor a ordenar as marcações do médico
+        Index("ix_marcacao_medico_id_id", "medico_id", "id"),
+    )
+
     id: uuid.UUID = Field(default_factory=uuid.uuid7, primary_key=True)
     data_marcacao: date = Field(nullable=False)
-    hora_marcacao: time = Field(index=True, unique=True, nullable=False)
+    hora_marcacao: time = Field(nullable=False)
     estado_marcacao: str = Field(nullable=False)
-    paciente_id: uuid.UUID = Field(foreign_key="paciente.id", nullable=False)
+    paciente_id: uuid.UUID = Field(foreign_key="paciente.id", index=True, nullable=False)
     medico_id: uuid.UUID = Field(foreign_key="medico.id", nullable=False)
+    versao: int = Field(default=1, nullable=False)
+
+
+class HorarioMedico(SQLModel, table=True):
+    id: uuid.UUID = Field(default_factory=uuid.uuid7, primary_key=True)
+    medico_id: uuid.UUID = Field(foreign_key="medico.id", index=True, nullable=False)
+    dia_semana: int = Field(ge=0, le=6, nullable=False)  # 0 = segunda-feira
+    hora_inicio: time = Field(nullable=False)
+    hora_fim: time = Field(nullable=False)
+    duracao_minutos: int = Field(default=30, gt=0, nullable=False)
     
 
 class Servico(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_servico_nome_servico_id", "nome_servico", "id"),
+        Index("ix_servico_preco_id", "preco", "id"),
+    )
+
     id: uuid.UUID = Field(default_factory=uuid.uuid7, primary_key=True)
     nome_servico: str = Field(nullable=False)
     descricao: str = Field(nullable=False)
     preco: float = Field(nullable=False)
+    versao: int = Field(default=1, nullable=False)
    
 
 
 class Consulta(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_consulta_data_hora_id", "data_consulta", "hora_consulta", "id"),
+        Index("ix_consulta_medico_data_hora_id", "medico_id", "data_consulta", "hora_consulta", "id"),
+        Index("ix_consulta_medico_id_id", "medico_id", "id"),
+    )
+
     id: uuid.UUID = Field(default_factory=uuid.uuid7, primary_key=True)
     data_consulta: date = Field(nullable=False)
-    hora_consulta: time = Field(index=True, unique=True, nullable=False)
-    marcacao_id: uuid.UUID = Field(foreign_key="marcacao.id", nullable=False)
-    paciente_id: uuid.UUID = Field(foreign_key="paciente.id", nullable=False)
+    hora_consulta: time = Field(nullable=False)
+    marcacao_id: uuid.UUID = Field(foreign_key="marcacao.id", index=True, nullable=False)
+    paciente_id: uuid.UUID = Field(foreign_key="paciente.id", index=True, nullable=False)
     medico_id: uuid.UUID = Field(foreign_key="medico.id", nullable=False)
-    servico_id: uuid.UUID = Field(foreign_key="servico.id", nullable=False)
+    servico_id: uuid.UUID = Field(foreign_key="servico.id", index=True, nullable=False)
+    # soma de quantidade * preco das linhas ConsultaService, mantida pela API
+    total: float = Field(default=0, nullable=False)
+    versao: int = Field(default=1, nullable=False)
+
+    linhas: List["ConsultaService"] = Relationship(sa_relationship_kwargs={"viewonly": True})
 
 
 
 class ConsultaService(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid7, primary_key=True)
-    consulta_id: uuid.UUID = Field(foreign_key="consulta.id", nullable=False)
-    servico_id: uuid.UUID = Field(foreign_key="servico.id", nullable=False)
+    consulta_id: uuid.UUID = Field(foreign_key="consulta.id", index=True, nullable=False)
+    servico_id: uuid.UUID = Field(foreign_key="servico.id", index=True, nullable=False)
     quantidade: int = Field(nullable=False)
+    versao: int = Field(default=1, nullable=False)
+
+    servico: Optional["Servico"] = Relationship(sa_relationship_kwargs={"viewonly": True})
 
 
    
 class Pagamento(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_pagamento_data_id", "data_pagamento", "id"),
+        Index("ix_pagamento_estado_id", "estado_pagamento", "id"),
+        Index("ix_pagamento_metodo_id", "metodo_pagamento", "id"),
+    )
+
     id: uuid.UUID = Field(default_factory=uuid.uuid7, primary_key=True)
     valor_pagamento: float = Field(nullable=False)
     metodo_pagamento: str = Field(nullable=False)
     data_pagamento: date = Field(nullable=False)
     estado_pagamento: str = Field(nullable=False)
-    paciente_id: uuid.UUID = Field(foreign_key="paciente.id", nullable=False)
-    consulta_id: uuid.UUID = Field(foreign_key="consulta.id", nullable=False)
-    
+    paciente_id: uuid.UUID = Field(foreign_key="paciente.id", index=True, nullable=False)
+    consulta_id: uuid.UUID = Field(foreign_key="consulta.id", index=True, nullable=False)
+    versao: int = Field(default=1, nullable=False)
 
-db_file = "database.db"
-url = f"sqlite:///{db_file}"
 
-engine = create_engine(url, connect_args={"check_same_thread": False})
+# Tabelas de resumo para os relatórios (uma linha por balde, não por registo)
+
+class ResumoReceita(SQLModel, table=True):
+    dia: date = Field(primary_key=True)
+    metodo_pagamento: str = Field(primary_key=True)
+    estado_pagamento: str = Field(primary_key=True)
+    medico_id: uuid.UUID = Field(primary_key=True)  # médico da consulta paga
+    total: float = Field(default=0, nullable=False)
+    quantidade: int = Field(default=0, nullable=False)
+
+
+class ResumoConsultas(SQLModel, table=True):
+    dia: date = Field(primary_key=True)
+    especialidade: str = Field(primary_key=True)
+    quantidade: int = Field(default=0, nullable=False)
+
+
+# Registo de alterações das marcações, lido pelo feed /marcacao/stream
+
+class AlteracaoMarcacao(SQLModel, table=True):
+    # AUTOINCREMENT: um id nunca é reutilizado, mesmo depois de apagar as
+    # linhas antigas, por isso serve de Last-Event-ID
+    __table_args__ = (
+        Index("ix_alteracaomarcacao_criado_em", "criado_em"),
+        {"sqlite_autoincrement": True},
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    tipo: str = Field(nullable=False)
+    marcacao_id: uuid.UUID = Field(nullable=False)
+    medico_id: uuid.UUID = Field(nullable=False)
+    data_marcacao: date = Field(nullable=False)
+    # médico e dia antes da alteração, se mudaram: quem segue o médico ou o dia
+    # antigo também tem de saber que a marcação saiu de lá
+    medico_anterior_id: Optional[uuid.UUID] = None
+    data_anterior: Optional[date] = None
+    dados: str = Field(nullable=False)  # a marcação em JSON (antes de ser eliminada, no caso de eliminada)
+    criado_em: datetime = Field(nullable=False)
+
+
+# Chaves de idempotência dos POST de pagamentos e marcações
+
+class PedidoIdempotente(SQLModel, table=True):
+    # sem rowid: a chave primária é a própria árvore e a procura é uma só leitura
+    __table_args__ = (
+        Index("ix_pedidoidempotente_criado_em", "criado_em"),
+        {"sqlite_with_rowid": False},
+    )
+
+    rota: str = Field(primary_key=True)
+    chave: str = Field(primary_key=True)
+    resumo_pedido: bytes = Field(nullable=False)  # blake2b do corpo validado
+    resposta: bytes = Field(nullable=False)
+    criado_em: datetime = Field(nullable=False)
+
+
+# Sessões abertas por POST /auth/login
+
+class SessaoUsuario(SQLModel, table=True):
+    __table_args__ = {"sqlite_with_rowid": False}
+
+    token_hash: bytes = Field(primary_key=True)  # sha256 do token; o token em si não é guardado
+    usuario_id: uuid.UUID = Field(foreign_key="usuario.id", index=True, nullable=False)
+    expira_em: datetime = Field(index=True, nullable=False)
+
+
+# Execuções das tarefas noturnas (ver Tarefas agendadas)
+
+class ExecucaoTarefa(SQLModel, table=True):
+    # uma execução por tarefa e dia: os workers que a criam ao mesmo tempo
+    # chocam no índice único e fica uma só
+    __table_args__ = (
+        Index("ix_execucaotarefa_tarefa_dia", "tarefa", "dia", unique=True),
+        Index("ix_execucaotarefa_estado", "estado"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    tarefa: str = Field(nullable=False)
+    dia: date = Field(nullable=False)
+    estado: str = Field(nullable=False)
+    processados: int = Field(default=0, nullable=False)
+    lotes: int = Field(default=0, nullable=False)
+    lote_max_ms: float = Field(default=0, nullable=False)  # a transação mais longa
+    duracao_ms: Optional[float] = None
+    resultado: str = Field(default="{}", nullable=False)  # contagens em JSON
+    erro: Optional[str] = None
+    criado_em: datetime = Field(nullable=False)
+    iniciado_em: Optional[datetime] = None
+    atualizado_em: Optional[datetime] = None  # a cada lote; sem progresso, o processo morreu
+    terminado_em: Optional[datetime] = None
+
+
+# ficheiros da clínica única (ver Clínicas)
+db_file = os.environ.get("CLINICA_DB", "database.db")
+# ficheiro anexado com as consultas, marcações e pagamentos antigos (ver Arquivo)
+arquivo_file = os.environ.get("CLINICA_ARQUIVO", f"{os.path.splitext(db_file)[0]}-arquivo.db")
+
+
+# Perfis de armazenamento
+# "simples" é o comportamento original: um só engine, journal em rollback.
+# "producao" liga o WAL (os leitores deixam de ser bloqueados pelo escritor),
+# ajusta as pragmas de cada ligação e separa um pool limitado de ligações só de
+# leitura de uma única ligação de escrita, que serializa as escritas deste
+# processo em vez de as deixar competir pelo lock e falhar com "database is locked".
+
+PERFIS_BD = {
+    "simples": {
+        "pragmas": {},
+        "leitores": 0,
+    },
+    "producao": {
+        "pragmas": {
+            "synchronous": "NORMAL",
+            "mmap_size": 256 * 1024 * 1024,
+            "cache_size": -64 * 1024,  # em KiB
+            "busy_timeout": 5000,  # em ms
+            "temp_store": "MEMORY",
+        },
+        "leitores": 8,
+    },
+}
+
+PERFIL_BD = os.environ.get("CLINICA_PERFIL_BD", "producao")
+# "sync" (handlers def + Session) ou "async" (handlers async def + AsyncSession/aiosqlite)
+MODO_API = os.environ.get("CLINICA_MODO", "sync")
+if PERFIL_BD not in PERFIS_BD:
+    raise RuntimeError(f"Perfil de base de dados desconhecido: {PERFIL_BD}")
+
+perfil = PERFIS_BD[PERFIL_BD]
+NUM_LEITORES = int(os.environ.get("CLINICA_LEITORES", perfil["leitores"]))
+
+
+# pragmas que valem por ficheiro e por isso se repetem para o arquivo anexado
+PRAGMAS_POR_FICHEIRO = {"journal_mode", "synchronous", "cache_size", "mmap_size"}
+
+
+def aplicar_pragmas(engine_bd, pragmas: dict, arquivo: str, so_leitura: bool = False):
+    @event.listens_for(engine_bd, "connect")
+    def _pragmas(ligacao, _registo):
+        cursor = ligacao.cursor()
+        for nome, valor in pragmas.items():
+            cursor.execute(f"PRAGMA {nome}={valor}")
+        cursor.execute("ATTACH DATABASE ? AS arquivo", (arquivo,))
+        for nome in PRAGMAS_POR_FICHEIRO & pragmas.keys():
+            cursor.execute(f"PRAGMA arquivo.{nome}={pragmas[nome]}")
+        if so_leitura:
+            cursor.execute("PRAGMA query_only=ON")
+        cursor.close()
+
+
+def criar_engines(ficheiro: str, arquivo: str):
+    """Devolve (engine de escrita, engine de leitura) de um ficheiro; no perfil simples são o mesmo."""
+    url = f"sqlite:///{ficheiro}"
+    if NUM_LEITORES > 0:
+        # uma só ligação de escrita: quem quer escrever espera pela vez no pool
+        escrita = create_engine(
+            url,
+            connect_args={"check_same_thread": False},
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=30,
+        )
+        aplicar_pragmas(escrita, {"journal_mode": "WAL", **perfil["pragmas"]}, arquivo)
+
+        leitura = create_engine(
+            url,
+            connect_args={"check_same_thread": False},
+            pool_size=NUM_LEITORES,
+            max_overflow=0,
+            pool_timeout=30,
+        )
+        aplicar_pragmas(leitura, perfil["pragmas"], arquivo, so_leitura=True)
+    else:
+        escrita = create_engine(url, connect_args={"check_same_thread": False})
+        aplicar_pragmas(escrita, perfil["pragmas"], arquivo)
+        leitura = escrita
+    return escrita, leitura
+
+
+def criar_engines_async(ficheiro: str, arquivo: str):
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url_async = f"sqlite+aiosqlite:///{ficheiro}"
+    if NUM_LEITORES > 0:
+        escrita = create_async_engine(url_async, pool_size=1, max_overflow=0, pool_timeout=30)
+        aplicar_pragmas(escrita.sync_engine, {"journal_mode": "WAL", **perfil["pragmas"]}, arquivo)
+        leitura = create_async_engine(url_async, pool_size=NUM_LEITORES, max_overflow=0, pool_timeout=30)
+        aplicar_pragmas(leitura.sync_engine, perfil["pragmas"], arquivo, so_leitura=True)
+    else:
+        escrita = create_async_engine(url_async)
+        aplicar_pragmas(escrita.sync_engine, perfil["pragmas"], arquivo)
+        leitura = escrita
+    return escrita, leitura
+
+
+# Clínicas (uma base de dados por clínica)
+# Sem CLINICA_CLINICAS_DIR há uma só clínica, em CLINICA_DB, como antes. Com
+# ele, o mesmo processo serve várias clínicas, cada uma na sua pasta
+# <CLINICA_CLINICAS_DIR>/<clínica>/ com database.db, o arquivo e as pastas de
+# saída e de cópias. A clínica de cada pedido vem do prefixo
+# /clinicas/<clínica>/... ou do cabeçalho X-Clinica, e fica em clinica_atual
+# durante o pedido; o código lê os engines com clinica().engine e
+# clinica().engine_leitura.
+# Os engines (e os seus pools de ligações) só são criados no primeiro pedido a
+# uma clínica, que também cria ou atualiza o esquema. Ficam numa LRU com no
+# máximo CLINICAS_ABERTAS clínicas; uma clínica sem pedidos em curso fecha os
+# engines quando sai da LRU ou ao fim de CLINICAS_INATIVIDADE segundos parada.
+# Uma clínica é aceite se a sua pasta já tiver database.db ou se estiver em
+# CLINICA_CLINICAS (lista separada por vírgulas), e então é criada no primeiro
+# uso; um nome desconhecido dá 404 sem tocar no disco.
+
+CLINICAS_DIR = os.environ.get("CLINICA_CLINICAS_DIR")
+CLINICAS_PERMITIDAS = {nome.strip() for nome in os.environ.get("CLINICA_CLINICAS", "").split(",") if nome.strip()}
+CLINICAS_ABERTAS = int(os.environ.get("CLINICA_CLINICAS_ABERTAS", 32))
+CLINICAS_INATIVIDADE = float(os.environ.get("CLINICA_CLINICAS_INATIVIDADE", 600))
+NOME_CLINICA_RE = re.compile(r"[a-z0-9][a-z0-9_-]{0,62}")
+PREFIXO_CLINICA = "/clinicas/"
+CABECALHO_CLINICA = b"x-clinica"
+
+
+class Clinica:
+    """Os engines e o feed de marcações de uma clínica; nome é None na clínica única."""
+
+    def __init__(self, nome: Optional[str], ficheiro: str, arquivo: str, saida: str, copias: str):
+        self.nome = nome
+        self.db_file = ficheiro
+        self.arquivo_file = arquivo
+        self.saida_dir = saida
+        self.copias_dir = copias
+        self.engine, self.engine_leitura = criar_engines(ficheiro, arquivo)
+        motores = {self.engine, self.engine_leitura}
+        self.engine_async = self.engine_async_leitura = None
+        if MODO_API == "async":
+            self.engine_async, self.engine_async_leitura = criar_engines_async(ficheiro, arquivo)
+            motores |= {self.engine_async.sync_engine, self.engine_async_leitura.sync_engine}
+        for motor in motores:
+            instrumentar_engine(motor)
+        self.feed_marcacoes = FeedAlteracoes(ler_alteracoes, ultima_alteracao)
+        self.preparada = False
+        self.lock = threading.Lock()
+        self.em_uso = 0
+        self.usada_em = relogio.monotonic()
+
+    def preparar(self):
+        """Cria ou atualiza o esquema e limpa os registos expirados, uma vez por abertura."""
+        with self.lock:
+            if self.preparada:
+                return
+            if self.nome is not None:
+                os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+            token = clinica_atual.set(self)
+            try:
+                create_db_and_tables()
+                with self.engine.begin() as ligacao:
+                    limpar_alteracoes(ligacao)
+                    limpar_pedidos_idempotentes(ligacao)
+                    limpar_sessoes(ligacao)
+            finally:
+                clinica_atual.reset(token)
+            self.preparada = True
+
+    async def fechar(self):
+        for motor in {self.engine, self.engine_leitura}:
+            motor.dispose()
+        if self.engine_async is not None:
+            for motor in {self.engine_async, self.engine_async_leitura}:
+                await motor.dispose()
+
+
+def pasta_clinica(nome: str):
+    return os.path.join(CLINICAS_DIR, nome)
+
+
+class ClinicasAbertas:
+    def __init__(self, capacidade: int, inatividade: float):
+        self.capacidade = capacidade
+        self.inatividade = inatividade
+        self.abertas = OrderedDict()
+        self.a_fechar = []
+        self.unica = None
+        self.lock = threading.Lock()
+
+    def existe(self, nome: str):
+        return nome in CLINICAS_PERMITIDAS or os.path.exists(os.path.join(pasta_clinica(nome), "database.db"))
+
+    def conhecidas(self):
+        if not CLINICAS_DIR:
+            return [None]
+        pastas = os.listdir(CLINICAS_DIR) if os.path.isdir(CLINICAS_DIR) else []
+        return sorted(CLINICAS_PERMITIDAS | {nome for nome in pastas if NOME_CLINICA_RE.fullmatch(nome) and self.existe(nome)})
+
+    def nomes_abertos(self):
+        if not CLINICAS_DIR:
+            return [None]
+        with self.lock:
+            return list(self.abertas)
+
+    def adquirir(self, nome: Optional[str], criar: bool = False):
+        """Devolve a clínica, aberta e marcada em uso, ou None se não existir; libertar() no fim."""
+        if nome is None or not CLINICAS_DIR:
+            with self.lock:
+                if self.unica is None:
+                    self.unica = Clinica(None, db_file, arquivo_file, SAIDA_DIR, COPIAS_DIR)
+                return self.unica
+        if not NOME_CLINICA_RE.fullmatch(nome):
+            return None
+        with self.lock:
+            atual = self.abertas.get(nome)
+            if atual is None:
+                if not (criar or self.existe(nome)):
+                    return None
+                pasta = pasta_clinica(nome)
+                atual = Clinica(
+                    nome,
+                    os.path.join(pasta, "database.db"),
+                    os.path.join(pasta, "database-arquivo.db"),
+                    os.path.join(pasta, "database-saida"),
+                    os.path.join(pasta, "database-copias"),
+                )
+                self.abertas[nome] = atual
+            self.abertas.move_to_end(nome)
+            atual.em_uso += 1
+            atual.usada_em = relogio.monotonic()
+            self.despejar()
+        return atual
+
+    def libertar(self, atual: Clinica):
+        if atual.nome is None:
+            return
+        with self.lock:
+            atual.em_uso -= 1
+            atual.usada_em = relogio.monotonic()
+            self.despejar()
+
+    def despejar(self):
+        # só sai quem não tem pedidos em curso; as restantes ficam, mesmo acima da capacidade
+        agora = relogio.monotonic()
+        for nome, atual in list(self.abertas.items()):
+            if atual.em_uso == 0 and (len(self.abertas) > self.capacidade or agora - atual.usada_em > self.inatividade):
+                del self.abertas[nome]
+                self.a_fechar.append(atual)
+
+    async def fechar_despejadas(self):
+        with self.lock:
+            fechar, self.a_fechar = self.a_fechar, []
+        for atual in fechar:
+            await atual.fechar()
+
+    def estatisticas(self):
+        with self.lock:
+            return {
+                "abertas": len(self.abertas),
+                "em_uso": sum(atual.em_uso > 0 for atual in self.abertas.values()),
+                "capacidade": self.capacidade,
+                "inatividade": self.inatividade,
+            }
+
+
+clinicas = ClinicasAbertas(CLINICAS_ABERTAS, CLINICAS_INATIVIDADE)
+clinica_atual: ContextVar[Optional[Clinica]] = ContextVar("clinica_atual", default=None)
+
+
+def clinica() -> Clinica:
+    atual = clinica_atual.get()
+    if atual is None:
+        if CLINICAS_DIR:
+            raise HTTPException(
+                status_code=400,
+                detail="Indique a clínica no caminho (/clinicas/{clinica}/...) ou no cabeçalho X-Clinica",
+            )
+        atual = clinicas.adquirir(None)
+    return atual
+
+
+@contextmanager
+def usar_clinica(nome: Optional[str], criar: bool = False):
+    """Torna `nome` a clínica atual deste contexto (para a linha de comandos e as tarefas)."""
+    atual = clinicas.adquirir(nome, criar)
+    if atual is None:
+        raise LookupError(f"Clínica não encontrada: {nome}")
+    token = clinica_atual.set(atual)
+    try:
+        atual.preparar()
+        yield atual
+    finally:
+        clinica_atual.reset(token)
+        clinicas.libertar(atual)
+
+
+class RotearClinica:
+    """Middleware ASGI que escolhe a clínica do pedido e a mantém aberta até ao fim da resposta."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not CLINICAS_DIR:
+            return await self.app(scope, receive, send)
+        nome = None
+        raiz = scope.get("root_path", "")
+        caminho = scope["path"][len(raiz):] if scope["path"].startswith(raiz) else scope["path"]
+        if caminho.startswith(PREFIXO_CLINICA):
+            nome = caminho[len(PREFIXO_CLINICA):].split("/", 1)[0]
+            # o prefixo passa a fazer parte do root_path: as rotas veem /pacientes
+            scope = dict(scope, root_path=raiz + PREFIXO_CLINICA + nome)
+        else:
+            nome = next((valor.decode("latin-1") for chave, valor in scope["headers"] if chave == CABECALHO_CLINICA), None)
+        if nome is None:
+            # /docs, /metrics...; as rotas com base de dados respondem 400
+            return await self.app(scope, receive, send)
+
+        atual = clinicas.adquirir(nome)
+        if atual is None:
+            resposta = Response(codificar_json({"detail": "Clínica não encontrada"}), status_code=404, media_type="application/json")
+            return await resposta(scope, receive, send)
+        token = clinica_atual.set(atual)
+        try:
+            if not atual.preparada:
+                try:
+                    await run_in_threadpool(atual.preparar)
+                except EsquemaDesatualizado as erro:
+                    resposta = Response(codificar_json({"detail": str(erro)}), status_code=503, media_type="application/json")
+                    return await resposta(scope, receive, send)
+            await self.app(scope, receive, send)
+        finally:
+            clinica_atual.reset(token)
+            clinicas.libertar(atual)
+            await clinicas.fechar_despejadas()
+
+
+# Migrações do esquema
+# Cada ficheiro guarda a versão do seu esquema em PRAGMA user_version (o
+# principal e o arquivo têm listas de migrações próprias). migrar() lê as duas
+# versões e, se já forem as últimas, não faz mais nada: sem create_all nem
+# reflexão de tabelas, o arranque custa duas leituras de PRAGMA. Senão aplica
+# as migrações em falta por ordem, cada uma numa transação BEGIN IMMEDIATE que
+# grava também a nova versão; dois processos a arrancar ao mesmo tempo
+# esperam um pelo outro e o segundo já não encontra nada para fazer.
+# Uma base com versão 0 tanto pode ser nova como anterior às migrações (o
+# database.db distribuído) ou uma carga do gerador interrompida, por isso
+# todas as migrações são idempotentes: criam só o que falta e apagam com IF
+# EXISTS. Migrações novas acrescentam-se sempre no fim da lista; as que já
+# foram publicadas não se alteram.
+# Os índices são criados um por transação, com uma pausa entre eles, para que
+# os pedidos de escrita não fiquem à espera da migração inteira. Numa base
+# grande é melhor aplicar as migrações com "python gerir.py migrar" antes de
+# arrancar os workers; com CLINICA_MIGRACOES=verificar a API não as aplica e
+# recusa-se a servir uma base desatualizada.
+
+MIGRACOES_MODO = os.environ.get("CLINICA_MIGRACOES", "aplicar")
+MIGRACOES_PAUSA = float(os.environ.get("CLINICA_MIGRACOES_PAUSA", 0.05))  # segundos entre índices
+
+log_migracoes = logging.getLogger("clinica.migracoes")
+
+
+class EsquemaDesatualizado(RuntimeError):
+    pass
+
+
+# índices de versões anteriores que já não fazem parte do esquema
+INDICES_OBSOLETOS = [
+    # hora_marcacao era única na tabela inteira: dois médicos nunca podiam
+    # ter consulta à mesma hora, em nenhum dia
+    "ix_marcacao_hora_marcacao",
+    # o mesmo com hora_consulta: uma só consulta a cada hora, em toda a clínica
+    "ix_consulta_hora_consulta",
+    # substituídos por (campo, ..., id), que também dão a ordem do cursor e de ?sort=
+    "ix_consulta_data_consulta",
+    "ix_pagamento_data_pagamento",
+    "ix_usuario_tipo_usuario",
+    # duas contas podiam não ter a mesma senha; com sal, os hashes nunca se repetem
+    "ix_usuario_senha_has",
+]
+
+
+# colunas acrescentadas a tabelas que já existiam: (tabela, coluna, definição)
+COLUNAS_NOVAS = [
+    ("consulta", "total", "FLOAT NOT NULL DEFAULT 0"),
+    *(
+        (tabela, "versao", "INTEGER NOT NULL DEFAULT 1")
+        for tabela in (
+            "usuario", "paciente", "medico", "funcionario", "marcacao",
+            "servico", "consulta", "consultaservice", "pagamento",
+        )
+    ),
+]
+
+
+def migrar_tabelas(ligacao):
+    # numa base nova cria já tudo, com as colunas e índices atuais
+    SQLModel.metadata.create_all(ligacao)
+
+
+def migrar_indices_obsoletos(ligacao):
+    for nome in INDICES_OBSOLETOS:
+        ligacao.exec_driver_sql(f"DROP INDEX IF EXISTS {nome}")
+
+
+def migrar_colunas_novas(ligacao):
+    for tabela, coluna, definicao in COLUNAS_NOVAS:
+        existentes = {linha[1] for linha in ligacao.exec_driver_sql(f"PRAGMA table_info({tabela})")}
+        if coluna not in existentes:
+            ligacao.exec_driver_sql(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}")
+
+
+def migrar_indices(ligacao):
+    # create_all não acrescenta índices novos a tabelas que já existem
+    for tabela in SQLModel.metadata.sorted_tables:
+        for indice in tabela.indexes:
+            if ligacao.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?", (indice.name,)).first():
+                continue
+            inicio = relogio.perf_counter()
+            indice.create(ligacao)
+            # cada índice fica gravado na sua transação; a migração só termina
+            # (e sobe a versão) depois do último
+            ligacao.commit()
+            log_migracoes.info("índice %s criado em %.0f ms", indice.name, (relogio.perf_counter() - inicio) * 1000)
+            relogio.sleep(MIGRACOES_PAUSA)
+            ligacao.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def migrar_pesquisa_pacientes(ligacao):
+    criar_pesquisa_pacientes(ligacao)
+
+
+def migrar_tabelas_arquivo(ligacao):
+    METADADOS_ARQUIVO.create_all(ligacao)
+
+
+# a tarefa fechar-marcacoes (e o gerador.py) gravavam "realizada"; o estado
+# pedido, e o único que passa a ser escrito, é "concluida"
+def migrar_estado_concluida(ligacao, opcoes=None):
+    tabela = Marcacao.__table__
+    ligacao.execute(
+        update(tabela).where(tabela.c.estado_marcacao == "realizada").values(estado_marcacao=ESTADO_MARCACAO_CONCLUIDA),
+        execution_options=opcoes or {},
+    )
+
+
+def migrar_estado_concluida_arquivo(ligacao):
+    migrar_estado_concluida(ligacao, SCHEMA_ARQUIVO)
+
+
+# (descrição, função) por ordem; a versão é a posição na lista a contar de 1
+MIGRACOES = {
+    "main": [
+        ("tabelas", migrar_tabelas),
+        ("remove índices obsoletos", migrar_indices_obsoletos),
+        ("colunas total e versao", migrar_colunas_novas),
+        ("índices em falta", migrar_indices),
+        ("pesquisa de pacientes (FTS5)", migrar_pesquisa_pacientes),
+        ("índices (medico_id, id) das listas", migrar_indices),
+        ("estado de marcação realizada -> concluida", migrar_estado_concluida),
+    ],
+    "arquivo": [
+        ("tabelas do arquivo", migrar_tabelas_arquivo),
+        ("estado de marcação realizada -> concluida", migrar_estado_concluida_arquivo),
+    ],
+}
+
+
+def versao_esquema(ligacao, ficheiro: str):
+    return ligacao.exec_driver_sql(f"PRAGMA {ficheiro}.user_version").scalar()
+
+
+def estado_migracoes(ligacao):
+    """{ficheiro: (versão atual, última versão, descrições pendentes)}"""
+    estado = {}
+    for ficheiro, migracoes in MIGRACOES.items():
+        versao = versao_esquema(ligacao, ficheiro)
+        if versao > len(migracoes):
+            raise EsquemaDesatualizado(
+                f"O esquema de {ficheiro} está na versão {versao}, mais recente que a deste código ({len(migracoes)})"
+            )
+        estado[ficheiro] = (versao, len(migracoes), [descricao for descricao, _ in migracoes[versao:]])
+    return estado
+
+
+def esquema_incompleto(ligacao):
+    # volta a versão a 0: a próxima chamada de migrar() repete todas as
+    # migrações, que recriam o que tiver sido apagado (ver gerador.adiar_indices)
+    ligacao.exec_driver_sql("PRAGMA main.user_version = 0")
+
+
+def migrar(progresso=None, aplicar: bool = True):
+    """Aplica as migrações em falta e devolve as aplicadas, como (ficheiro, versão, descrição).
+
+    Com aplicar=False só verifica, e levanta EsquemaDesatualizado se houver alguma pendente.
+    """
+    aplicadas = []
+    with clinica().engine.connect() as ligacao:
+        estado = estado_migracoes(ligacao)
+        ligacao.rollback()
+        if not any(pendentes for _, _, pendentes in estado.values()):
+            return aplicadas
+        if not aplicar:
+            pendentes = "; ".join(f"{ficheiro} {atual} -> {ultima}" for ficheiro, (atual, ultima, _) in estado.items() if atual < ultima)
+            raise EsquemaDesatualizado(f"Migrações pendentes em {clinica().db_file} ({pendentes}); corra python gerir.py migrar")
+        for ficheiro, migracoes in MIGRACOES.items():
+            while True:
+                ligacao.exec_driver_sql("BEGIN IMMEDIATE")
+                versao = versao_esquema(ligacao, ficheiro)
+                if versao >= len(migracoes):
+                    ligacao.rollback()
+                    break
+                descricao, funcao = migracoes[versao]
+                inicio = relogio.perf_counter()
+                funcao(ligacao)
+                ligacao.exec_driver_sql(f"PRAGMA {ficheiro}.user_version = {versao + 1}")
+                ligacao.commit()
+                log_migracoes.info(
+                    "%s: %s versão %d (%s) em %.0f ms",
+                    clinica().db_file, ficheiro, versao + 1, descricao, (relogio.perf_counter() - inicio) * 1000,
+                )
+                aplicadas.append((ficheiro, versao + 1, descricao))
+                if progresso:
+                    progresso(ficheiro, versao + 1, descricao)
+    return aplicadas
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
 
-def get_session():
-    with Session(engine) as session: 
+def create_db_and_tables():
+    migrar(aplicar=MIGRACOES_MODO != "verificar")
+
+
+# Pesquisa de pacientes (FTS5)
+# paciente_fts é um índice de texto com conteúdo externo: guarda só os tokens
+# de nome, telefone, num_bi e email e aponta para o rowid da linha em paciente.
+# Os triggers mantêm-no sincronizado em cada INSERT, UPDATE e DELETE, incluindo
+# os feitos pelo bulk. remove_diacritics faz "Joao" encontrar "João" e os
+# índices de prefixo tornam rápidas as pesquisas por início de palavra.
+# Um VACUUM pode renumerar os rowid de paciente: depois de um VACUUM correr
+# "python gerir.py reconstruir-pesquisa".
+
+DDL_PESQUISA_PACIENTES = [
+    """
+    CREATE VIRTUAL TABLE paciente_fts USING fts5(
+        nome, telefone, num_bi, email,
+        content='paciente', content_rowid='rowid',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER paciente_fts_ai AFTER INSERT ON paciente BEGIN
+        INSERT INTO paciente_fts(rowid, nome, telefone, num_bi, email)
+        VALUES (new.rowid, new.nome, new.telefone, new.num_bi, new.email);
+    END
+    """,
+    """
+    CREATE TRIGGER paciente_fts_ad AFTER DELETE ON paciente BEGIN
+        INSERT INTO paciente_fts(paciente_fts, rowid, nome, telefone, num_bi, email)
+        VALUES ('delete', old.rowid, old.nome, old.telefone, old.num_bi, old.email);
+    END
+    """,
+    """
+    CREATE TRIGGER paciente_fts_au AFTER UPDATE ON paciente BEGIN
+        INSERT INTO paciente_fts(paciente_fts, rowid, nome, telefone, num_bi, email)
+        VALUES ('delete', old.rowid, old.nome, old.telefone, old.num_bi, old.email);
+        INSERT INTO paciente_fts(rowid, nome, telefone, num_bi, email)
+        VALUES (new.rowid, new.nome, new.telefone, new.num_bi, new.email);
+    END
+    """,
+]
+
+
+def criar_pesquisa_pacientes(ligacao):
+    existe = ligacao.exec_driver_sql(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'paciente_fts'"
+    ).first()
+    if existe:
+        return
+    for ddl in DDL_PESQUISA_PACIENTES:
+        ligacao.exec_driver_sql(ddl)
+    # indexa os pacientes que já existiam
+    reconstruir_pesquisa_pacientes(ligacao)
+
+
+def remover_pesquisa_pacientes(ligacao):
+    # os triggers primeiro: sem a tabela, um INSERT em paciente falharia
+    for trigger in ("paciente_fts_ai", "paciente_fts_ad", "paciente_fts_au"):
+        ligacao.exec_driver_sql(f"DROP TRIGGER IF EXISTS {trigger}")
+    ligacao.exec_driver_sql("DROP TABLE IF EXISTS paciente_fts")
+
+
+def reconstruir_pesquisa_pacientes(ligacao):
+    ligacao.exec_driver_sql("INSERT INTO paciente_fts(paciente_fts) VALUES ('rebuild')")
+
+
+def expressao_pesquisa(q: str):
+    # cada palavra passa a prefixo entre aspas ("ana"* "9231"*): o texto do
+    # utilizador nunca é interpretado como sintaxe FTS5
+    palavras = re.findall(r"\w+", q)
+    return " ".join(f'"{palavra}"*' for palavra in palavras)
+
+
+# Arquivo (dados históricos noutro ficheiro)
+# Consultas, marcações, pagamentos e linhas de consulta só crescem. arquivar()
+# move os anteriores a um limite para o ficheiro arquivo_file, anexado a todas
+# as ligações como "arquivo" e com as mesmas tabelas (sem FKs nem índices
+# únicos). Cada consulta muda de ficheiro com as suas linhas, pagamentos e
+# marcação, e só quando todas as datas do grupo são anteriores ao limite: uma
+# linha arquivada tem sempre a data antes de limite_arquivo, e tudo o que é
+# igual ou posterior está no ficheiro principal.
+# As leituras com intervalo de datas (?data_consulta_de=, faturas, exportação)
+# só vão também ao arquivo quando o intervalo começa antes desse limite; as
+# linhas das duas origens são juntadas pela ordem pedida. Sem intervalo de
+# datas lê-se só o ficheiro principal, e os GET por id procuram no arquivo
+# quando não encontram a linha. Os resumos dos relatórios continuam a contar
+# as linhas arquivadas.
+# Com WAL, o COMMIT de um lote não é atómico entre os dois ficheiros: uma
+# leitura nesse instante pode ver a mesma linha nos dois, e as listas
+# descartam o duplicado.
+
+TABELAS_ARQUIVADAS = [Marcacao, Consulta, ConsultaService, Pagamento]
+COLUNA_DATA_ARQUIVO = {Marcacao: "data_marcacao", Consulta: "data_consulta", Pagamento: "data_pagamento"}
+# executa a mesma instrução sobre as tabelas do arquivo
+SCHEMA_ARQUIVO = {"schema_translate_map": {None: "arquivo"}}
+ARQUIVO_DIAS = int(os.environ.get("CLINICA_ARQUIVO_DIAS", "730"))
+
+METADADOS_ARQUIVO = MetaData()
+
+
+def copiar_tabela_arquivo(tabela: Table):
+    copia = Table(
+        tabela.name,
+        METADADOS_ARQUIVO,
+        *(Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable) for c in tabela.columns),
+        schema="arquivo",
+    )
+    for indice in tabela.indexes:
+        if not indice.unique:
+            Index(indice.name, *(copia.c[c.name] for c in indice.columns))
+    return copia
+
+
+TABELAS_ARQUIVO = {modelo: copiar_tabela_arquivo(modelo.__table__) for modelo in TABELAS_ARQUIVADAS}
+
+limite_arquivo = Table(
+    "limite_arquivo",
+    METADADOS_ARQUIVO,
+    Column("id", Integer, primary_key=True),
+    Column("limite", Date, nullable=False),
+    schema="arquivo",
+)
+
+
+def ler_limite_arquivo(ligacao):
+    return ligacao.execute(select(limite_arquivo.c.limite)).scalar()
+
+
+def alcanca_arquivo(ligacao, de: Optional[date]):
+    limite = ler_limite_arquivo(ligacao)
+    return limite is not None and (de is None or de < limite)
+
+
+def buscar_arquivado(ligacao, modelo, item_id: uuid.UUID):
+    if modelo not in TABELAS_ARQUIVO:
+        return None
+    linha = ligacao.execute(
+        select(*modelo.__table__.columns).where(modelo.id == item_id), execution_options=SCHEMA_ARQUIVO
+    ).mappings().first()
+    return None if linha is None else dict(linha)
+
+
+def juntar_com_arquivo(ligacao, consulta, chaves: List[str], descendente: bool = False, maximo: Optional[int] = None):
+    """Corre `consulta` nos dois ficheiros e junta as linhas pela ordem de `chaves`."""
+    principais = ligacao.execute(consulta).mappings().all()
+    arquivadas = ligacao.execute(consulta, execution_options=SCHEMA_ARQUIVO).mappings().all()
+    chave = lambda linha: tuple(linha[c] for c in chaves)
+    linhas = []
+    for linha in heapq.merge(arquivadas, principais, key=chave, reverse=descendente):
+        if linhas and linhas[-1]["id"] == linha["id"]:
+            continue
+        linhas.append(dict(linha))
+        if len(linhas) == maximo:
+            break
+    return linhas
+
+
+def copiar_para_arquivo(ligacao, modelo, condicao):
+    tabela = modelo.__table__
+    ligacao.execute(
+        insert(TABELAS_ARQUIVO[modelo])
+        .prefix_with("OR IGNORE")
+        .from_select(list(tabela.columns.keys()), select(*tabela.columns).where(condicao))
+    )
+
+
+def arquivar(limite: date, tamanho_lote: int = 1000, progresso=None):
+    """Move para o arquivo, em lotes de `tamanho_lote` consultas, tudo o que é anterior a `limite`."""
+    # o limite é gravado antes de mover: entretanto as leituras já consultam o
+    # arquivo, e uma linha ainda não movida continua no ficheiro principal
+    with clinica().engine.begin() as ligacao:
+        atual = ler_limite_arquivo(ligacao)
+        if atual is None or limite > atual:
+            ligacao.execute(
+                sqlite_insert(limite_arquivo)
+                .values(id=1, limite=limite)
+                .on_conflict_do_update(index_elements=["id"], set_={"limite": limite})
+            )
+
+    contagem = dict.fromkeys((m.__tablename__ for m in TABELAS_ARQUIVADAS), 0)
+    pagamento_posterior = (
+        select(Pagamento.id)
+        .where(Pagamento.consulta_id == Consulta.id, Pagamento.data_pagamento >= limite)
+        .exists()
+    )
+    consultas_antigas = (
+        select(Consulta.id)
+        .outerjoin(Marcacao, Marcacao.id == Consulta.marcacao_id)
+        .where(
+            Consulta.data_consulta < limite,
+            func.coalesce(Marcacao.data_marcacao, Consulta.data_consulta) < limite,
+            ~pagamento_posterior,
+        )
+        .order_by(Consulta.data_consulta)
+        .limit(tamanho_lote)
+    )
+    # marcações que nunca chegaram a consulta (canceladas, faltas)
+    marcacoes_soltas = (
+        select(Marcacao.id)
+        .where(
+            Marcacao.data_marcacao < limite,
+            ~select(Consulta.id).where(Consulta.marcacao_id == Marcacao.id).exists(),
+        )
+        .order_by(Marcacao.data_marcacao)
+        .limit(tamanho_lote)
+    )
+
+    while True:
+        with clinica().engine.begin() as ligacao:
+            ids = ligacao.execute(consultas_antigas).scalars().all()
+            if ids:
+                grupo = {
+                    ConsultaService: ConsultaService.consulta_id.in_(ids),
+                    Pagamento: Pagamento.consulta_id.in_(ids),
+                    Marcacao: Marcacao.id.in_(select(Consulta.marcacao_id).where(Consulta.id.in_(ids))),
+                    Consulta: Consulta.id.in_(ids),
+                }
+            else:
+                ids = ligacao.execute(marcacoes_soltas).scalars().all()
+                if not ids:
+                    break
+                grupo = {Marcacao: Marcacao.id.in_(ids)}
+
+            for modelo, condicao in grupo.items():
+                copiar_para_arquivo(ligacao, modelo, condicao)
+            # apaga pela mesma ordem: a marcação é encontrada pela consulta
+            for modelo, condicao in grupo.items():
+                contagem[modelo.__tablename__] += ligacao.execute(delete(modelo).where(condicao)).rowcount
+        if progresso:
+            progresso(contagem)
+    return contagem
+
+
+# uma sessão por pedido: GET/HEAD vão ao pool só de leitura, o resto à ligação
+# de escrita. scope="function" fecha a sessão (e devolve a ligação ao pool)
+# logo que o handler termina, antes de a resposta ser enviada.
+METODOS_LEITURA = {"GET", "HEAD", "OPTIONS"}
+
+
+def get_session(request: Request):
+    atual = clinica()
+    engine_pedido = atual.engine_leitura if request.method in METODOS_LEITURA else atual.engine
+    with Session(engine_pedido) as session:
         yield session
-        
-DBSession = Annotated[Session, Depends(get_session)]
+
+
+DBSession = Annotated[Session, Depends(get_session, scope="function")]
+# as respostas em streaming leem depois de o handler terminar: a sessão só
+# fecha quando a resposta acabar de ser enviada
+DBSessionStreaming = Annotated[Session, Depends(get_session, scope="request")]
+
+
+# Paginação por cursor (keyset)
+# As listas são ordenadas pela chave primária e o cursor é o id da última linha
+# devolvida, por isso cada página custa uma procura no índice da PK e não um
+# OFFSET que percorre as linhas anteriores. Nas tabelas com uuid7 esta ordem é a
+# ordem de criação; no Paciente (uuid4) a ordem não é cronológica, mas é estável.
+
+LIMITE_PADRAO = 50
+LIMITE_MAXIMO = 500
+
+T = TypeVar("T")
+
+
+class Pagina(BaseModel, Generic[T]):
+    items: List[T]
+    next_cursor: Optional[uuid.UUID] = None
+
+
+Limite = Annotated[int, Query(ge=1, le=LIMITE_MAXIMO)]
+Cursor = Annotated[Optional[uuid.UUID], Query()]
+
+
+# Listas: projeção, filtros e ordenação
+# ?fields=id,nome,telefone limita as colunas do SELECT (o id vem sempre, é o
+# cursor). Os campos de FILTROS_LISTA filtram por igualdade (?medico_id=...),
+# as datas também por intervalo (?data_marcacao_de=...&data_marcacao_ate=...)
+# e os estado_* aceitam vários valores (?estado_marcacao=agendada,confirmada).
+# ?sort=data_marcacao,hora_marcacao (ou -data_marcacao,-hora_marcacao) ordena
+# por uma das combinações de ORDENACOES_LISTA e pelo id; o cursor continua a
+# ser o id da última linha e os seus valores de ordenação são lidos numa
+# subconsulta pela PK. Cada filtro e ordenação tem um índice (campo, ..., id);
+# "python gerir.py verificar-indices" confirma os planos com EXPLAIN QUERY PLAN.
+
+FILTROS_LISTA = {
+    Usuario: ["tipo_usuario", "username", "email"],
+    Paciente: ["usuario_id", "email", "data_registro"],
+    Medico: ["especialidade", "usuario_id", "email"],
+    Funcionario: ["cargo", "usuario_id", "email"],
+    Marcacao: ["medico_id", "paciente_id", "data_marcacao", "estado_marcacao"],
+    Servico: ["nome_servico"],
+    Consulta: ["medico_id", "paciente_id", "marcacao_id", "servico_id", "data_consulta"],
+    ConsultaService: ["consulta_id", "servico_id"],
+    Pagamento: ["paciente_id", "consulta_id", "data_pagamento", "estado_pagamento", "metodo_pagamento"],
+}
+
+ORDENACOES_LISTA = {
+    Usuario: [("username",)],
+    Paciente: [("nome",), ("data_registro",)],
+    Medico: [("nome_medico",)],
+    Funcionario: [("nome_funcionario",)],
+    Marcacao: [("data_marcacao", "hora_marcacao")],
+    Servico: [("nome_servico",), ("preco",)],
+    Consulta: [("data_consulta", "hora_consulta")],
+    Pagamento: [("data_pagamento",)],
+}
+
+
+# modelo de tabela -> modelo das respostas, quando há colunas que nunca saem
+# da API; as listas nem as leem e ?fields= não as aceita
+MODELOS_PUBLICOS = {
+    Usuario: UsuarioPublico,
+}
+
+
+def campos_publicos(modelo):
+    return list(MODELOS_PUBLICOS[modelo].model_fields) if modelo in MODELOS_PUBLICOS else list(modelo.__table__.c.keys())
+
+
+def publico(modelo, registo):
+    """O registo (objeto ou dict de uma linha) só com os campos do modelo público."""
+    if modelo not in MODELOS_PUBLICOS:
+        return registo
+    valores = registo if isinstance(registo, dict) else campos_linha(registo)
+    return {campo: valores[campo] for campo in campos_publicos(modelo)}
+
+
+class Listagem:
+    def __init__(self, modelo, campos=None, ordenacao=(), descendente=False, condicoes=(), inicios=None):
+        self.modelo = modelo
+        self.campos = campos
+        self.ordenacao = ordenacao
+        self.descendente = descendente
+        self.condicoes = list(condicoes)
+        # campo de data filtrado -> início do intervalo (None se só tem fim)
+        self.inicios = inicios or {}
+
+    def colunas(self):
+        tabela = self.modelo.__table__
+        return [tabela.c[campo] for campo in self.campos or campos_publicos(self.modelo)]
+
+
+def ler_campos(modelo, fields: Optional[str]):
+    if not fields:
+        return None
+    campos = ["id"] + [c.strip() for c in fields.split(",") if c.strip() and c.strip() != "id"]
+    conhecidos = campos_publicos(modelo)
+    desconhecidos = [c for c in campos if c not in conhecidos]
+    if desconhecidos:
+        raise HTTPException(status_code=422, detail=f"Campos desconhecidos: {', '.join(desconhecidos)}")
+    return list(dict.fromkeys(campos))
+
+
+def ler_ordenacao(modelo, sort: Optional[str]):
+    if not sort:
+        return (), False
+    chaves = [c.strip() for c in sort.split(",") if c.strip()]
+    descendente = chaves[0].startswith("-")
+    if any(c.startswith("-") != descendente for c in chaves):
+        raise HTTPException(status_code=422, detail="Todos os campos de sort têm de ter o mesmo sentido")
+    ordenacao = tuple(c.lstrip("-") for c in chaves)
+    permitidas = ORDENACOES_LISTA.get(modelo, [])
+    if ordenacao not in permitidas:
+        opcoes = "; ".join(",".join(o) for o in permitidas) or "nenhuma"
+        raise HTTPException(status_code=422, detail=f"Ordenação não suportada (opções: {opcoes})")
+    return ordenacao, descendente
+
+
+def parametros_lista(modelo):
+    """Dependência com os parâmetros de lista do modelo, tipados a partir dos campos."""
+    def parametro(nome, tipo):
+        return inspect.Parameter(
+            nome, inspect.Parameter.KEYWORD_ONLY, default=None, annotation=Annotated[Optional[tipo], Query()]
+        )
+
+    parametros = [parametro("fields", str), parametro("sort", str)]
+    intervalos = []
+    multiplos = []
+    for campo in FILTROS_LISTA.get(modelo, []):
+        tipo = modelo.model_fields[campo].annotation
+        if campo.startswith("estado_"):
+            multiplos.append(campo)
+            parametros.append(parametro(campo, List[tipo]))
+            continue
+        parametros.append(parametro(campo, tipo))
+        if tipo in (date, datetime):
+            intervalos.append(campo)
+            parametros += [parametro(f"{campo}_de", tipo), parametro(f"{campo}_ate", tipo)]
+
+    def ler(**valores):
+        # datas e horas sem fuso são UTC, como as gravadas pela API
+        valores = {
+            nome: valor.replace(tzinfo=timezone.utc) if isinstance(valor, datetime) and valor.tzinfo is None else valor
+            for nome, valor in valores.items()
+        }
+        condicoes = []
+        inicios = {}
+        for campo in FILTROS_LISTA.get(modelo, []):
+            coluna = getattr(modelo, campo)
+            valor = valores[campo]
+            if campo in multiplos and valor:
+                valor = [v for item in valor for v in item.split(",") if v]
+                condicoes.append(coluna.in_(valor))
+            elif valor is not None:
+                condicoes.append(coluna == valor)
+            if campo in intervalos:
+                de, ate = valores[f"{campo}_de"], valores[f"{campo}_ate"]
+                if de is not None:
+                    condicoes.append(coluna >= de)
+                if ate is not None:
+                    condicoes.append(coluna <= ate)
+                if valor is not None or de is not None or ate is not None:
+                    inicios[campo] = max((v for v in (valor, de) if v is not None), default=None)
+        ordenacao, descendente = ler_ordenacao(modelo, valores["sort"])
+        return Listagem(modelo, ler_campos(modelo, valores["fields"]), ordenacao, descendente, condicoes, inicios)
+
+    ler.__signature__ = inspect.Signature(parametros)
+    return ler
+
+
+def consulta_pagina(modelo, limit: int, after: Optional[uuid.UUID], lista: Optional[Listagem] = None, ancora=None):
+    lista = lista or Listagem(modelo)
+    chaves = [getattr(modelo, campo) for campo in lista.ordenacao] + [modelo.id]
+    consulta = (
+        select(modelo)
+        .where(*lista.condicoes)
+        .order_by(*(c.desc() for c in chaves) if lista.descendente else chaves)
+        .limit(limit + 1)
+    )
+    if after is not None:
+        if lista.ordenacao:
+            # (campos de ordenação, id) da linha do cursor, lidos pela PK, a
+            # não ser que já venham em `ancora`
+            if ancora is None:
+                ancora = select(*chaves).where(modelo.id == after).scalar_subquery()
+            linha = tuple_(*chaves)
+            consulta = consulta.where(linha < ancora if lista.descendente else linha > ancora)
+        else:
+            consulta = consulta.where(modelo.id > after)
+    return consulta
+
+
+def montar_pagina(linhas, limit: int):
+    next_cursor = None
+    if len(linhas) > limit:
+        linhas = linhas[:limit]
+        next_cursor = linhas[-1].id
+    return Pagina(items=linhas, next_cursor=next_cursor)
+
+
+class PaginaParcial(Pagina[dict]):
+    """Página com só as colunas pedidas em ?fields=, que não cumpre o response_model."""
+
+
+def pagina_de_linhas(resultado, limit: int, classe=Pagina):
+    nomes = list(resultado.keys())
+    linhas = [dict(zip(nomes, linha)) for linha in resultado]
+    next_cursor = None
+    if len(linhas) > limit:
+        linhas = linhas[:limit]
+        next_cursor = linhas[-1]["id"]
+    return classe.model_construct(items=linhas, next_cursor=next_cursor)
+
+
+def paginar_com_arquivo(ligacao, modelo, limit: int, after: Optional[uuid.UUID], lista: Listagem):
+    chaves = [*lista.ordenacao, "id"]
+    ancora = None
+    if after is not None and lista.ordenacao:
+        # o cursor pode ser uma linha de qualquer dos ficheiros
+        cursor = select(*(modelo.__table__.c[c] for c in chaves)).where(modelo.id == after)
+        ancora = ligacao.execute(cursor).first() or ligacao.execute(cursor, execution_options=SCHEMA_ARQUIVO).first()
+        if ancora is None:
+            return Pagina.model_construct(items=[], next_cursor=None)
+        ancora = tuple(ancora)
+
+    colunas = lista.colunas()
+    extra = [c for c in chaves if c not in {coluna.name for coluna in colunas}]
+    consulta = consulta_pagina(modelo, limit, after, lista, ancora)
+    consulta = consulta.with_only_columns(*colunas, *(modelo.__table__.c[c] for c in extra))
+    linhas = juntar_com_arquivo(ligacao, consulta, chaves, lista.descendente, limit + 1)
+    for linha in linhas:
+        for campo in extra:
+            del linha[campo]
+
+    next_cursor = None
+    if len(linhas) > limit:
+        linhas = linhas[:limit]
+        next_cursor = linhas[-1]["id"]
+    classe = Pagina if lista.campos is None else PaginaParcial
+    return classe.model_construct(items=linhas, next_cursor=next_cursor)
+
+
+def paginar(session: Session, modelo, limit: int, after: Optional[uuid.UUID], lista: Optional[Listagem] = None):
+    lista = lista or Listagem(modelo)
+    campo_data = COLUNA_DATA_ARQUIVO.get(modelo)
+    if campo_data in lista.inicios and alcanca_arquivo(session.connection(), lista.inicios[campo_data]):
+        return paginar_com_arquivo(session.connection(), modelo, limit, after, lista)
+
+    consulta = consulta_pagina(modelo, limit, after, lista)
+    if not JSON_RAPIDO and lista.campos is None:
+        return montar_pagina(session.exec(consulta).all(), limit)
+
+    # a página só vai ser serializada: dicts com os valores das colunas em vez
+    # de objetos ORM (sem identity map nem validação de cada linha)
+    resultado = session.connection().execute(consulta.with_only_columns(*lista.colunas()))
+    return pagina_de_linhas(resultado, limit, Pagina if lista.campos is None else PaginaParcial)
+
+
+# Respostas JSON rápidas
+# Com um response_model, o FastAPI revalida cada objeto devolvido contra o
+# modelo e só depois o codifica; nas listas isto é a maior parte do CPU do
+# pedido. responder() devolve logo uma resposta já codificada: as linhas vêm da
+# base de dados (ou de modelos já validados), por isso cada modelo passa a um
+# dict raso dos seus campos e o orjson trata de UUID, date, time e datetime.
+# Nas listas paginar() nem cria objetos ORM: lê as colunas para dicts.
+# O response_model continua declarado para o OpenAPI. CLINICA_JSON_RAPIDO=0
+# volta ao caminho normal do FastAPI. Sem orjson instalado usa-se o json da
+# biblioteca padrão com o mesmo atalho.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_RAPIDO = os.environ.get("CLINICA_JSON_RAPIDO", "1") == "1"
+
+
+def campos_linha(obj: BaseModel):
+    valores = obj.__dict__
+    return {
+        campo: valores[campo] if campo in valores else getattr(obj, campo)
+        for campo in type(obj).model_fields
+    }
+
+
+def converter_json(obj):
+    if isinstance(obj, BaseModel):
+        return campos_linha(obj)
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, datetime) and obj.utcoffset() == timedelta(0):
+        return obj.replace(tzinfo=None).isoformat() + "Z"
+    if isinstance(obj, (date, time)):  # datetime é subclasse de date
+        return obj.isoformat()
+    raise TypeError(f"{type(obj).__name__} não é serializável em JSON")
+
+
+def codificar_json(conteudo) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(conteudo, default=converter_json, option=orjson.OPT_UTC_Z)
+    return json.dumps(conteudo, default=converter_json, ensure_ascii=False).encode()
+
+
+class RespostaJSONRapida(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return codificar_json(content)
+
+
+def responder(conteudo):
+    # uma PaginaParcial tem de ser codificada aqui: o FastAPI rejeitá-la-ia
+    # contra o response_model
+    if not JSON_RAPIDO and not isinstance(conteudo, PaginaParcial):
+        return conteudo
+    return RespostaJSONRapida(conteudo)
+
+
+# campos mantidos pela API que o cliente não pode definir: modelo -> {campo: valor inicial}
+CAMPOS_CALCULADOS = {
+    Consulta: {"total": 0.0},
+}
+for _modelo in (Usuario, Paciente, Medico, Funcionario, Marcacao, Servico, Consulta, ConsultaService, Pagamento):
+    CAMPOS_CALCULADOS.setdefault(_modelo, {})["versao"] = 1
+
+
+def validar_modelo(modelo, dados):
+    obj = modelo.model_validate(dados)
+    for campo, valor in CAMPOS_CALCULADOS.get(modelo, {}).items():
+        setattr(obj, campo, valor)
+    return obj
+
+
+def validar(modelo, dados):
+    # o FastAPI não converte os tipos (datas, uuid, enum) ao construir um
+    # modelo table=True a partir do corpo do pedido, por isso valida-se aqui
+    try:
+        return validar_modelo(modelo, dados)
+    except ValidationError as erro:
+        raise HTTPException(status_code=422, detail=erro.errors(include_url=False, include_context=False))
+
+
+# Atualizações num só UPDATE (PUT e PATCH)
+# Em vez de session.get + copiar campos + commit + refresh, cada atualização é
+# um UPDATE ... SET <só as colunas enviadas>, versao = versao + 1 WHERE id = ?
+# RETURNING *. Se o cliente indicar a versão que leu (If-Match: "3" ou o campo
+# versao do corpo) o WHERE inclui AND versao = ?, e uma gravação concorrente
+# feita entretanto dá 409 em vez de ser silenciosamente sobreposta.
+
+def modelo_parcial(modelo):
+    ignorados = {"id", *CAMPOS_CALCULADOS.get(modelo, {})}
+    campos = {
+        nome: (Optional[info.annotation], None)
+        for nome, info in modelo.model_fields.items()
+        if nome not in ignorados
+    }
+    return create_model(f"{modelo.__name__}Parcial", versao=(Optional[int], None), **campos)
+
+
+def campos_editaveis(modelo):
+    ignorados = {"id", *CAMPOS_CALCULADOS.get(modelo, {})}
+    return [nome for nome in modelo.model_fields if nome not in ignorados]
+
+
+def versao_pedido(request: Request, versao: Optional[int]):
+    if_match = request.headers.get("if-match")
+    if not if_match:
+        return versao
+    try:
+        return int(if_match.removeprefix("W/").strip().strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=422, detail="If-Match tem de ser a versão do registo")
+
+
+def pedido_put(request: Request, modelo, dados):
+    validado = validar(modelo, dados)
+    alteracoes = {campo: getattr(validado, campo) for campo in campos_editaveis(modelo)}
+    versao = dados.versao if "versao" in dados.model_fields_set else None
+    return alteracoes, versao_pedido(request, versao)
+
+
+def pedido_patch(request: Request, dados: BaseModel):
+    alteracoes = dados.model_dump(exclude_unset=True, exclude={"versao"})
+    if not alteracoes:
+        raise HTTPException(status_code=422, detail="Nenhum campo para alterar")
+    return alteracoes, versao_pedido(request, dados.versao)
+
+
+def atualizar_linha(
+    session: Session,
+    modelo,
+    item_id: uuid.UUID,
+    alteracoes: dict,
+    versao: Optional[int],
+    nao_encontrado: str,
+    conflito: str = "Já existe um registo com esses dados",
+):
+    tabela = modelo.__table__
+    for campo, valor in alteracoes.items():
+        if valor is None and not tabela.c[campo].nullable:
+            raise HTTPException(status_code=422, detail=f"{campo} não pode ser nulo")
+
+    consulta = (
+        update(tabela)
+        .where(tabela.c.id == item_id)
+        .values(**alteracoes, versao=tabela.c.versao + 1)
+        .returning(*tabela.columns)
+    )
+    if versao is not None:
+        consulta = consulta.where(tabela.c.versao == versao)
+
+    resumir = not CAMPOS_RESUMO.get(modelo, set()).isdisjoint(alteracoes)
+    try:
+        if resumir:
+            atualizar_resumos(session, modelo, [item_id], -1)
+        linha = session.execute(consulta).mappings().first()
+        if linha is not None and resumir:
+            atualizar_resumos(session, modelo, [item_id], 1)
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(status_code=409, detail=conflito)
+
+    if linha is None:
+        # só se distingue 404 de 409 quando o UPDATE não encontrou a linha
+        atual = session.execute(select(tabela.c.versao).where(tabela.c.id == item_id)).scalar()
+        session.rollback()
+        if atual is None:
+            raise HTTPException(status_code=404, detail=nao_encontrado)
+        raise HTTPException(
+            status_code=409,
+            detail=f"O registo foi alterado entretanto (versão {atual}, esperada {versao})",
+        )
+    return dict(linha)
+
+
+def gravar_alteracoes(session: Session, modelo, item_id: uuid.UUID, alteracoes: dict, versao: Optional[int], nao_encontrado: str, **kwargs):
+    linha = atualizar_linha(session, modelo, item_id, alteracoes, versao, nao_encontrado, **kwargs)
+    session.commit()
+    invalidar_cache(modelo)
+    return responder(linha)
+
+
+# Cache dos dados de referência (serviços e médicos)
+# Estes dados são lidos em todos os ecrãs da receção e quase nunca mudam. As
+# respostas ficam guardadas já serializadas, com TTL e despejo LRU, e são
+# invalidadas por grupo sempre que um endpoint de escrita desse grupo faz
+# commit. O ETag e o Last-Modified permitem ao cliente receber um 304 sem corpo.
+# A cache é por processo: com vários workers, o TTL limita o tempo em que um
+# worker pode servir dados que outro já alterou.
+
+CACHE_TTL = float(os.environ.get("CLINICA_CACHE_TTL", 60))
+CACHE_CAPACIDADE = int(os.environ.get("CLINICA_CACHE_CAPACIDADE", 256))
+
+
+class EntradaCache(BaseModel):
+    corpo: bytes
+    etag: str
+    ultima_modificacao: float
+    expira_em: float
+
+
+class CacheReferencia:
+    def __init__(self, capacidade: int, ttl: float):
+        self.capacidade = capacidade
+        self.ttl = ttl
+        self.entradas = OrderedDict()
+        self.modificado_em = {}
+        self.geracoes = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def obter(self, chave):
+        with self.lock:
+            entrada = self.entradas.get(chave)
+            if entrada is None or entrada.expira_em < relogio.monotonic():
+                self.entradas.pop(chave, None)
+                self.misses += 1
+                return None
+            self.entradas.move_to_end(chave)
+            self.hits += 1
+            return entrada
+
+    def geracao(self, grupo: str):
+        with self.lock:
+            return self.geracoes.get(grupo, 0)
+
+    def guardar(self, chave, corpo: bytes, geracao: int):
+        grupo = chave[0]
+        with self.lock:
+            entrada = EntradaCache(
+                corpo=corpo,
+                etag='"' + hashlib.blake2b(corpo, digest_size=16).hexdigest() + '"',
+                ultima_modificacao=self.modificado_em.setdefault(grupo, relogio.time()),
+                expira_em=relogio.monotonic() + self.ttl,
+            )
+            if self.geracoes.get(grupo, 0) != geracao:
+                # houve uma escrita enquanto se lia da base: não guardar
+                return entrada
+            self.entradas[chave] = entrada
+            self.entradas.move_to_end(chave)
+            while len(self.entradas) > self.capacidade:
+                self.entradas.popitem(last=False)
+            return entrada
+
+    def invalidar(self, grupo: str):
+        with self.lock:
+            self.modificado_em[grupo] = relogio.time()
+            self.geracoes[grupo] = self.geracoes.get(grupo, 0) + 1
+            for chave in [c for c in self.entradas if c[0] == grupo]:
+                del self.entradas[chave]
+
+    def estatisticas(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entradas": len(self.entradas),
+                "capacidade": self.capacidade,
+                "ttl": self.ttl,
+            }
+
+
+cache_referencia = CacheReferencia(CACHE_CAPACIDADE, CACHE_TTL)
+
+GRUPOS_CACHE = {Servico: "servicos", Medico: "medicos"}
+
+
+def grupo_cache(modelo):
+    # cada clínica tem os seus grupos: com o cabeçalho X-Clinica, o mesmo
+    # caminho serve dados de clínicas diferentes
+    return (clinica().nome, GRUPOS_CACHE[modelo])
+
+
+def invalidar_cache(modelo):
+    if modelo in GRUPOS_CACHE:
+        cache_referencia.invalidar(grupo_cache(modelo))
+
+
+def nao_modificado(request: Request, entrada: EntradaCache):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etags = [e.strip() for e in if_none_match.split(",")]
+        return entrada.etag in etags or "*" in etags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            desde = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(entrada.ultima_modificacao) <= desde
+    return False
+
+
+def guardar_em_cache(chave, geracao: int, conteudo):
+    if JSON_RAPIDO:
+        corpo = codificar_json(conteudo)
+    else:
+        corpo = json.dumps(jsonable_encoder(conteudo), ensure_ascii=False).encode()
+    return cache_referencia.guardar(chave, corpo, geracao)
+
+
+def resposta_em_cache(request: Request, modelo, carregar):
+    grupo = grupo_cache(modelo)
+    chave = (grupo, request.url.path, request.url.query)
+    entrada = cache_referencia.obter(chave)
+    if entrada is None:
+        # a geração é lida antes de carregar: uma escrita a meio deixa a entrada já velha
+        geracao = cache_referencia.geracao(grupo)
+        entrada = guardar_em_cache(chave, geracao, carregar())
+    return resposta_da_entrada(request, entrada)
+
+
+async def resposta_em_cache_async(request: Request, modelo, carregar):
+    """O mesmo que resposta_em_cache, para o router async: carregar é uma corrotina."""
+    grupo = grupo_cache(modelo)
+    chave = (grupo, request.url.path, request.url.query)
+    entrada = cache_referencia.obter(chave)
+    if entrada is None:
+        geracao = cache_referencia.geracao(grupo)
+        entrada = guardar_em_cache(chave, geracao, await carregar())
+    return resposta_da_entrada(request, entrada)
+
+
+def resposta_da_entrada(request: Request, entrada: EntradaCache):
+    cabecalhos = {
+        "ETag": entrada.etag,
+        "Last-Modified": formatdate(entrada.ultima_modificacao, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+    if nao_modificado(request, entrada):
+        return Response(status_code=304, headers=cabecalhos)
+    return Response(entrada.corpo, media_type="application/json", headers=cabecalhos)
+
+
+# Feed de alterações das marcações (SSE)
+# Os ecrãs da receção e dos médicos seguem as marcações por GET /marcacao/stream
+# em vez de repetirem GET /marcacao. Cada escrita numa marcação grava, na mesma
+# transação, uma linha em AlteracaoMarcacao; depois do commit avisa o feed, que
+# lê uma só vez as linhas novas e as distribui pelas filas de todas as ligações
+# abertas. Uma ligação que cai volta com o Last-Event-ID e recebe do registo o
+# que perdeu. O registo guarda FEED_DIAS dias.
+# O feed é por processo: com vários workers, as escritas de outro processo
+# chegam na leitura periódica, de FEED_PING em FEED_PING segundos.
+
+ALTERACAO_CRIADA = "criada"
+ALTERACAO_ALTERADA = "alterada"
+ALTERACAO_ELIMINADA = "eliminada"
+
+FEED_DIAS = int(os.environ.get("CLINICA_FEED_DIAS", 7))
+FEED_PING = float(os.environ.get("CLINICA_FEED_PING", 15))
+FEED_CAPACIDADE = 1000  # eventos por ligação à espera de serem enviados
+FEED_LOTE = 500
+
+
+def registar_alteracoes(ligacao, modelo, tipo: str, linhas: list, anterior: Optional[dict] = None):
+    """Grava no registo uma alteração por linha (só as marcações têm feed)."""
+    if modelo is not Marcacao or not linhas:
+        return
+    criado_em = datetime.now(timezone.utc)
+    valores = []
+    for linha in linhas:
+        valor = {
+            "tipo": tipo,
+            "marcacao_id": linha["id"],
+            "medico_id": linha["medico_id"],
+            "data_marcacao": linha["data_marcacao"],
+            "medico_anterior_id": None,
+            "data_anterior": None,
+            "dados": codificar_json(linha).decode(),
+            "criado_em": criado_em,
+        }
+        if anterior is not None:
+            if anterior["medico_id"] != linha["medico_id"]:
+                valor["medico_anterior_id"] = anterior["medico_id"]
+            if anterior["data_marcacao"] != linha["data_marcacao"]:
+                valor["data_anterior"] = anterior["data_marcacao"]
+        valores.append(valor)
+    ligacao.execute(insert(AlteracaoMarcacao.__table__), valores)
+
+
+def publicar_alteracoes(modelo):
+    if modelo is Marcacao:
+        clinica().feed_marcacoes.avisar()
+
+
+def ler_alteracoes(desde: int, medico_id: Optional[uuid.UUID] = None, dia: Optional[date] = None, limite: Optional[int] = None):
+    tabela = AlteracaoMarcacao.__table__
+    consulta = select(tabela).where(tabela.c.id > desde).order_by(tabela.c.id).limit(limite)
+    if medico_id is not None:
+        consulta = consulta.where(or_(tabela.c.medico_id == medico_id, tabela.c.medico_anterior_id == medico_id))
+    if dia is not None:
+        consulta = consulta.where(or_(tabela.c.data_marcacao == dia, tabela.c.data_anterior == dia))
+    with clinica().engine_leitura.connect() as ligacao:
+        return ligacao.execute(consulta).all()
+
+
+def ultima_alteracao():
+    with clinica().engine_leitura.connect() as ligacao:
+        return ligacao.execute(select(func.max(AlteracaoMarcacao.id))).scalar() or 0
+
+
+def alteracoes_perdidas(desde: int):
+    # os ids são seguidos: se o mais antigo que resta vem depois de desde + 1,
+    # as alterações pelo meio já foram apagadas
+    with clinica().engine_leitura.connect() as ligacao:
+        primeira = ligacao.execute(select(func.min(AlteracaoMarcacao.id))).scalar()
+    return primeira is not None and primeira > desde + 1
+
+
+def limpar_alteracoes(ligacao, dias: int = FEED_DIAS):
+    tabela = AlteracaoMarcacao.__table__
+    # fica sempre a última linha, para se saber até onde o registo chegou
+    ultima = select(func.max(tabela.c.id)).scalar_subquery()
+    return ligacao.execute(
+        delete(tabela).where(
+            tabela.c.criado_em < datetime.now(timezone.utc) - timedelta(days=dias),
+            tabela.c.id < ultima,
+        )
+    )
+
+
+def alteracao_corresponde(alteracao, medico_id: Optional[uuid.UUID], dia: Optional[date]):
+    if medico_id is not None and medico_id not in (alteracao.medico_id, alteracao.medico_anterior_id):
+        return False
+    return dia is None or dia in (alteracao.data_marcacao, alteracao.data_anterior)
+
+
+def evento_sse(alteracao):
+    return f"id: {alteracao.id}\nevent: {alteracao.tipo}\ndata: {alteracao.dados}\n\n"
+
+
+class FeedAlteracoes:
+    def __init__(self, ler, ultima):
+        self.ler = ler
+        self.ultima = ultima
+        self.filas = set()
+        self.loop = None
+        self.acordar = None
+        self.tarefa = None
+        self.ultimo_id = 0
+
+    def subscrever(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # um event loop novo (por exemplo, depois de reiniciar a aplicação)
+            self.loop = loop
+            self.acordar = asyncio.Event()
+            self.filas = set()
+            self.tarefa = None
+        fila = asyncio.Queue(FEED_CAPACIDADE)
+        self.filas.add(fila)
+        if self.tarefa is None or self.tarefa.done():
+            self.tarefa = loop.create_task(self.distribuir())
+        return fila
+
+    def cancelar(self, fila):
+        self.filas.discard(fila)
+
+    def avisar(self):
+        # chamado depois de um commit, de qualquer thread
+        loop, acordar, tarefa = self.loop, self.acordar, self.tarefa
+        if tarefa is None or tarefa.done():
+            return
+        try:
+            loop.call_soon_threadsafe(acordar.set)
+        except RuntimeError:  # loop já fechado
+            pass
+
+    async def distribuir(self):
+        self.ultimo_id = await run_in_threadpool(self.ultima)
+        while self.filas:
+            try:
+                await asyncio.wait_for(self.acordar.wait(), FEED_PING)
+            except TimeoutError:
+                pass
+            self.acordar.clear()
+            novas = await run_in_threadpool(self.ler, self.ultimo_id)
+            if not novas:
+                continue
+            self.ultimo_id = novas[-1].id
+            for fila in list(self.filas):
+                try:
+                    for alteracao in novas:
+                        fila.put_nowait(alteracao)
+                except asyncio.QueueFull:
+                    # ligação lenta: fecha-se; o cliente volta com o Last-Event-ID
+                    self.filas.discard(fila)
+                    while not fila.empty():
+                        fila.get_nowait()
+                    fila.put_nowait(None)
+
+
+
+# Idempotência (cabeçalho Idempotency-Key)
+# Com Wi-Fi instável o cliente repete POST /pagamentos e POST /marcacao sem
+# saber se o primeiro chegou. Com Idempotency-Key, a chave e a resposta são
+# gravadas na mesma transação que o registo criado. Uma repetição encontra-a
+# com uma leitura pela chave primária e recebe a mesma resposta, sem tocar nas
+# tabelas de negócio. Dois pedidos iguais em simultâneo colidem na chave
+# primária: o segundo desfaz a sua transação e devolve a resposta do primeiro.
+# As chaves expiram ao fim de IDEMPOTENCIA_HORAS horas.
+
+IDEMPOTENCIA_HORAS = int(os.environ.get("CLINICA_IDEMPOTENCIA_HORAS", 24))
+
+ChaveIdempotencia = Annotated[Optional[str], Header(min_length=1, max_length=255)]
+
+ROTAS_IDEMPOTENTES = {Pagamento: "pagamentos", Marcacao: "marcacao"}
+
+
+def validade_idempotencia():
+    return datetime.now(timezone.utc) - timedelta(hours=IDEMPOTENCIA_HORAS)
+
+
+def resumo_pedido(modelo, obj):
+    dados = {campo: getattr(obj, campo) for campo in campos_editaveis(modelo)}
+    return hashlib.blake2b(codificar_json(dados), digest_size=16).digest()
+
+
+def resposta_guardada(session: Session, rota: str, chave: str, resumo: bytes):
+    tabela = PedidoIdempotente.__table__
+    linha = session.execute(
+        select(tabela.c.resumo_pedido, tabela.c.resposta).where(
+            tabela.c.rota == rota,
+            tabela.c.chave == chave,
+            tabela.c.criado_em >= validade_idempotencia(),
+        )
+    ).first()
+    if linha is None:
+        return None
+    if linha.resumo_pedido != resumo:
+        raise HTTPException(status_code=422, detail="Idempotency-Key já usada com outro pedido")
+    return Response(linha.resposta, media_type="application/json", headers={"Idempotent-Replayed": "true"})
+
+
+def reservar_pedido(session: Session, modelo, chave: str, obj):
+    """None se o pedido é novo (a chave fica gravada na transação); senão a resposta a devolver."""
+    rota = ROTAS_IDEMPOTENTES[modelo]
+    resumo = resumo_pedido(modelo, obj)
+    repetida = resposta_guardada(session, rota, chave, resumo)
+    if repetida is not None:
+        return repetida
+
+    tabela = PedidoIdempotente.__table__
+    instrucao = sqlite_insert(tabela).values(
+        rota=rota,
+        chave=chave,
+        resumo_pedido=resumo,
+        # o registo já tem id e valores iniciais, por isso a resposta é conhecida
+        resposta=codificar_json(campos_linha(obj)),
+        criado_em=datetime.now(timezone.utc),
+    )
+    # uma chave expirada é reaproveitada; uma válida gravada entretanto por
+    # outro pedido não devolve linha
+    instrucao = instrucao.on_conflict_do_update(
+        index_elements=["rota", "chave"],
+        set_={c: instrucao.excluded[c] for c in ("resumo_pedido", "resposta", "criado_em")},
+        where=tabela.c.criado_em < validade_idempotencia(),
+    ).returning(tabela.c.chave)
+    if session.execute(instrucao).first() is not None:
+        return None
+
+    session.rollback()
+    repetida = resposta_guardada(session, rota, chave, resumo)
+    if repetida is None:
+        raise HTTPException(status_code=409, detail="Pedido com esta Idempotency-Key ainda em curso")
+    return repetida
+
+
+def limpar_pedidos_idempotentes(ligacao):
+    tabela = PedidoIdempotente.__table__
+    return ligacao.execute(delete(tabela).where(tabela.c.criado_em < validade_idempotencia()))
+
+
+# Senhas e sessões
+# As senhas são guardadas com scrypt (hashlib), que gasta dezenas de ms de CPU
+# e 16 MiB de memória por cálculo. O cálculo corre num pool de threads limitado
+# (o scrypt do OpenSSL liberta o GIL), fora do event loop e das threads dos
+# pedidos. Se os trabalhadores e a fila do pool estiverem ocupados, o pedido
+# recebe logo 503 com Retry-After em vez de ficar à espera; isto protege a
+# troca de turno da manhã, quando todos entram ao mesmo tempo.
+# O login devolve um token opaco. Na base fica só o sha256 do token, e cada
+# sessão lida fica numa cache por processo: um pedido autenticado nunca volta a
+# calcular o scrypt e quase nunca lê a base. Com vários workers, o TTL da cache
+# limita o tempo em que um worker aceita um token já revogado noutro.
+# Valores de senha_has fora do formato scrypt são de antes desta versão
+# (guardados tal como vieram) e o primeiro login bem-sucedido converte-os.
+
+SCRYPT_N = int(os.environ.get("CLINICA_SCRYPT_N", 2**14))
+SCRYPT_R = 8
+SCRYPT_P = 1
+HASH_SENHA_RE = re.compile(r"scrypt\$\d+\$\d+\$\d+\$[0-9a-f]{32}\$[0-9a-f]{64}")
+
+SENHAS_TRABALHADORES = int(os.environ.get("CLINICA_SENHAS_TRABALHADORES", os.cpu_count() or 2))
+# cálculos à espera, além dos que estão a correr, antes de responder 503
+SENHAS_FILA = int(os.environ.get("CLINICA_SENHAS_FILA", 4 * SENHAS_TRABALHADORES))
+SESSAO_HORAS = float(os.environ.get("CLINICA_SESSAO_HORAS", 12))
+SESSOES_CACHE_TTL = 60
+SESSOES_CACHE_CAPACIDADE = 10_000
+
+pool_senhas = ThreadPoolExecutor(max_workers=SENHAS_TRABALHADORES, thread_name_prefix="senhas")
+vagas_senhas = threading.BoundedSemaphore(SENHAS_TRABALHADORES + SENHAS_FILA)
+
+
+def scrypt(senha: str, sal: bytes, n: int, r: int, p: int):
+    return hashlib.scrypt(senha.encode(), salt=sal, n=n, r=r, p=p, maxmem=2 * 128 * n * r * p, dklen=32)
+
+
+def gerar_hash_senha(senha: str, sal: Optional[bytes] = None):
+    sal = sal or os.urandom(16)
+    chave = scrypt(senha, sal, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${sal.hex()}${chave.hex()}"
+
+
+def e_hash_senha(valor: str):
+    return HASH_SENHA_RE.fullmatch(valor) is not None
+
+
+def verificar_hash_senha(senha: str, guardada: str):
+    if not e_hash_senha(guardada):
+        return hmac.compare_digest(senha.encode(), guardada.encode())
+    _, n, r, p, sal, chave = guardada.split("$")
+    return hmac.compare_digest(scrypt(senha, bytes.fromhex(sal), int(n), int(r), int(p)), bytes.fromhex(chave))
+
+
+def hash_desatualizado(guardada: str):
+    # valores antigos fora do formato scrypt ou com outros n, r e p (mais
+    # fracos ou não) são refeitos no login
+    if not e_hash_senha(guardada):
+        return True
+    _, n, r, p, _, _ = guardada.split("$")
+    return (int(n), int(r), int(p)) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+@cache
+def hash_ficticio():
+    # um username desconhecido também paga um scrypt, para o tempo de resposta
+    # não revelar quais existem
+    return gerar_hash_senha("")
+
+
+def submeter_calculo(funcao, *args):
+    if not vagas_senhas.acquire(blocking=False):
+        raise HTTPException(
+            status_code=503,
+            detail="Servidor ocupado a verificar senhas, tente novamente",
+            headers={"Retry-After": "1"},
+        )
+    futuro = pool_senhas.submit(funcao, *args)
+    futuro.add_done_callback(lambda _: vagas_senhas.release())
+    return futuro
+
+
+async def hash_para_guardar(senha: str):
+    # o que vem do cliente é sempre a senha, mesmo que pareça um hash: só o
+    # import em massa aceita hashes, e só com os parâmetros atuais
+    return await asyncio.wrap_future(submeter_calculo(gerar_hash_senha, senha))
+
+
+def hash_token(token: str):
+    return hashlib.sha256(token.encode()).digest()
+
+
+class SessaoAtiva(BaseModel):
+    usuario_id: uuid.UUID
+    username: str
+    tipo_usuario: TipoUsuario
+    expira_em: datetime
+
+
+class CacheSessoes:
+    def __init__(self, capacidade: int, ttl: float):
+        self.capacidade = capacidade
+        self.ttl = ttl
+        self.entradas = OrderedDict()
+        self.lock = threading.Lock()
+
+    def obter(self, chave: bytes):
+        with self.lock:
+            entrada = self.entradas.get(chave)
+            if entrada is None:
+                return None
+            sessao, guardada_em = entrada
+            if guardada_em + self.ttl < relogio.monotonic():
+                del self.entradas[chave]
+                return None
+            self.entradas.move_to_end(chave)
+            return sessao
+
+    def guardar(self, chave: bytes, sessao: SessaoAtiva):
+        with self.lock:
+            self.entradas[chave] = (sessao, relogio.monotonic())
+            self.entradas.move_to_end(chave)
+            while len(self.entradas) > self.capacidade:
+                self.entradas.popitem(last=False)
+
+    def remover(self, chave: bytes):
+        with self.lock:
+            self.entradas.pop(chave, None)
+
+    def remover_usuario(self, usuario_id: uuid.UUID):
+        with self.lock:
+            for chave in [c for c, (s, _) in self.entradas.items() if s.usuario_id == usuario_id]:
+                del self.entradas[chave]
+
+
+cache_sessoes = CacheSessoes(SESSOES_CACHE_CAPACIDADE, SESSOES_CACHE_TTL)
+
+
+def ler_sessao(chave: bytes):
+    # o join deixa de aceitar o token logo que a conta é eliminada
+    consulta = (
+        select(SessaoUsuario.usuario_id, Usuario.username, Usuario.tipo_usuario, SessaoUsuario.expira_em)
+        .join(Usuario, Usuario.id == SessaoUsuario.usuario_id)
+        .where(SessaoUsuario.token_hash == chave)
+    )
+    with Session(clinica().engine_leitura) as session:
+        linha = session.exec(consulta).first()
+    if linha is None:
+        return None
+    return SessaoAtiva(
+        usuario_id=linha.usuario_id,
+        username=linha.username,
+        tipo_usuario=linha.tipo_usuario,
+        expira_em=linha.expira_em.replace(tzinfo=timezone.utc),
+    )
+
+
+def revogar_sessoes(ligacao, usuario_id: uuid.UUID):
+    ligacao.execute(delete(SessaoUsuario).where(SessaoUsuario.usuario_id == usuario_id))
+    cache_sessoes.remover_usuario(usuario_id)
+
+
+def limpar_sessoes(ligacao):
+    return ligacao.execute(delete(SessaoUsuario).where(SessaoUsuario.expira_em < datetime.now(timezone.utc)))
+
+
+async def sessao_atual(authorization: Annotated[Optional[str], Header()] = None):
+    esquema, _, token = (authorization or "").partition(" ")
+    if esquema.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Token em falta", headers={"WWW-Authenticate": "Bearer"})
+    chave = hash_token(token.strip())
+    # a cache é partilhada pelas clínicas: o mesmo token numa clínica errada não passa
+    chave_cache = (clinica().nome, chave)
+    sessao = cache_sessoes.obter(chave_cache)
+    if sessao is None:
+        sessao = await run_in_threadpool(ler_sessao, chave)
+        if sessao is not None:
+            cache_sessoes.guardar(chave_cache, sessao)
+    if sessao is None or sessao.expira_em <= datetime.now(timezone.utc):
+        raise HTTPException(status_code=401, detail="Sessão inválida ou expirada", headers={"WWW-Authenticate": "Bearer"})
+    return sessao
+
+
+UsuarioAutenticado = Annotated[SessaoAtiva, Depends(sessao_atual)]
+
+
+# Cópias de segurança
+# Copiar database.db com a API a escrever pode dar um ficheiro inconsistente, e
+# um VACUUM INTO numa clínica com muito histórico prende o ficheiro enquanto
+# dura. criar_copia() usa a API de backup do SQLite numa ligação própria, fora
+# dos pools, que mantém aberta uma transação de leitura sobre o ficheiro
+# principal e o arquivo: com WAL os pedidos continuam a escrever e a cópia é a
+# fotografia do instante em que começou. Sem essa transação, cada escrita de
+# outra ligação obrigaria a cópia a recomeçar do início, e numa clínica
+# ocupada nunca terminaria. As páginas são copiadas COPIAS_PAGINAS de cada vez,
+# com COPIAS_PAUSA segundos entre passos; enquanto a cópia corre o checkpoint
+# não passa do início da cópia e o WAL cresce com as escritas desse período.
+# Cada cópia é uma pasta copia-<AAAAMMDDTHHMMSS.mmmZ> em clinica().copias_dir
+# com os dois ficheiros (em modo de journal normal, sem -wal) e um
+# manifesto.json com as versões do esquema, o PRAGMA integrity_check e as
+# linhas de cada tabela, contadas na própria cópia. A pasta só recebe esse nome
+# depois de verificada, e ficam as COPIAS_MANTER mais recentes.
+# restaurar_copia() volta a verificar a cópia (integridade e contagens contra o
+# manifesto), faz uma cópia da base atual e só então grava a cópia por cima,
+# cada ficheiro num só passo. Corre com a API parada: "python gerir.py restaurar <cópia>".
+
+COPIAS_DIR = os.environ.get("CLINICA_COPIAS", f"{os.path.splitext(db_file)[0]}-copias")
+COPIAS_PAGINAS = int(os.environ.get("CLINICA_COPIAS_PAGINAS", 1024))
+COPIAS_PAUSA = float(os.environ.get("CLINICA_COPIAS_PAUSA", 0.02))  # segundos entre passos
+COPIAS_MANTER = int(os.environ.get("CLINICA_COPIAS_MANTER", 7))
+NOME_COPIA_RE = re.compile(r"copia-\d{8}T\d{6}\.\d{3}Z")
+# esquema da ligação -> nome do ficheiro dentro da pasta da cópia
+FICHEIROS_COPIA = {"main": "database.db", "arquivo": "database-arquivo.db"}
+MANIFESTO_COPIA = "manifesto.json"
+
+log_copias = logging.getLogger("clinica.copias")
+
+
+class CopiaInvalida(RuntimeError):
+    pass
+
+
+def uri_so_leitura(caminho: str):
+    return f"file:{pathname2url(os.path.abspath(caminho))}?mode=ro"
+
+
+def abrir_so_leitura(principal: str, arquivo: str):
+    ligacao = sqlite3.connect(uri_so_leitura(principal), uri=True, check_same_thread=False)
+    ligacao.execute("ATTACH DATABASE ? AS arquivo", (uri_so_leitura(arquivo),))
+    return ligacao
+
+
+def pasta_copia(nome: str):
+    if not NOME_COPIA_RE.fullmatch(nome) or not os.path.isdir(os.path.join(clinica().copias_dir, nome)):
+        raise LookupError(f"Cópia não encontrada: {nome}")
+    return os.path.join(clinica().copias_dir, nome)
+
+
+def examinar_ficheiros(ligacao):
+    """(integridade, versões do esquema, {esquema: {tabela: linhas}}) dos dois ficheiros de uma ligação."""
+    problemas = [
+        linha[0]
+        for esquema in FICHEIROS_COPIA
+        for linha in ligacao.execute(f"PRAGMA {esquema}.integrity_check")
+        if linha[0] != "ok"
+    ]
+    versoes = {esquema: ligacao.execute(f"PRAGMA {esquema}.user_version").fetchone()[0] for esquema in FICHEIROS_COPIA}
+    contagens = {}
+    for esquema in FICHEIROS_COPIA:
+        # todas as tabelas reais, incluindo as internas do FTS5: uma cópia de
+        # uma versão anterior do esquema pode não ter as mesmas
+        tabelas = [
+            linha[0]
+            for linha in ligacao.execute(
+                f"SELECT name FROM {esquema}.sqlite_master WHERE type = 'table' "
+                "AND name NOT LIKE 'sqlite_%' AND sql NOT LIKE 'CREATE VIRTUAL TABLE%' ORDER BY name"
+            )
+        ]
+        contagens[esquema] = {
+            tabela: ligacao.execute(f'SELECT count(*) FROM {esquema}."{tabela}"').fetchone()[0] for tabela in tabelas
+        }
+    return "; ".join(problemas) or "ok", versoes, contagens
+
+
+def copiar_paginas(origem, esquema: str, destino: str, aviso=None):
+    """Copia um esquema de `origem` para o ficheiro `destino`, por passos; devolve o número de páginas."""
+    copiadas = 0
+    inicio = relogio.perf_counter()
+
+    def passo(_estado, restantes, total):
+        nonlocal copiadas, inicio
+        if aviso:
+            aviso(total - restantes - copiadas, (relogio.perf_counter() - inicio) * 1000)
+        copiadas = total - restantes
+        if restantes:
+            relogio.sleep(COPIAS_PAUSA)
+        inicio = relogio.perf_counter()
+
+    with closing(sqlite3.connect(destino)) as alvo:
+        origem.backup(alvo, pages=COPIAS_PAGINAS, progress=passo, name=esquema)
+        # a cópia fica num ficheiro só, sem -wal nem -shm
+        alvo.execute("PRAGMA journal_mode=DELETE")
+    return copiadas
+
+
+def ler_manifesto(nome: str):
+    with open(os.path.join(pasta_copia(nome), MANIFESTO_COPIA), encoding="utf-8") as ficheiro:
+        return json.load(ficheiro)
+
+
+def listar_copias():
+    """Manifestos das cópias da clínica atual, da mais recente para a mais antiga."""
+    pasta = clinica().copias_dir
+    if not os.path.isdir(pasta):
+        return []
+    return [ler_manifesto(nome) for nome in sorted(filter(NOME_COPIA_RE.fullmatch, os.listdir(pasta)), reverse=True)]
+
+
+def rodar_copias():
+    """Apaga as cópias para lá das COPIAS_MANTER mais recentes e devolve os nomes apagados."""
+    antigas = [manifesto["nome"] for manifesto in listar_copias()[COPIAS_MANTER:]]
+    for nome in antigas:
+        shutil.rmtree(pasta_copia(nome))
+    return antigas
+
+
+def criar_copia(aviso=None, rodar: bool = True):
+    """Faz uma cópia online da clínica atual e devolve o seu manifesto.
+
+    aviso(paginas, ms) é chamado depois de cada passo; pode interromper a cópia levantando uma exceção.
+    """
+    atual = clinica()
+    criada_em = datetime.now(timezone.utc)
+    nome = f"copia-{criada_em:%Y%m%dT%H%M%S}.{criada_em.microsecond // 1000:03d}Z"
+    pasta = os.path.join(atual.copias_dir, nome)
+    if os.path.exists(pasta):
+        raise CopiaInvalida(f"A cópia {nome} já existe")
+    temporaria = pasta + ".tmp"
+    shutil.rmtree(temporaria, ignore_errors=True)
+    os.makedirs(temporaria)
+    inicio = relogio.perf_counter()
+    try:
+        with closing(abrir_so_leitura(atual.db_file, atual.arquivo_file)) as origem:
+            # a transação de leitura fixa a fotografia dos dois ficheiros até ao fim da cópia
+            origem.execute("BEGIN")
+            for esquema in FICHEIROS_COPIA:
+                origem.execute(f"SELECT count(*) FROM {esquema}.sqlite_master").fetchone()
+            paginas = {
+                esquema: copiar_paginas(origem, esquema, os.path.join(temporaria, ficheiro), aviso)
+                for esquema, ficheiro in FICHEIROS_COPIA.items()
+            }
+            origem.rollback()
+        with closing(abrir_so_leitura(*(os.path.join(temporaria, f) for f in FICHEIROS_COPIA.values()))) as copia:
+            integridade, versoes, contagens = examinar_ficheiros(copia)
+        if integridade != "ok":
+            raise CopiaInvalida(f"A cópia {nome} falhou a verificação de integridade: {integridade}")
+        manifesto = {
+            "nome": nome,
+            "clinica": atual.nome,
+            "criada_em": criada_em.isoformat(),
+            "duracao_ms": round((relogio.perf_counter() - inicio) * 1000),
+            "paginas": paginas,
+            "bytes": sum(os.path.getsize(os.path.join(temporaria, f)) for f in FICHEIROS_COPIA.values()),
+            "versao_esquema": versoes,
+            "integridade": integridade,
+            "contagens": contagens,
+        }
+        with open(os.path.join(temporaria, MANIFESTO_COPIA), "w", encoding="utf-8") as ficheiro:
+            json.dump(manifesto, ficheiro, ensure_ascii=False, indent=2)
+        os.rename(temporaria, pasta)
+    except BaseException:
+        shutil.rmtree(temporaria, ignore_errors=True)
+        raise
+    log_copias.info("Cópia %s: %d páginas em %.1f s", nome, sum(paginas.values()), manifesto["duracao_ms"] / 1000)
+    if rodar:
+        manifesto["removidas"] = rodar_copias()
+    return manifesto
+
+
+def verificar_copia(nome: str):
+    """Repete o integrity_check e as contagens de uma cópia e compara-as com o manifesto."""
+    manifesto = ler_manifesto(nome)
+    pasta = pasta_copia(nome)
+    with closing(abrir_so_leitura(*(os.path.join(pasta, f) for f in FICHEIROS_COPIA.values()))) as copia:
+        integridade, versoes, contagens = examinar_ficheiros(copia)
+    diferencas = {
+        f"{esquema}.{tabela}": {"manifesto": manifesto["contagens"][esquema].get(tabela), "copia": linhas.get(tabela)}
+        for esquema, linhas in contagens.items()
+        for tabela in manifesto["contagens"][esquema].keys() | linhas.keys()
+        if manifesto["contagens"][esquema].get(tabela) != linhas.get(tabela)
+    }
+    return {
+        "nome": nome,
+        "integridade": integridade,
+        "versao_esquema": versoes,
+        "diferencas": diferencas,
+        "valida": integridade == "ok" and not diferencas and versoes == manifesto["versao_esquema"],
+    }
+
+
+def restaurar_copia(nome: str, aviso=None):
+    """Verifica a cópia `nome` e grava-a por cima da base da clínica atual; devolve o manifesto da cópia de antes."""
+    verificacao = verificar_copia(nome)
+    if not verificacao["valida"]:
+        diferencas = ", ".join(
+            f"{tabela} ({linhas['manifesto']} no manifesto, {linhas['copia']} na cópia)"
+            for tabela, linhas in verificacao["diferencas"].items()
+        )
+        raise CopiaInvalida(
+            f"A cópia {nome} não passou a verificação: integridade {verificacao['integridade']}"
+            + (f"; contagens diferentes em {diferencas}" if diferencas else "")
+        )
+    for esquema, versao in verificacao["versao_esquema"].items():
+        if versao > len(MIGRACOES[esquema]):
+            raise EsquemaDesatualizado(f"A cópia {nome} tem o esquema {esquema} na versão {versao}, mais recente que este código")
+    atual = clinica()
+    anterior = criar_copia(aviso, rodar=False)
+    pasta = pasta_copia(nome)
+    for esquema, destino in (("main", atual.db_file), ("arquivo", atual.arquivo_file)):
+        with closing(sqlite3.connect(uri_so_leitura(os.path.join(pasta, FICHEIROS_COPIA[esquema])), uri=True)) as copia:
+            with closing(sqlite3.connect(destino, timeout=30)) as alvo:
+                # num só passo: quem abrir o ficheiro vê a base antiga ou a restaurada, nunca as duas misturadas
+                copia.backup(alvo)
+    # uma cópia de uma versão anterior fica com o esquema atual
+    migrar()
+    log_copias.info("Cópia %s restaurada; a base anterior ficou em %s", nome, anterior["nome"])
+    return anterior
+
+
+# Tarefas agendadas
+# Fechar as marcações que já passaram e preparar os lembretes do dia seguinte
+# eram feitos à mão, com um PUT por marcação. Agora correm uma vez por noite,
+# dentro do próprio processo, a partir de TAREFAS_HORA (hora local):
+# "fechar-marcacoes" passa a concluida (se houver consulta) ou a faltou as
+# marcações de dias anteriores ainda por fechar, com um UPDATE por lote, e
+# "lembretes" escreve na pasta de saída (SAIDA_DIR) o CSV das marcações ativas do dia seguinte.
+# "copia" faz a cópia de segurança da noite (ver Cópias de segurança).
+# As escritas são feitas em lotes de TAREFAS_LOTE linhas, cada um na sua
+# transação curta e seguido de uma pausa, para que os pedidos à espera da
+# ligação de escrita passem à frente em vez de ficarem parados atrás da tarefa.
+# Cada execução tem uma linha em ExecucaoTarefa (uma por tarefa e dia) com o
+# estado, as contagens e os tempos, gravados no commit de cada lote. Com vários
+# workers só corre a execução quem a passa de pendente a em_curso; uma execução
+# sem progresso há TAREFAS_ABANDONO minutos (o processo morreu) pode voltar a
+# ser reclamada. Todas as tarefas podem ser repetidas sem efeitos duplicados.
+# Com CLINICA_TAREFAS=0 o agendador não arranca e as tarefas correm com
+# "python gerir.py tarefa <nome>" (por exemplo a partir do cron).
+# Arrancar a API não recupera a noite que já passou: o primeiro dia agendado é
+# o da próxima TAREFAS_HORA e a primeira passagem só acontece ao fim de
+# TAREFAS_INTERVALO ou quando a API pede uma execução, para que um servidor de
+# desenvolvimento ou um TestClient não ponha a correr tarefas nem uma cópia.
+# Com CLINICA_TAREFAS_ATRASADAS=1 (um só processo que substitui o cron, por
+# exemplo) a execução em falta é agendada e corre logo no arranque.
+
+TAREFAS_ATIVAS = os.environ.get("CLINICA_TAREFAS", "1") == "1"
+TAREFAS_ATRASADAS = os.environ.get("CLINICA_TAREFAS_ATRASADAS", "0") == "1"
+TAREFAS_HORA = time.fromisoformat(os.environ.get("CLINICA_TAREFAS_HORA", "02:00"))
+TAREFAS_LOTE = int(os.environ.get("CLINICA_TAREFAS_LOTE", 500))
+TAREFAS_PAUSA = float(os.environ.get("CLINICA_TAREFAS_PAUSA", 0.05))  # segundos entre lotes
+TAREFAS_INTERVALO = 60  # segundos entre procuras de execuções pendentes
+TAREFAS_ABANDONO = 10  # minutos
+# pasta dos ficheiros produzidos pelas tarefas (lembretes) da clínica única
+SAIDA_DIR = os.environ.get("CLINICA_SAIDA", f"{os.path.splitext(db_file)[0]}-saida")
+
+EXECUCAO_PENDENTE = "pendente"
+EXECUCAO_EM_CURSO = "em_curso"
+EXECUCAO_CONCLUIDA = "concluida"
+EXECUCAO_FALHOU = "falhou"
+
+log_tarefas = logging.getLogger("clinica.tarefas")
+
+
+class TarefaInterrompida(Exception):
+    pass
+
+
+class ProgressoTarefa:
+    """Contagens de uma execução, gravadas na sua linha de ExecucaoTarefa."""
+
+    def __init__(self, execucao_id: int, dia: date, parar: threading.Event, aviso=None):
+        self.execucao_id = execucao_id
+        self.dia = dia
+        self.parar = parar
+        self.aviso = aviso
+        self.processados = 0
+        self.lotes = 0
+        self.lote_max_ms = 0.0
+        self.resultado = {}
+
+    def contar(self, **contagem):
+        for chave, n in contagem.items():
+            self.resultado[chave] = self.resultado.get(chave, 0) + n
+            self.processados += n
+
+    def gravar(self, ligacao, **valores):
+        ligacao.execute(
+            update(ExecucaoTarefa)
+            .where(ExecucaoTarefa.id == self.execucao_id)
+            .values(
+                processados=self.processados,
+                lotes=self.lotes,
+                lote_max_ms=self.lote_max_ms,
+                resultado=json.dumps(self.resultado, ensure_ascii=False),
+                atualizado_em=datetime.now(timezone.utc),
+                **valores,
+            )
+        )
+
+    def avancar(self):
+        # entre lotes: é aqui que um pedido de paragem interrompe a tarefa
+        if self.parar.is_set():
+            raise TarefaInterrompida()
+        if self.aviso:
+            self.aviso(self)
+
+    @contextmanager
+    def lote(self):
+        """Uma transação de escrita; as contagens são gravadas no mesmo commit."""
+        self.avancar()
+        inicio = relogio.perf_counter()
+        with clinica().engine.begin() as ligacao:
+            yield ligacao
+            self.lotes += 1
+            self.lote_max_ms = max(self.lote_max_ms, (relogio.perf_counter() - inicio) * 1000)
+            self.gravar(ligacao)
+        relogio.sleep(TAREFAS_PAUSA)
+
+
+def fechar_marcacoes(progresso: ProgressoTarefa):
+    """Passa a concluida ou faltou as marcações pendentes de dias anteriores a progresso.dia."""
+    tabela = Marcacao.__table__
+    # lidas pelo índice (estado_marcacao, id), a continuar no id do lote anterior
+    pendentes = (
+        select(tabela.c.id)
+        .where(tabela.c.estado_marcacao.in_(ESTADOS_MARCACAO_PENDENTES), tabela.c.data_marcacao < progresso.dia)
+        .order_by(tabela.c.id)
+        .limit(TAREFAS_LOTE)
+    )
+    com_consulta = select(Consulta.id).where(Consulta.marcacao_id == tabela.c.id).exists()
+    ultimo = None
+    while True:
+        with clinica().engine_leitura.connect() as leitura:
+            consulta = pendentes if ultimo is None else pendentes.where(tabela.c.id > ultimo)
+            ids = leitura.execute(consulta).scalars().all()
+        if not ids:
+            break
+        ultimo = ids[-1]
+        with progresso.lote() as ligacao:
+            # o estado volta a ser verificado: um PUT entretanto ganha à tarefa
+            linhas = ligacao.execute(
+                update(tabela)
+                .where(tabela.c.id.in_(ids), tabela.c.estado_marcacao.in_(ESTADOS_MARCACAO_PENDENTES))
+                .values(
+                    estado_marcacao=case((com_consulta, ESTADO_MARCACAO_CONCLUIDA), else_=ESTADO_MARCACAO_FALTOU),
+                    versao=tabela.c.versao + 1,
+                )
+                .returning(*tabela.columns)
+            ).mappings().all()
+            linhas = [dict(linha) for linha in linhas]
+            registar_alteracoes(ligacao, Marcacao, ALTERACAO_ALTERADA, linhas)
+            progresso.contar(**Counter(linha["estado_marcacao"] for linha in linhas))
+        publicar_alteracoes(Marcacao)
+
+
+def exportar_lembretes(progresso: ProgressoTarefa):
+    """Escreve na pasta de saída da clínica o CSV das marcações ativas do dia seguinte a progresso.dia."""
+    dia = progresso.dia + timedelta(days=1)
+    consulta = (
+        select(
+            Marcacao.data_marcacao,
+            Marcacao.hora_marcacao,
+            Marcacao.id.label("marcacao_id"),
+            Paciente.nome.label("paciente"),
+            Paciente.telefone,
+            Paciente.email,
+            Medico.nome_medico.label("medico"),
+            Medico.especialidade,
+            Marcacao.estado_marcacao,
+        )
+        .join(Paciente, Paciente.id == Marcacao.paciente_id)
+        .join(Medico, Medico.id == Marcacao.medico_id)
+        .where(Marcacao.data_marcacao == dia, Marcacao.estado_marcacao != ESTADO_MARCACAO_CANCELADA)
+        .order_by(Marcacao.hora_marcacao, Marcacao.id)
+    )
+    saida = clinica().saida_dir
+    os.makedirs(saida, exist_ok=True)
+    caminho = os.path.join(saida, f"lembretes-{dia.isoformat()}.csv")
+    # escrito ao lado e renomeado no fim: quem lê a pasta nunca vê um ficheiro a meio
+    temporario = caminho + ".tmp"
+    with Session(clinica().engine_leitura) as session, open(temporario, "w", newline="", encoding="utf-8") as ficheiro:
+        escritor = csv.writer(ficheiro)
+        resultado = session.execute(consulta.execution_options(yield_per=TAREFAS_LOTE))
+        escritor.writerow(resultado.keys())
+        progresso.contar(lembretes=0)
+        for lote in resultado.partitions():
+            escritor.writerows([valor_exportacao(v) for v in linha] for linha in lote)
+            progresso.lotes += 1
+            progresso.contar(lembretes=len(lote))
+            progresso.avancar()
+    os.replace(temporario, caminho)
+    progresso.resultado["ficheiro"] = caminho
+
+
+def limpar_registos(progresso: ProgressoTarefa):
+    """Apaga o registo antigo do feed, as chaves de idempotência e as sessões expiradas."""
+    with progresso.lote() as ligacao:
+        progresso.contar(
+            alteracoes=limpar_alteracoes(ligacao).rowcount,
+            pedidos_idempotentes=limpar_pedidos_idempotentes(ligacao).rowcount,
+            sessoes=limpar_sessoes(ligacao).rowcount,
+        )
+
+
+def copiar_base(progresso: ProgressoTarefa):
+    """Faz a cópia de segurança da clínica (ver Cópias de segurança) e apaga as mais antigas."""
+    gravado_em = relogio.monotonic()
+
+    def passo(paginas, ms):
+        nonlocal gravado_em
+        progresso.lotes += 1
+        progresso.lote_max_ms = max(progresso.lote_max_ms, ms)
+        progresso.contar(paginas=paginas)
+        progresso.avancar()
+        # a cópia não escreve na base: sem isto, uma cópia longa pareceria abandonada
+        if relogio.monotonic() - gravado_em > TAREFAS_INTERVALO:
+            with clinica().engine.begin() as ligacao:
+                progresso.gravar(ligacao)
+            gravado_em = relogio.monotonic()
+
+    manifesto = criar_copia(passo)
+    progresso.resultado["copia"] = manifesto["nome"]
+    progresso.resultado["removidas"] = manifesto["removidas"]
+
+
+# pela ordem em que correm: os lembretes saem depois de fechado o dia anterior
+# e a cópia é feita no fim, já com tudo fechado e limpo
+TAREFAS = {
+    "fechar-marcacoes": fechar_marcacoes,
+    "lembretes": exportar_lembretes,
+    "limpeza": limpar_registos,
+    "copia": copiar_base,
+}
+
+
+def dia_das_tarefas(agora: datetime):
+    # antes da hora, a execução que pode estar em falta é a da noite anterior
+    return agora.date() if agora.time() >= TAREFAS_HORA else agora.date() - timedelta(days=1)
+
+
+def agendar_execucao(ligacao, tarefa: str, dia: date, repetir: bool = False):
+    """Cria a execução pendente de `tarefa` em `dia` e devolve o id, ou None se já existia.
+
+    Com repetir, uma execução já terminada volta a pendente; uma em curso fica como está.
+    """
+    tabela = ExecucaoTarefa.__table__
+    instrucao = sqlite_insert(tabela).values(
+        tarefa=tarefa, dia=dia, estado=EXECUCAO_PENDENTE, processados=0, lotes=0,
+        lote_max_ms=0, resultado="{}", criado_em=datetime.now(timezone.utc),
+    )
+    if repetir:
+        instrucao = instrucao.on_conflict_do_update(
+            index_elements=["tarefa", "dia"],
+            set_={"estado": EXECUCAO_PENDENTE, "erro": None, "terminado_em": None},
+            where=tabela.c.estado != EXECUCAO_EM_CURSO,
+        )
+    else:
+        instrucao = instrucao.on_conflict_do_nothing()
+    return ligacao.execute(instrucao.returning(tabela.c.id)).scalar()
+
+
+def reclamar_execucao(ligacao, execucao_id: Optional[int] = None):
+    """Passa a em_curso a execução pendente mais antiga (ou `execucao_id`) e devolve-a.
+
+    Devolve None se não houver nenhuma ou se outro processo a levou primeiro.
+    """
+    tabela = ExecucaoTarefa.__table__
+    agora = datetime.now(timezone.utc)
+    livre = or_(
+        tabela.c.estado == EXECUCAO_PENDENTE,
+        and_(
+            tabela.c.estado == EXECUCAO_EM_CURSO,
+            tabela.c.atualizado_em < agora - timedelta(minutes=TAREFAS_ABANDONO),
+        ),
+    )
+    if execucao_id is None:
+        execucao_id = select(tabela.c.id).where(livre).order_by(tabela.c.id).limit(1).scalar_subquery()
+    # o UPDATE volta a verificar o estado com o lock de escrita: dois processos
+    # nunca reclamam a mesma execução
+    return ligacao.execute(
+        update(tabela)
+        .where(tabela.c.id == execucao_id, livre)
+        .values(
+            estado=EXECUCAO_EM_CURSO, processados=0, lotes=0, lote_max_ms=0, resultado="{}",
+            erro=None, iniciado_em=agora, atualizado_em=agora, terminado_em=None, duracao_ms=None,
+        )
+        .returning(*tabela.columns)
+    ).first()
+
+
+def executar_execucao(execucao, parar: threading.Event, aviso=None):
+    """Corre a tarefa de uma execução já reclamada e grava como terminou."""
+    progresso = ProgressoTarefa(execucao.id, execucao.dia, parar, aviso)
+    inicio = relogio.perf_counter()
+    erro = None
+    try:
+        TAREFAS[execucao.tarefa](progresso)
+        estado = EXECUCAO_CONCLUIDA
+    except TarefaInterrompida:
+        # o processo vai parar: a execução volta à fila e recomeça mais tarde
+        estado = EXECUCAO_PENDENTE
+    except Exception as e:
+        log_tarefas.exception("Tarefa %s (%s) falhou", execucao.tarefa, execucao.dia)
+        estado, erro = EXECUCAO_FALHOU, f"{type(e).__name__}: {e}"
+    duracao_ms = (relogio.perf_counter() - inicio) * 1000
+    with clinica().engine.begin() as ligacao:
+        progresso.gravar(
+            ligacao,
+            estado=estado,
+            erro=erro,
+            duracao_ms=duracao_ms,
+            terminado_em=None if estado == EXECUCAO_PENDENTE else datetime.now(timezone.utc),
+        )
+    log_tarefas.info(
+        "Tarefa %s (%s) %s: %d linhas, %d lotes, %.1f s, lote mais longo %.0f ms",
+        execucao.tarefa, execucao.dia, estado, progresso.processados, progresso.lotes,
+        duracao_ms / 1000, progresso.lote_max_ms,
+    )
+    return progresso
+
+
+def correr_pendentes(parar: threading.Event):
+    while not parar.is_set():
+        with clinica().engine.begin() as ligacao:
+            execucao = reclamar_execucao(ligacao)
+        if execucao is None:
+            return
+        executar_execucao(execucao, parar)
+
+
+class AgendadorTarefas:
+    def __init__(self):
+        self.loop = None
+        self.acordar = None
+        self.tarefa = None
+        self.parar = threading.Event()
+        self.dia_verificado = None
+        self.primeiro_dia = None
+
+    def iniciar(self):
+        self.loop = asyncio.get_running_loop()
+        self.acordar = asyncio.Event()
+        self.parar.clear()
+        dia = dia_das_tarefas(datetime.now())
+        self.primeiro_dia = dia if TAREFAS_ATRASADAS else dia + timedelta(days=1)
+        self.tarefa = self.loop.create_task(self.correr())
+
+    async def terminar(self):
+        # a tarefa em curso para no fim do lote atual e volta a pendente
+        self.parar.set()
+        if self.tarefa is not None:
+            self.tarefa.cancel()
+            try:
+                await self.tarefa
+            except asyncio.CancelledError:
+                pass
+            self.tarefa = None
+
+    def avisar(self):
+        # chamado de qualquer thread quando é pedida uma execução
+        loop, acordar, tarefa = self.loop, self.acordar, self.tarefa
+        if tarefa is None or tarefa.done():
+            return
+        try:
+            loop.call_soon_threadsafe(acordar.set)
+        except RuntimeError:  # loop já fechado
+            pass
+
+    def verificar(self):
+        dia = dia_das_tarefas(datetime.now())
+        # a noite anterior ao arranque fica por agendar (ver TAREFAS_ATRASADAS);
+        # as execuções já pendentes correm na mesma
+        agendar = dia >= self.primeiro_dia
+        # uma vez por dia passa por todas as clínicas; no resto do tempo só pelas
+        # abertas, que são as que podem ter execuções pedidas pela API
+        todas = agendar and self.dia_verificado != dia
+        for nome in clinicas.conhecidas() if todas else clinicas.nomes_abertos():
+            if self.parar.is_set():
+                return
+            try:
+                with usar_clinica(nome) as atual:
+                    if agendar:
+                        with atual.engine.begin() as ligacao:
+                            for tarefa in TAREFAS:
+                                agendar_execucao(ligacao, tarefa, dia)
+                    correr_pendentes(self.parar)
+            except Exception:
+                log_tarefas.exception("Falha nas tarefas da clínica %s", nome)
+        if todas:
+            self.dia_verificado = dia
+
+    async def esperar(self):
+        # até à próxima procura, à TAREFAS_HORA ou a um aviso da API
+        agora = datetime.now()
+        proxima = datetime.combine(agora.date(), TAREFAS_HORA)
+        if proxima <= agora:
+            proxima += timedelta(days=1)
+        try:
+            await asyncio.wait_for(self.acordar.wait(), min(TAREFAS_INTERVALO, (proxima - agora).total_seconds()))
+        except TimeoutError:
+            pass
+        self.acordar.clear()
+
+    async def correr(self):
+        if not TAREFAS_ATRASADAS:
+            await self.esperar()
+        while not self.parar.is_set():
+            try:
+                await run_in_threadpool(self.verificar)
+            except Exception:
+                log_tarefas.exception("Falha ao procurar tarefas pendentes")
+            await clinicas.fechar_despejadas()
+            await self.esperar()
+
+
+agendador_tarefas = AgendadorTarefas()
+
+
 app = FastAPI( title="Sistema de Gestão de Clínica (de pequena escala)")
+app.add_middleware(RotearClinica)
 
 
 @app.on_event("startup")
 def on_startup():
-    create_db_and_tables()
+    hash_ficticio()
+    # com várias clínicas, cada uma é preparada no primeiro pedido
+    if not CLINICAS_DIR:
+        clinica().preparar()
 
 #### USUÁRIOS APIENDPOINTS ###
 
-@app.post("/usuarios", response_model=Usuario)
-def criar_usuario(usuario: Usuario):
-    with Session(engine) as session:
-        session.add(usuario)
-        session.commit()
-        session.refresh(usuario)
-        return usuario
+# as rotas que calculam o scrypt são async: esperam pelo pool de senhas sem
+# ocupar uma thread e fazem o trabalho na base de dados em run_in_threadpool
 
+def gravar_usuario(session: Session, usuario: Usuario):
+    session.add(usuario)
+    session.commit()
+    session.refresh(usuario)
+    return usuario
 
-@app.get("/usuarios", response_model=List[Usuario])
-def listar_usuarios():
-    with Session(engine) as session:
-        return session.exec(select(Usuario)).all()
 
+@app.post("/usuarios", response_model=UsuarioPublico)
+async def criar_usuario(usuario: Usuario, session: DBSession):
+    usuario = validar(Usuario, usuario)
+    usuario.senha_has = await hash_para_guardar(usuario.senha_has)
+    return publico(Usuario, await run_in_threadpool(gravar_usuario, session, usuario))
 
-@app.get("/usuarios/{usuario_id}", response_model=Usuario)
-def buscar_usuario(usuario_id: uuid.UUID):
-    with Session(engine) as session:
-        usuario = session.get(Usuario, usuario_id)
-        if not usuario:
-            raise HTTPException(status_code=404, detail="Usuário não encontrado")
-        return usuario
 
+@app.get("/usuarios", response_model=Pagina[UsuarioPublico])
+def listar_usuarios(
+    session: DBSession,
+    lista: Annotated[Listagem, Depends(parametros_lista(Usuario))],
+    limit: Limite = LIMITE_PADRAO,
+    after: Cursor = None,
+):
+    return responder(paginar(session, Usuario, limit, after, lista))
 
-@app.put("/usuarios/{usuario_id}", response_model=Usuario)
-def atualizar_usuario(usuario_id: uuid.UUID, dados: Usuario):
-    with Session(engine) as session:
-        usuario = session.get(Usuario, usuario_id)
-        if not usuario:
-            raise HTTPException(status_code=404, detail="Usuário não encontrado")
 
-        usuario.nome = dados.nome
-        usuario.senha = dados.senha
-        usuario.email = dados.email
+@app.get("/usuarios/{usuario_id}", response_model=UsuarioPublico)
+def buscar_usuario(usuario_id: uuid.UUID, session: DBSession):
+    usuario = session.get(Usuario, usuario_id)
+    if not usuario:
+        raise HTTPException(status_code=404, detail="Usuário não encontrado")
+    return responder(publico(Usuario, usuario))
+
+
+UsuarioParcial = modelo_parcial(Usuario)
 
-        usuario. tipo_usuario= dados.tipo_usuario
-        session.add(usuario)
-        session.commit()
-        session.refresh(usuario)
-        return usuario
+
+def gravar_alteracoes_usuario(session: Session, usuario_id: uuid.UUID, alteracoes: dict, versao: Optional[int]):
+    # a senha já chega em hash (ver hash_das_alteracoes); uma senha nova fecha
+    # as sessões abertas com a antiga
+    anterior = None
+    if alteracoes.get("senha_has") is not None:
+        anterior = session.execute(select(Usuario.senha_has).where(Usuario.id == usuario_id)).scalar()
+    linha = atualizar_linha(session, Usuario, usuario_id, alteracoes, versao, "Usuário não encontrado")
+    if anterior is not None and linha["senha_has"] != anterior:
+        revogar_sessoes(session, usuario_id)
+    session.commit()
+    return responder(publico(Usuario, linha))
+
+
+async def hash_das_alteracoes(alteracoes: dict):
+    if alteracoes.get("senha_has") is not None:
+        alteracoes["senha_has"] = await hash_para_guardar(alteracoes["senha_has"])
+    return alteracoes
+
+
+@app.put("/usuarios/{usuario_id}", response_model=UsuarioPublico)
+async def atualizar_usuario(request: Request, usuario_id: uuid.UUID, dados: Usuario, session: DBSession):
+    alteracoes, versao = pedido_put(request, Usuario, dados)
+    await hash_das_alteracoes(alteracoes)
+    return await run_in_threadpool(gravar_alteracoes_usuario, session, usuario_id, alteracoes, versao)
+
+
+@app.patch("/usuarios/{usuario_id}", response_model=UsuarioPublico)
+async def alterar_usuario(request: Request, usuario_id: uuid.UUID, dados: UsuarioParcial, session: DBSession):
+    alteracoes, versao = pedido_patch(request, dados)
+    await hash_das_alteracoes(alteracoes)
+    return await run_in_threadpool(gravar_alteracoes_usuario, session, usuario_id, alteracoes, versao)
+
+
+class NovaSenha(BaseModel):
+    senha: str = Field(min_length=1)
+
+
+def gravar_senha(session: Session, usuario_id: uuid.UUID, senha_has: str):
+    alterado = session.execute(
+        update(Usuario)
+        .where(Usuario.id == usuario_id)
+        .values(senha_has=senha_has, versao=Usuario.versao + 1)
+    ).rowcount
+    if not alterado:
+        raise HTTPException(status_code=404, detail="Usuário não encontrado")
+    revogar_sessoes(session, usuario_id)
+    session.commit()
+    return {"mensagem": "Senha alterada com sucesso"}
+
+
+@app.put("/usuarios/{usuario_id}/senha")
+async def definir_senha(usuario_id: uuid.UUID, dados: NovaSenha, session: DBSession):
+    senha_has = await asyncio.wrap_future(submeter_calculo(gerar_hash_senha, dados.senha))
+    return await run_in_threadpool(gravar_senha, session, usuario_id, senha_has)
 
 
 @app.delete("/usuarios/{usuario_id}")
-def eliminar_usuario(usuario_id: uuid.UUID):
-    with Session(engine) as session:
-        usuario = session.get(Usuario, usuario_id)
-        if not usuario:
-            raise HTTPException(status_code=404, detail="Usuário não encontrado")
+def eliminar_usuario(usuario_id: uuid.UUID, session: DBSession):
+    usuario = session.get(Usuario, usuario_id)
+    if not usuario:
+        raise HTTPException(status_code=404, detail="Usuário não encontrado")
+
+    revogar_sessoes(session, usuario_id)
+    session.delete(usuario)
+    session.commit()
+    return {"mensagem": "Usuário eliminado com sucesso"}
+
+
+
+#### AUTENTICAÇÃO API ENDPOINTS ####
+
+class Credenciais(BaseModel):
+    username: str
+    senha: str
+
+
+class Token(BaseModel):
+    access_token: str
+    token_type: str = "bearer"
+    expira_em: datetime
+    usuario_id: uuid.UUID
+    tipo_usuario: TipoUsuario
+
+
+# o login e o logout escrevem, por isso usam a sessão de escrita do pedido
+# (DBSession, ou a AsyncSession de escrita no modo async); as funções abaixo
+# recebem a sessão sync, que no modo async é a de run_sync
+
+def ler_conta(session: Session, username: str):
+    conta = session.exec(
+        select(Usuario.id, Usuario.username, Usuario.senha_has, Usuario.tipo_usuario)
+        .where(Usuario.username == username)
+    ).first()
+    # devolve a ligação de escrita ao pool enquanto o scrypt corre
+    session.rollback()
+    return conta
+
+
+def abrir_sessao(session: Session, conta, senha_nova: Optional[str]):
+    token = secrets.token_urlsafe(32)
+    sessao = SessaoAtiva(
+        usuario_id=conta.id,
+        username=conta.username,
+        tipo_usuario=conta.tipo_usuario,
+        expira_em=datetime.now(timezone.utc) + timedelta(hours=SESSAO_HORAS),
+    )
+    if senha_nova is not None:
+        # só se a senha não mudou entretanto
+        session.execute(
+            update(Usuario)
+            .where(Usuario.id == conta.id, Usuario.senha_has == conta.senha_has)
+            .values(senha_has=senha_nova, versao=Usuario.versao + 1)
+        )
+    session.execute(insert(SessaoUsuario.__table__).values(
+        token_hash=hash_token(token), usuario_id=conta.id, expira_em=sessao.expira_em,
+    ))
+    session.commit()
+    cache_sessoes.guardar((clinica().nome, hash_token(token)), sessao)
+    return Token(
+        access_token=token,
+        expira_em=sessao.expira_em,
+        usuario_id=sessao.usuario_id,
+        tipo_usuario=sessao.tipo_usuario,
+    )
+
+
+async def autenticar(credenciais: Credenciais, executar):
+    """executar(funcao, *args) corre funcao(session, *args) na sessão do pedido."""
+    conta = await executar(ler_conta, credenciais.username)
+    guardada = conta.senha_has if conta else hash_ficticio()
+    valida = await asyncio.wrap_future(submeter_calculo(verificar_hash_senha, credenciais.senha, guardada))
+    if conta is None or not valida:
+        raise HTTPException(status_code=401, detail="Username ou senha inválidos")
+
+    senha_nova = None
+    if hash_desatualizado(conta.senha_has):
+        try:
+            senha_nova = await asyncio.wrap_future(submeter_calculo(gerar_hash_senha, credenciais.senha))
+        except HTTPException:
+            pass  # pool cheio: converte-se no próximo login
+    return await executar(abrir_sessao, conta, senha_nova)
+
+
+@app.post("/auth/login", response_model=Token)
+async def login(credenciais: Credenciais, session: DBSession):
+    return await autenticar(credenciais, lambda funcao, *args: run_in_threadpool(funcao, session, *args))
+
+
+def terminar_sessao(session: Session, authorization: str):
+    chave = hash_token(authorization.partition(" ")[2].strip())
+    session.execute(delete(SessaoUsuario).where(SessaoUsuario.token_hash == chave))
+    session.commit()
+    cache_sessoes.remover((clinica().nome, chave))
+    return {"mensagem": "Sessão terminada"}
+
+
+@app.post("/auth/logout")
+def logout(sessao: UsuarioAutenticado, authorization: Annotated[str, Header()], session: DBSession):
+    return terminar_sessao(session, authorization)
+
 
-        session.delete(usuario)
-        session.commit()
-        return {"mensagem": "Usuário eliminado com sucesso"}
+@app.get("/auth/sessao", response_model=SessaoAtiva)
+async def sessao_autenticada(sessao: UsuarioAutenticado):
+    return sessao
 
 
 
 #### PACIENTES API ENDPOINTS ####
 
 @app.post("/pacientes", response_model=Paciente)
-def criar_paciente(paciente: Paciente):
-    with Session(engine) as session:
-        session.add(paciente)
-        session.commit()
-        session.refresh(paciente)
-        return paciente
-
-
-@app.get("/pacientes", response_model=List[Paciente])
-def listar_pacientes():
-    with Session(engine) as session:
-        return session.exec(select(Paciente)).all()
+def criar_paciente(paciente: Paciente, session: DBSession):
+    paciente = validar(Paciente, paciente)
+    session.add(paciente)
+    session.commit()
+    session.refresh(paciente)
+    return paciente
+
+
+@app.get("/pacientes", response_model=Pagina[Paciente])
+def listar_pacientes(
+    session: DBSession,
+    lista: Annotated[Listagem, Depends(parametros_lista(Paciente))],
+    limit: Limite = LIMITE_PADRAO,
+    after: Cursor = None,
+):
+    return responder(paginar(session, Paciente, limit, after, lista))
+
+
+@app.get("/pacientes/pesquisa", response_model=List[Paciente])
+def pesquisar_pacientes(q: Annotated[str, Query(min_length=1)], session: DBSession, limit: Annotated[int, Query(ge=1, le=100)] = 20):
+    expressao = expressao_pesquisa(q)
+    if not expressao:
+        return []
+
+    # o nome pesa mais do que os restantes campos na ordenação bm25
+    consulta = text("""
+        SELECT paciente.*
+        FROM paciente_fts
+        JOIN paciente ON paciente.rowid = paciente_fts.rowid
+        WHERE paciente_fts MATCH :expressao
+        ORDER BY bm25(paciente_fts, 10.0, 5.0, 5.0, 2.0)
+        LIMIT :limit
+    """)
+    return responder(session.exec(
+        select(Paciente).from_statement(consulta).params(expressao=expressao, limit=limit)
+    ).scalars().all())
 
 
 @app.get("/pacientes/{paciente_id}", response_model=Paciente)
-def buscar_paciente(paciente_id: uuid.UUID):
-    with Session(engine) as session:
-        paciente = session.get(Paciente, paciente_id)
-        if not paciente:
-            raise HTTPException(status_code=404, detail="Paciente não encontrado")
-        return paciente
+def buscar_paciente(paciente_id: uuid.UUID, session: DBSession):
+    paciente = session.get(Paciente, paciente_id)
+    if not paciente:
+        raise HTTPException(status_code=404, detail="Paciente não encontrado")
+    return responder(paciente)
+
+
+class LinhaHistorico(BaseModel):
+    servico_id: uuid.UUID
+    nome_servico: Optional[str]
+    preco: Optional[float]
+    quantidade: int
+
+
+class ConsultaHistorico(BaseModel):
+    id: uuid.UUID
+    data_consulta: date
+    hora_consulta: time
+    marcacao_id: uuid.UUID
+    medico_id: uuid.UUID
+    servico_id: uuid.UUID
+    total: float
+    linhas: List[LinhaHistorico]
+
+
+class HistoricoPaciente(BaseModel):
+    paciente: Paciente
+    marcacoes: List[Marcacao]
+    consultas: List[ConsultaHistorico]
+    pagamentos: List[Pagamento]
+
+
+@app.get("/pacientes/{paciente_id}/historico", response_model=HistoricoPaciente)
+def historico_paciente(paciente_id: uuid.UUID, session: DBSession):
+    # número fixo de consultas, seja qual for o histórico: paciente, marcações,
+    # consultas, linhas (com join ao serviço) e pagamentos, cada uma pelo índice
+    # da respetiva FK
+    paciente = session.exec(
+        select(Paciente)
+        .where(Paciente.id == paciente_id)
+        .options(
+            selectinload(Paciente.marcacoes),
+            selectinload(Paciente.consultas)
+            .selectinload(Consulta.linhas)
+            .joinedload(ConsultaService.servico),
+            selectinload(Paciente.pagamentos),
+        )
+    ).first()
+    if not paciente:
+        raise HTTPException(status_code=404, detail="Paciente não encontrado")
+
+    consultas = [
+        ConsultaHistorico(
+            **consulta.model_dump(exclude={"paciente_id"}),
+            linhas=[
+                LinhaHistorico(
+                    servico_id=linha.servico_id,
+                    nome_servico=linha.servico.nome_servico if linha.servico else None,
+                    preco=linha.servico.preco if linha.servico else None,
+                    quantidade=linha.quantidade,
+                )
+                for linha in consulta.linhas
+            ],
+        )
+        for consulta in sorted(paciente.consultas, key=lambda c: (c.data_consulta, c.hora_consulta), reverse=True)
+    ]
+    return responder(HistoricoPaciente(
+        paciente=paciente,
+        marcacoes=sorted(paciente.marcacoes, key=lambda m: (m.data_marcacao, m.hora_marcacao), reverse=True),
+        consultas=consultas,
+        pagamentos=sorted(paciente.pagamentos, key=lambda p: p.data_pagamento, reverse=True),
+    ))
+
+
+PacienteParcial = modelo_parcial(Paciente)
 
 
 @app.put("/pacientes/{paciente_id}", response_model=Paciente)
-def atualizar_paciente(paciente_id: uuid.UUID, dados: Paciente):
-    with Session(engine) as session:
-        paciente = session.get(Paciente, paciente_id)
-        if not paciente:
-            raise HTTPException(status_code=404, detail="Paciente não encontrado")
-
-        paciente.nome = dados.nome
-        paciente.idade = dados.idade
-        paciente.genero = dados.genero
-        paciente.num_bi = dados.num_bi
-        paciente.telefone = dados.telefone
-        paciente.endereco = dados.endereco
-        paciente.email = dados.email
-        paciente.data_registro = dados.data_registro
-        paciente.user_id = dados.user_id
-
-        session.add(paciente )
-        session.commit()
-        session.refresh(paciente)
-        return paciente
+def atualizar_paciente(request: Request, paciente_id: uuid.UUID, dados: Paciente, session: DBSession):
+    alteracoes, versao = pedido_put(request, Paciente, dados)
+    return gravar_alteracoes(session, Paciente, paciente_id, alteracoes, versao, "Paciente não encontrado")
+
+
+@app.patch("/pacientes/{paciente_id}", response_model=Paciente)
+def alterar_paciente(request: Request, paciente_id: uuid.UUID, dados: PacienteParcial, session: DBSession):
+    alteracoes, versao = pedido_patch(request, dados)
+    return gravar_alteracoes(session, Paciente, paciente_id, alteracoes, versao, "Paciente não encontrado")
 
 
 @app.delete("/pacientes/{paciente_id}")
-def eliminar_paciente(paciente_id: uuid.UUID):
-    with Session(engine) as session:
-        paciente = session.get(Paciente, paciente_id)
-        if not paciente:
-            raise HTTPException(status_code=404, detail="Paciente não encontrado")
+def eliminar_paciente(paciente_id: uuid.UUID, session: DBSession):
+    paciente = session.get(Paciente, paciente_id)
+    if not paciente:
+        raise HTTPException(status_code=404, detail="Paciente não encontrado")
 
-        session.delete(paciente)
-        session.commit()
-        return {"mensagem": "Paciente eliminado com sucesso"}
+    session.delete(paciente)
+    session.commit()
+    return {"mensagem": "Paciente eliminado com sucesso"}
 
 
 
 #### MÉDICOS API ENDPOINTS ####
 
 @app.post("/medicos", response_model=Medico)
-def criar_medico(medico: Medico):
-    with Session(engine) as session:
-        session.add(medico)
-        session.commit()
-        session.refresh(medico)
-        return medico
-
-
-@app.get("/medicos", response_model=List[Medico])
-def listar_medicos():
-    with Session(engine) as session:
-        return session.exec(select(Medico)).all()
+def criar_medico(medico: Medico, session: DBSession):
+    medico = validar(Medico, medico)
+    atualizar_resumos(session, Medico, [medico.id], -1)
+    session.add(medico)
+    session.flush()
+    atualizar_resumos(session, Medico, [medico.id], 1)
+    session.commit()
+    invalidar_cache(Medico)
+    session.refresh(medico)
+    return medico
+
+
+@app.get("/medicos", response_model=Pagina[Medico])
+def listar_medicos(
+    request: Request,
+    session: DBSession,
+    lista: Annotated[Listagem, Depends(parametros_lista(Medico))],
+    limit: Limite = LIMITE_PADRAO,
+    after: Cursor = None,
+):
+    def carregar():
+        return paginar(session, Medico, limit, after, lista)
+
+    return resposta_em_cache(request, Medico, carregar)
 
 
 @app.get("/medicos/{medico_id}", response_model=Medico)
-def buscar_medico(medico_id: uuid.UUID):
-    with Session(engine) as session:
+def buscar_medico(request: Request, medico_id: uuid.UUID, session: DBSession):
+    def carregar():
         medico = session.get(Medico, medico_id)
         if not medico:
             raise HTTPException(status_code=404, detail="Médico não encontrado")
         return medico
 
+    return resposta_em_cache(request, Medico, carregar)
+
+
+MedicoParcial = modelo_parcial(Medico)
+
 
 @app.put("/medicos/{medico_id}", response_model=Medico)
-def atualizar_medico(medico_id: uuid.UUID, dados: Medico):
-    with Session(engine) as session:
-        medico = session.get(Medico, medico_id)
-        if not medico:
-            raise HTTPException(status_code=404, detail="Médico não encontrado")
+def atualizar_medico(request: Request, medico_id: uuid.UUID, dados: Medico, session: DBSession):
+    alteracoes, versao = pedido_put(request, Medico, dados)
+    return gravar_alteracoes(session, Medico, medico_id, alteracoes, versao, "Médico não encontrado")
 
-        medico.nome = dados.nome
-        medico.especialidade = dados.especialidade
-        medico.telefone = dados.telefone
-        medico.user_id = dados.user_id
-        session.add(medico)
-        session.commit()
-        session.refresh(medico)
-        return medico
+
+@app.patch("/medicos/{medico_id}", response_model=Medico)
+def alterar_medico(request: Request, medico_id: uuid.UUID, dados: MedicoParcial, session: DBSession):
+    alteracoes, versao = pedido_patch(request, dados)
+    return gravar_alteracoes(session, Medico, medico_id, alteracoes, versao, "Médico não encontrado")
 
 
 @app.delete("/medicos/{medico_id}")
-def eliminar_medico(medico_id: uuid.UUID):
-    with Session(engine) as session:
-        medico = session.get(Medico, medico_id)
-        if not medico:
-            raise HTTPException(status_code=404, detail="Médico não encontrado")
+def eliminar_medico(medico_id: uuid.UUID, session: DBSession):
+    medico = session.get(Medico, medico_id)
+    if not medico:
+        raise HTTPException(status_code=404, detail="Médico não encontrado")
 
-        session.delete(medico)
-        session.commit()
-        return {"mensagem": "Médico eliminado com sucesso"}
+    atualizar_resumos(session, Medico, [medico_id], -1)
+    session.delete(medico)
+    session.flush()
+    atualizar_resumos(session, Medico, [medico_id], 1)
+    session.commit()
+    invalidar_cache(Medico)
+    return {"mensagem": "Médico eliminado com sucesso"}
 
 
 
 #### FUNCIONARIOS API ENDPOINTS ####
 
-@app.post("/funcionario", response_model=Medico)
-def criar_funcionario(funcionario: Funcionario):
-    with Session(engine) as session:
-        session.add(funcionario)
-        session.commit()
-        session.refresh(funcionario)
-        return funcionario
+@app.post("/funcionario", response_model=Funcionario)
+def criar_funcionario(funcionario: Funcionario, session: DBSession):
+    funcionario = validar(Funcionario, funcionario)
+    session.add(funcionario)
+    session.commit()
+    session.refresh(funcionario)
+    return funcionario
 
 
-@app.get("/funcionario", response_model=List[Funcionario])
-def listar_funcionario():
-    with Session(engine) as session:
-        return session.exec(select(Funcionario)).all()
+@app.get("/funcionario", response_model=Pagina[Funcionario])
+def listar_funcionario(
+    session: DBSession,
+    lista: Annotated[Listagem, Depends(parametros_lista(Funcionario))],
+    limit: Limite = LIMITE_PADRAO,
+    after: Cursor = None,
+):
+    return responder(paginar(session, Funcionario, limit, after, lista))
 
 
 @app.get("/funcionarios/{funcionario_id}", response_model=Funcionario)
-def buscar_funcionario(funcionario_id: uuid.UUID):
-    with Session(engine) as session:
-        func = session.get(Funcionario, funcionario_id)
-        if not func:
-            raise HTTPException(status_code=404, detail="Funcionário não encontrado")
-        return func
+def buscar_funcionario(funcionario_id: uuid.UUID, session: DBSession):
+    func = session.get(Funcionario, funcionario_id)
+    if not func:
+        raise HTTPException(status_code=404, detail="Funcionário não encontrado")
+    return responder(func)
+
+
+FuncionarioParcial = modelo_parcial(Funcionario)
 
 
 @app.put("/funcionarios/{funcionario_id}", response_model=Funcionario)
-def atualizar_funcionario(funcionario_id: uuid.UUID, dados: Funcionario):
-    with Session(engine) as session:
-        funcionario = session.get(Funcionario, funcionario_id)
-        if not funcionario:
-            raise HTTPException(status_code=404, detail="Funcionario não encontrado")
-
-        funcionario.nome = dados.nome
-        funcionario.cargo = dados.cargo
-        funcionario.telefone = dados.telefone
-        funcionario.email = dados.email
-        funcionario.user_id = dados.user_id
-
-        session.add(funcionario)
-        session.commit()
-        session.refresh(funcionario)
-        return funcionario
+def atualizar_funcionario(request: Request, funcionario_id: uuid.UUID, dados: Funcionario, session: DBSession):
+    alteracoes, versao = pedido_put(request, Funcionario, dados)
+    return gravar_alteracoes(session, Funcionario, funcionario_id, alteracoes, versao, "Funcionario não encontrado")
 
-@app.delete("/funcionarios/{funcionario_id}")
-def eliminar_funcionario(funcionario_id: uuid.UUID):
-    with Session(engine) as session:
-        funcionario = session.get(Funcionario, funcionario_id)
-        if not funcionario:
-            raise HTTPException(status_code=404, detail="Funcionário não encontrado")
 
-        session.delete(funcionario)
+@app.patch("/funcionarios/{funcionario_id}", response_model=Funcionario)
+def alterar_funcionario(request: Request, funcionario_id: uuid.UUID, dados: FuncionarioParcial, session: DBSession):
+    alteracoes, versao = pedido_patch(request, dados)
+    return gravar_alteracoes(session, Funcionario, funcionario_id, alteracoes, versao, "Funcionario não encontrado")
+
+@app.delete("/funcionarios/{funcionario_id}")
+def eliminar_funcionario(funcionario_id: uuid.UUID, session: DBSession):
+    funcionario = session.get(Funcionario, funcionario_id)
+    if not funcionario:
+        raise HTTPException(status_code=404, detail="Funcionário não encontrado")
+
+    session.delete(funcionario)
+    session.commit()
+    return {"mensagem": "Funcionario eliminado com sucesso"}
+
+
+    #### AGENDA DOS MÉDICOS ####
+
+# Os horários livres de um médico num dia são os slots do seu horário de
+# trabalho menos as marcações ativas desse dia, lidas pelo índice
+# (medico_id, data_marcacao, hora_marcacao). A marcação em si é atómica: o mesmo
+# índice é único, por isso dois pedidos concorrentes para o mesmo slot nunca
+# são gravados os dois; o segundo recebe 409.
+
+# usado quando o médico não tem horário definido: segunda a sexta, 08h-17h
+HORARIO_PADRAO = [
+    (dia, time(8, 0), time(17, 0), 30) for dia in range(5)
+]
+
+
+class IntervaloHorario(BaseModel):
+    dia_semana: int = Field(ge=0, le=6)
+    hora_inicio: time
+    hora_fim: time
+    duracao_minutos: int = Field(default=30, gt=0)
+
+
+class Disponibilidade(BaseModel):
+    medico_id: uuid.UUID
+    data: date
+    livres: List[time]
+
+
+def horario_do_dia(session: Session, medico_id: uuid.UUID, dia: date):
+    horarios = session.exec(
+        select(HorarioMedico).where(HorarioMedico.medico_id == medico_id)
+    ).all()
+    if horarios:
+        intervalos = [
+            (h.dia_semana, h.hora_inicio, h.hora_fim, h.duracao_minutos) for h in horarios
+        ]
+    else:
+        intervalos = HORARIO_PADRAO
+
+    slots = []
+    for dia_semana, inicio, fim, duracao in intervalos:
+        if dia_semana != dia.weekday():
+            continue
+        atual = datetime.combine(dia, inicio)
+        limite = datetime.combine(dia, fim)
+        while atual + timedelta(minutes=duracao) <= limite:
+            slots.append(atual.time())
+            atual += timedelta(minutes=duracao)
+    return sorted(set(slots))
+
+
+def horas_ocupadas(session: Session, medico_id: uuid.UUID, dia: date):
+    return set(session.exec(
+        select(Marcacao.hora_marcacao).where(
+            Marcacao.medico_id == medico_id,
+            Marcacao.data_marcacao == dia,
+            Marcacao.estado_marcacao != ESTADO_MARCACAO_CANCELADA,
+        )
+    ).all())
+
+
+def verificar_slot(session: Session, marcacao: Marcacao, slots: Optional[dict] = None):
+    # slots guarda os horários já calculados, por (medico_id, data), entre
+    # chamadas seguidas (o bulk verifica muitas marcações do mesmo dia)
+    if not session.get(Medico, marcacao.medico_id):
+        raise HTTPException(status_code=404, detail="Médico não encontrado")
+    if marcacao.estado_marcacao == ESTADO_MARCACAO_CANCELADA:
+        return
+    chave = (marcacao.medico_id, marcacao.data_marcacao)
+    livres = slots.get(chave) if slots is not None else None
+    if livres is None:
+        livres = set(horario_do_dia(session, *chave))
+        if slots is not None:
+            slots[chave] = livres
+    if marcacao.hora_marcacao not in livres:
+        raise HTTPException(status_code=422, detail="Fora do horário de trabalho do médico")
+
+
+def gravar_marcacao(session: Session, marcacao: Marcacao, verificar: bool = True):
+    if verificar:
+        verificar_slot(session, marcacao)
+    session.add(marcacao)
+    try:
+        registar_alteracoes(session, Marcacao, ALTERACAO_CRIADA, [campos_linha(marcacao)])
         session.commit()
-        return {"mensagem": "Funcionario eliminado com sucesso"}
+    except IntegrityError:
+        session.rollback()
+        raise HTTPException(status_code=409, detail="O médico já tem uma marcação nesse horário")
+    publicar_alteracoes(Marcacao)
+    session.refresh(marcacao)
+    return marcacao
+
+
+@app.get("/medicos/{medico_id}/disponibilidade", response_model=Disponibilidade)
+def disponibilidade_medico(medico_id: uuid.UUID, data: date, session: DBSession):
+    if not session.get(Medico, medico_id):
+        raise HTTPException(status_code=404, detail="Médico não encontrado")
+
+    ocupadas = horas_ocupadas(session, medico_id, data)
+    livres = [h for h in horario_do_dia(session, medico_id, data) if h not in ocupadas]
+    return Disponibilidade(medico_id=medico_id, data=data, livres=livres)
+
+
+@app.get("/medicos/{medico_id}/horario", response_model=List[IntervaloHorario])
+def buscar_horario_medico(medico_id: uuid.UUID, session: DBSession):
+    if not session.get(Medico, medico_id):
+        raise HTTPException(status_code=404, detail="Médico não encontrado")
+
+    horarios = session.exec(
+        select(HorarioMedico)
+        .where(HorarioMedico.medico_id == medico_id)
+        .order_by(HorarioMedico.dia_semana, HorarioMedico.hora_inicio)
+    ).all()
+    if not horarios:
+        return [
+            IntervaloHorario(dia_semana=d, hora_inicio=i, hora_fim=f, duracao_minutos=m)
+            for d, i, f, m in HORARIO_PADRAO
+        ]
+    return [IntervaloHorario.model_validate(h, from_attributes=True) for h in horarios]
+
+
+@app.put("/medicos/{medico_id}/horario", response_model=List[IntervaloHorario])
+def definir_horario_medico(medico_id: uuid.UUID, intervalos: List[IntervaloHorario], session: DBSession):
+    for intervalo in intervalos:
+        if intervalo.hora_fim <= intervalo.hora_inicio:
+            raise HTTPException(status_code=422, detail="hora_fim tem de ser depois de hora_inicio")
+
+    if not session.get(Medico, medico_id):
+        raise HTTPException(status_code=404, detail="Médico não encontrado")
+
+    for antigo in session.exec(select(HorarioMedico).where(HorarioMedico.medico_id == medico_id)):
+        session.delete(antigo)
+    for intervalo in intervalos:
+        session.add(HorarioMedico(medico_id=medico_id, **intervalo.model_dump()))
+    session.commit()
+    return intervalos
+
 
 
     #### MARCAÇÃO API ENDPOINTS ####
 
 @app.post("/marcacao", response_model=Marcacao)
-def criar_marcacao(marcacao: Marcacao):
-    with Session(engine) as session:
-        session.add(marcacao)
-        session.commit()
-        session.refresh(marcacao)
-        return marcacao
+def criar_marcacao(marcacao: Marcacao, session: DBSession, idempotency_key: ChaveIdempotencia = None):
+    marcacao = validar(Marcacao, marcacao)
+    if idempotency_key:
+        repetida = reservar_pedido(session, Marcacao, idempotency_key, marcacao)
+        if repetida is not None:
+            return repetida
+    return gravar_marcacao(session, marcacao)
+
+
+@app.get("/marcacao", response_model=Pagina[Marcacao])
+def listar_marcacao(
+    session: DBSession,
+    lista: Annotated[Listagem, Depends(parametros_lista(Marcacao))],
+    limit: Limite = LIMITE_PADRAO,
+    after: Cursor = None,
+):
+    return responder(paginar(session, Marcacao, limit, after, lista))
+
+
+# declarada antes de /marcacao/{marcacao_id}, que também apanharia "stream"
+@app.get("/marcacao/stream")
+async def stream_marcacao(
+    medico_id: Optional[uuid.UUID] = None,
+    data: Optional[date] = None,
+    last_event_id: Annotated[Optional[str], Header()] = None,
+):
+    desde = None
+    if last_event_id:
+        try:
+            desde = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Last-Event-ID inválido")
+
+    feed = clinica().feed_marcacoes
+
+    async def eventos():
+        fila = feed.subscrever()
+        try:
+            yield "retry: 3000\n\n"
+            enviado = 0
+            if desde is not None:
+                if await run_in_threadpool(alteracoes_perdidas, desde):
+                    # o registo já não chega lá: o cliente tem de recarregar a lista
+                    enviado = await run_in_threadpool(ultima_alteracao)
+                    yield "event: reiniciar\ndata: {}\n\n"
+                else:
+                    enviado = desde
+                    while True:
+                        lote = await run_in_threadpool(ler_alteracoes, enviado, medico_id, data, FEED_LOTE)
+                        if lote:
+                            enviado = lote[-1].id
+                            yield "".join(evento_sse(alteracao) for alteracao in lote)
+                        if len(lote) < FEED_LOTE:
+                            break
+            while True:
+                try:
+                    alteracao = await asyncio.wait_for(fila.get(), FEED_PING)
+                except TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if alteracao is None:
+                    return
+                if alteracao.id > enviado and alteracao_corresponde(alteracao, medico_id, data):
+                    enviado = alteracao.id
+                    yield evento_sse(alteracao)
+        finally:
+            feed.cancelar(fila)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
-@app.get("/marcacao", response_model=List[Marcacao])
-def listar_marcacao():
-    with Session(engine) as session:
-        return session.exec(select(Marcacao)).all()
+@app.get("/marcacao/{marcacao_id}", response_model=Marcacao)
+def buscar_marcacao(marcacao_id: uuid.UUID, session: DBSession):
+    marcacao = session.get(Marcacao, marcacao_id) or buscar_arquivado(session.connection(), Marcacao, marcacao_id)
+    if not marcacao:
+        raise HTTPException(status_code=404, detail="Marcação não encontrado")
+    return responder(marcacao)
 
 
-@app.get("/marcacao/{marcacao_id}", response_model=Marcacao)
-def buscar_marcacao(marcacao_id: uuid.UUID):
-    with Session(engine) as session:
+CAMPOS_SLOT = ("medico_id", "data_marcacao", "hora_marcacao")
+MarcacaoParcial = modelo_parcial(Marcacao)
+
+
+def gravar_alteracoes_marcacao(session: Session, marcacao_id: uuid.UUID, alteracoes: dict, versao: Optional[int]):
+    # só se lê a marcação (e se volta a validar o horário) se mudar de slot;
+    # mudar só o estado é um único UPDATE
+    anterior = None
+    if any(campo in alteracoes for campo in CAMPOS_SLOT):
         marcacao = session.get(Marcacao, marcacao_id)
         if not marcacao:
             raise HTTPException(status_code=404, detail="Marcação não encontrado")
-        return marcacao
+        anterior = campos_linha(marcacao)
+        nova = marcacao.model_copy(update=alteracoes)
+        if any(getattr(nova, campo) != getattr(marcacao, campo) for campo in CAMPOS_SLOT):
+            verificar_slot(session, nova)
+    linha = atualizar_linha(
+        session, Marcacao, marcacao_id, alteracoes, versao, "Marcação não encontrado",
+        conflito="O médico já tem uma marcação nesse horário",
+    )
+    registar_alteracoes(session, Marcacao, ALTERACAO_ALTERADA, [linha], anterior)
+    session.commit()
+    publicar_alteracoes(Marcacao)
+    return responder(linha)
 
 
 @app.put("/marcacao/{marcacao_id}", response_model=Marcacao)
-def atualizar_marcacao(marcacao_id: uuid.UUID, dados: Marcacao):
-    with Session(engine) as session:
-        marcacao = session.get(Marcacao, marcacao_id)
-        if not marcacao:
-            raise HTTPException(status_code=404, detail="Marcação não encontrado")
+def atualizar_marcacao(request: Request, marcacao_id: uuid.UUID, dados: Marcacao, session: DBSession):
+    alteracoes, versao = pedido_put(request, Marcacao, dados)
+    return gravar_alteracoes_marcacao(session, marcacao_id, alteracoes, versao)
 
-        marcacao.data_marcacao = dados.data_marcacao
-        marcacao.hora_marcacao = dados.hora_marcacao 
-        marcacao.estado_marcacao = dados.estado_marcacao
-        marcacao.paciente_id = dados.paciente_id
-        marcacao.medico_id = dados.medico_id
-        
-        session.add(marcacao)
-        session.commit()
-        session.refresh(marcacao)
-        return marcacao
+
+@app.patch("/marcacao/{marcacao_id}", response_model=Marcacao)
+def alterar_marcacao(request: Request, marcacao_id: uuid.UUID, dados: MarcacaoParcial, session: DBSession):
+    alteracoes, versao = pedido_patch(request, dados)
+    return gravar_alteracoes_marcacao(session, marcacao_id, alteracoes, versao)
 
 
 @app.delete("/marcacao/{marcacao_id}")
-def eliminar_marcacao(marcacao_id: uuid.UUID):
-    with Session(engine) as session:
-        marcacao = session.get(Marcacao, marcacao_id)
-        if not marcacao:
-            raise HTTPException(status_code=404, detail="Marcação não encontrado")
+def eliminar_marcacao(marcacao_id: uuid.UUID, session: DBSession):
+    marcacao = session.get(Marcacao, marcacao_id)
+    if not marcacao:
+        raise HTTPException(status_code=404, detail="Marcação não encontrado")
 
-        session.delete(marcacao)
-        session.commit()
-        return {"mensagem": "Marcação eliminado com sucesso"}
+    registar_alteracoes(session, Marcacao, ALTERACAO_ELIMINADA, [campos_linha(marcacao)])
+    session.delete(marcacao)
+    session.commit()
+    publicar_alteracoes(Marcacao)
+    return {"mensagem": "Marcação eliminado com sucesso"}
 
 
 
@@ -417,231 +3519,1524 @@ def eliminar_marcacao(marcacao_id: uuid.UUID):
 #### SERVIÇO API ENDPOINTS ####
 
 @app.post("/servicos", response_model=Servico)
-def criar_servico(servico: Servico):
-    with Session(engine) as session:
-        session.add(servico)
-        session.commit()
-        session.refresh(servico)
-        return servico
+def criar_servico(servico: Servico, session: DBSession):
+    servico = validar(Servico, servico)
+    session.add(servico)
+    session.commit()
+    invalidar_cache(Servico)
+    session.refresh(servico)
+    return servico
 
 
-@app.get("/servicos", response_model=List[Servico])
-def listar_servico():
-    with Session(engine) as session:
-        return session.exec(select(Servico)).all()
+@app.get("/servicos", response_model=Pagina[Servico])
+def listar_servico(
+    request: Request,
+    session: DBSession,
+    lista: Annotated[Listagem, Depends(parametros_lista(Servico))],
+    limit: Limite = LIMITE_PADRAO,
+    after: Cursor = None,
+):
+    def carregar():
+        return paginar(session, Servico, limit, after, lista)
+
+    return resposta_em_cache(request, Servico, carregar)
 
 
 @app.get("/servicos/{servico_id}", response_model=Servico)
-def buscar_servico(servico_id: uuid.UUID):
-    with Session(engine) as session:
+def buscar_servico(request: Request, servico_id: uuid.UUID, session: DBSession):
+    def carregar():
         servico = session.get(Servico, servico_id)
         if not servico:
             raise HTTPException(status_code=404, detail="Serviço não encontrado")
         return servico
 
+    return resposta_em_cache(request, Servico, carregar)
+
+
+ServicoParcial = modelo_parcial(Servico)
+
+
+def gravar_alteracoes_servico(session: Session, servico_id: uuid.UUID, alteracoes: dict, versao: Optional[int]):
+    # o preço antigo é preciso para propagar a diferença aos totais das consultas
+    preco_antigo = None
+    if alteracoes.get("preco") is not None:
+        preco_antigo = session.execute(select(Servico.preco).where(Servico.id == servico_id)).scalar()
+    linha = atualizar_linha(session, Servico, servico_id, alteracoes, versao, "Serviço não encontrado")
+    if preco_antigo is not None:
+        ajustar_totais_servico(session, servico_id, linha["preco"] - preco_antigo)
+    session.commit()
+    invalidar_cache(Servico)
+    return responder(linha)
+
 
 @app.put("/servicos/{servico_id}", response_model=Servico)
-def atualizar_servico(servico_id: uuid.UUID, dados: Servico):
-    with Session(engine) as session:
-        servico = session.get(Servico, servico_id)
-        if not servico:
-            raise HTTPException(status_code=404, detail="Serviço não encontrado")
+def atualizar_servico(request: Request, servico_id: uuid.UUID, dados: Servico, session: DBSession):
+    alteracoes, versao = pedido_put(request, Servico, dados)
+    return gravar_alteracoes_servico(session, servico_id, alteracoes, versao)
 
-        servico.nome_servico = dados.nome_servico
-        servico.descricao = dados.descricao 
-        servico. preco = dados.preco
-        
-        session.add(servico)
-        session.commit()
-        session.refresh(servico)
-        return servico
+
+@app.patch("/servicos/{servico_id}", response_model=Servico)
+def alterar_servico(request: Request, servico_id: uuid.UUID, dados: ServicoParcial, session: DBSession):
+    alteracoes, versao = pedido_patch(request, dados)
+    return gravar_alteracoes_servico(session, servico_id, alteracoes, versao)
 
 
 @app.delete("/servicos/{servico_id}")
-def eliminar_servico(servico_id: uuid.UUID):
-    with Session(engine) as session:
-        a = session.get(Servico, servico_id)
-        if not a:
-            raise HTTPException(status_code=404, detail="Serviço não encontrado")
+def eliminar_servico(servico_id: uuid.UUID, session: DBSession):
+    a = session.get(Servico, servico_id)
+    if not a:
+        raise HTTPException(status_code=404, detail="Serviço não encontrado")
 
-        session.delete(a)
-        session.commit()
-        return {"mensagem": "Serviço eliminado com sucesso"}
+    ajustar_totais_servico(session, servico_id, -a.preco)
+    session.delete(a)
+    session.commit()
+    invalidar_cache(Servico)
+    return {"mensagem": "Serviço eliminado com sucesso"}
 
 
 
 ## CONSULTA API ENDPOINTS ##
 
 @app.post("/consultas", response_model=Consulta)
-def criar_Consulta(consulta: Consulta):
-    with Session(engine) as session:
-        session.add(consulta)
-        session.commit()
-        session.refresh(consulta)
-        return consulta
-
-
-@app.get("/consultas", response_model=List[Consulta])
-def listar_consulta():
-    with Session(engine) as session:
-        return session.exec(select(Consulta)).all()
+def criar_Consulta(consulta: Consulta, session: DBSession):
+    consulta = validar(Consulta, consulta)
+    atualizar_resumos(session, Consulta, [consulta.id], -1)
+    session.add(consulta)
+    session.flush()
+    atualizar_resumos(session, Consulta, [consulta.id], 1)
+    session.commit()
+    session.refresh(consulta)
+    return consulta
+
+
+@app.get("/consultas", response_model=Pagina[Consulta])
+def listar_consulta(
+    session: DBSession,
+    lista: Annotated[Listagem, Depends(parametros_lista(Consulta))],
+    limit: Limite = LIMITE_PADRAO,
+    after: Cursor = None,
+):
+    return responder(paginar(session, Consulta, limit, after, lista))
 
 
 @app.get("/consultas/{consulta_id}", response_model=Consulta)
-def buscar_consulta(consulta_id: uuid.UUID):
-    with Session(engine) as session:
-        consulta = session.get(Consulta, consulta_id)
-        if not consulta:
-            raise HTTPException(status_code=404, detail="Consulta não encontrado")
-        return consulta
-
-
-@app.put("/consultas/{consulta_id}", response_model=Consulta)
-def atualizar_consulta(consulta_id: uuid.UUID, dados: Consulta):
-    with Session(engine) as session:
-        consulta = session.get(Consulta, consulta_id)
-        if not consulta:
-            raise HTTPException(status_code=404, detail="Consulta não encontrado")
-
-        consulta.data_consulta = dados.data_consulta
-        consulta.hora_consulta = dados.hora_consulta 
-        consulta. marcacao_id = dados.marcacao_id
-        consulta. paciente_id = dados.paciente_id
-        consulta. medico_id = dados.medico_id
-        consulta. servico_id = dados.servico_id
-
-        session.add(consulta)
-        session.commit()
-        session.refresh(consulta)
-        return consulta
+def buscar_consulta(consulta_id: uuid.UUID, session: DBSession):
+    consulta = session.get(Consulta, consulta_id) or buscar_arquivado(session.connection(), Consulta, consulta_id)
+    if not consulta:
+        raise HTTPException(status_code=404, detail="Consulta não encontrado")
+    return responder(consulta)
 
 
-@app.delete("/consultas/{consulta_id}")
-def eliminar_consulta(consulta_id: uuid.UUID):
-    with Session(engine) as session:
-        consulta = session.get(Consulta, consulta_id)
-        if not consulta:
-            raise HTTPException(status_code=404, detail="Consulta não encontrado")
+ConsultaParcial = modelo_parcial(Consulta)
 
-        session.delete(consulta)
-        session.commit()
-        return {"mensagem": "Consulta eliminado com sucesso"}
 
+@app.put("/consultas/{consulta_id}", response_model=Consulta)
+def atualizar_consulta(request: Request, consulta_id: uuid.UUID, dados: Consulta, session: DBSession):
+    alteracoes, versao = pedido_put(request, Consulta, dados)
+    return gravar_alteracoes(session, Consulta, consulta_id, alteracoes, versao, "Consulta não encontrado")
 
 
-        #### CONSULTA_SERVIÇO API ENDPOINT ####
+@app.patch("/consultas/{consulta_id}", response_model=Consulta)
+def alterar_consulta(request: Request, consulta_id: uuid.UUID, dados: ConsultaParcial, session: DBSession):
+    alteracoes, versao = pedido_patch(request, dados)
+    return gravar_alteracoes(session, Consulta, consulta_id, alteracoes, versao, "Consulta não encontrado")
 
 
-# @app.post("/consulta_servico", response_model=Consulta_Servico)
-# def criar_Consulta(consulta_servico: Consulta_Servico):
-#     with Session(engine) as session:
-#         session.add(consulta_servico)
-#         session.commit()
-#         session.refresh(consulta_servico)
-#         return consulta_servico
+@app.delete("/consultas/{consulta_id}")
+def eliminar_consulta(consulta_id: uuid.UUID, session: DBSession):
+    consulta = session.get(Consulta, consulta_id)
+    if not consulta:
+        raise HTTPException(status_code=404, detail="Consulta não encontrado")
+
+    atualizar_resumos(session, Consulta, [consulta_id], -1)
+    session.delete(consulta)
+    session.flush()
+    # os pagamentos desta consulta passam para o balde sem médico
+    atualizar_resumos(session, Consulta, [consulta_id], 1)
+    session.commit()
+    return {"mensagem": "Consulta eliminado com sucesso"}
+
+
+
+    #### CONSULTA_SERVIÇO API ENDPOINT ####
+
+# Cada linha altera o total guardado na sua consulta com um UPDATE por delta
+# (quantidade * preço), na mesma transação que a própria linha, em vez de se
+# recalcular a fatura a partir de todas as linhas.
+
+def ajustar_total_consulta(session: Session, consulta_id: uuid.UUID, servico_id: uuid.UUID, quantidade: int):
+    servico = session.get(Servico, servico_id)
+    if not servico:
+        raise HTTPException(status_code=404, detail="Serviço não encontrado")
+    session.exec(
+        update(Consulta)
+        .where(Consulta.id == consulta_id)
+        .values(total=func.round(Consulta.total + quantidade * servico.preco, 2))
+    )
+
+
+def ajustar_totais_servico(session: Session, servico_id: uuid.UUID, delta_preco: float):
+    # propaga uma alteração de preço às consultas que usam o serviço
+    if not delta_preco:
+        return
+    quantidade = (
+        select(func.sum(ConsultaService.quantidade))
+        .where(
+            ConsultaService.consulta_id == Consulta.id,
+            ConsultaService.servico_id == servico_id,
+        )
+        .scalar_subquery()
+    )
+    session.exec(
+        update(Consulta)
+        .where(Consulta.id.in_(
+            select(ConsultaService.consulta_id).where(ConsultaService.servico_id == servico_id)
+        ))
+        .values(total=func.round(Consulta.total + delta_preco * quantidade, 2))
+    )
+
+
+def recalcular_totais(session: Session):
+    # reconstrução completa, para recuperar de dados importados fora da API
+    soma = (
+        select(func.coalesce(func.sum(ConsultaService.quantidade * Servico.preco), 0))
+        .join(Servico, Servico.id == ConsultaService.servico_id)
+        .where(ConsultaService.consulta_id == Consulta.id)
+        .scalar_subquery()
+    )
+    session.exec(update(Consulta).values(total=func.round(soma, 2)))
+
+
+@app.post("/consulta_servico", response_model=ConsultaService)
+def criar_consulta_servico(consulta_servico: ConsultaService, session: DBSession):
+    consulta_servico = validar(ConsultaService, consulta_servico)
+    if not session.get(Consulta, consulta_servico.consulta_id):
+        raise HTTPException(status_code=404, detail="Consulta não encontrado")
+
+    session.add(consulta_servico)
+    ajustar_total_consulta(
+        session, consulta_servico.consulta_id, consulta_servico.servico_id, consulta_servico.quantidade
+    )
+    session.commit()
+    session.refresh(consulta_servico)
+    return consulta_servico
+
+
+@app.get("/consulta_servico", response_model=Pagina[ConsultaService])
+def listar_consulta_servico(
+    session: DBSession,
+    lista: Annotated[Listagem, Depends(parametros_lista(ConsultaService))],
+    limit: Limite = LIMITE_PADRAO,
+    after: Cursor = None,
+):
+    return responder(paginar(session, ConsultaService, limit, after, lista))
+
+
+@app.get("/consulta_servico/{consulta_servico_id}", response_model=ConsultaService)
+def buscar_consulta_servico(consulta_servico_id: uuid.UUID, session: DBSession):
+    consulta_servico = session.get(ConsultaService, consulta_servico_id) or buscar_arquivado(session.connection(), ConsultaService, consulta_servico_id)
+    if not consulta_servico:
+        raise HTTPException(status_code=404, detail="Consulta_servico não encontrado")
+    return responder(consulta_servico)
+
+
+ConsultaServiceParcial = modelo_parcial(ConsultaService)
+
+
+def gravar_alteracoes_consulta_servico(session: Session, consulta_servico_id: uuid.UUID, alteracoes: dict, versao: Optional[int]):
+    if "consulta_id" in alteracoes and not session.get(Consulta, alteracoes["consulta_id"]):
+        raise HTTPException(status_code=404, detail="Consulta não encontrado")
+
+    # retira a linha antiga do total e soma a nova; o UPDATE devolve a nova,
+    # a antiga vem do SELECT feito antes
+    antiga = session.execute(
+        select(ConsultaService.consulta_id, ConsultaService.servico_id, ConsultaService.quantidade)
+        .where(ConsultaService.id == consulta_servico_id)
+    ).first()
+    linha = atualizar_linha(session, ConsultaService, consulta_servico_id, alteracoes, versao, "Consulta_Serviço não encontrado")
+    ajustar_total_consulta(session, antiga.consulta_id, antiga.servico_id, -antiga.quantidade)
+    ajustar_total_consulta(session, linha["consulta_id"], linha["servico_id"], linha["quantidade"])
+    session.commit()
+    return responder(linha)
+
+
+@app.put("/consulta_servico/{consulta_servico_id}", response_model=ConsultaService)
+def atualizar_consulta_servico(request: Request, consulta_servico_id: uuid.UUID, dados: ConsultaService, session: DBSession):
+    alteracoes, versao = pedido_put(request, ConsultaService, dados)
+    return gravar_alteracoes_consulta_servico(session, consulta_servico_id, alteracoes, versao)
+
+
+@app.patch("/consulta_servico/{consulta_servico_id}", response_model=ConsultaService)
+def alterar_consulta_servico(request: Request, consulta_servico_id: uuid.UUID, dados: ConsultaServiceParcial, session: DBSession):
+    alteracoes, versao = pedido_patch(request, dados)
+    return gravar_alteracoes_consulta_servico(session, consulta_servico_id, alteracoes, versao)
+
+
+@app.delete("/consulta_servico/{consulta_servico_id}")
+def eliminar_consulta_servico(consulta_servico_id: uuid.UUID, session: DBSession):
+    consulta_servico = session.get(ConsultaService, consulta_servico_id)
+    if not consulta_servico:
+        raise HTTPException(status_code=404, detail="Consulta_Serviço não encontrado")
+
+    ajustar_total_consulta(
+        session, consulta_servico.consulta_id, consulta_servico.servico_id, -consulta_servico.quantidade
+    )
+    session.delete(consulta_servico)
+    session.commit()
+    return {"mensagem": "Consulta_Serviço eliminado com sucesso"}
+
+
+
+    #### FATURAS API ENDPOINTS ####
+
+class LinhaFatura(BaseModel):
+    servico_id: uuid.UUID
+    nome_servico: str
+    preco_unitario: float
+    quantidade: int
+    subtotal: float
+
+
+class Fatura(BaseModel):
+    consulta_id: uuid.UUID
+    data_consulta: date
+    paciente_id: uuid.UUID
+    medico_id: uuid.UUID
+    linhas: List[LinhaFatura]
+    total: float
+
+
+class ResumoFatura(BaseModel):
+    consulta_id: uuid.UUID
+    data_consulta: date
+    paciente_id: uuid.UUID
+    medico_id: uuid.UUID
+    total: float
+
+
+def linhas_fatura(ligacao, consulta_id: uuid.UUID, consulta=Consulta.__table__, linha=ConsultaService.__table__):
+    # consulta, linhas e preços numa só consulta com joins; o catálogo de
+    # serviços só existe no ficheiro principal, também para as consultas arquivadas
+    return ligacao.execute(
+        select(
+            consulta.c.data_consulta,
+            consulta.c.paciente_id,
+            consulta.c.medico_id,
+            linha.c.servico_id,
+            linha.c.quantidade,
+            Servico.nome_servico,
+            Servico.preco,
+        )
+        .select_from(consulta)
+        .outerjoin(linha, linha.c.consulta_id == consulta.c.id)
+        .outerjoin(Servico, Servico.id == linha.c.servico_id)
+        .where(consulta.c.id == consulta_id)
+        .order_by(linha.c.id)
+    ).all()
+
+
+@app.get("/consultas/{consulta_id}/fatura", response_model=Fatura)
+def fatura_consulta(consulta_id: uuid.UUID, session: DBSession):
+    ligacao = session.connection()
+    linhas = linhas_fatura(ligacao, consulta_id)
+    if not linhas and ler_limite_arquivo(ligacao) is not None:
+        # a consulta e as suas linhas são arquivadas juntas
+        linhas = linhas_fatura(ligacao, consulta_id, TABELAS_ARQUIVO[Consulta], TABELAS_ARQUIVO[ConsultaService])
+    if not linhas:
+        raise HTTPException(status_code=404, detail="Consulta não encontrado")
+
+    itens = [
+        LinhaFatura(
+            servico_id=l.servico_id,
+            nome_servico=l.nome_servico,
+            preco_unitario=l.preco,
+            quantidade=l.quantidade,
+            subtotal=round(l.quantidade * l.preco, 2),
+        )
+        for l in linhas if l.servico_id is not None and l.preco is not None
+    ]
+    primeira = linhas[0]
+    return Fatura(
+        consulta_id=consulta_id,
+        data_consulta=primeira.data_consulta,
+        paciente_id=primeira.paciente_id,
+        medico_id=primeira.medico_id,
+        linhas=itens,
+        total=round(sum(item.subtotal for item in itens), 2),
+    )
+
+
+@app.get("/faturas", response_model=Pagina[ResumoFatura])
+def listar_faturas(
+    session: DBSession,
+    de: Optional[date] = None,
+    ate: Optional[date] = None,
+    limit: Limite = LIMITE_PADRAO,
+    after: Cursor = None,
+):
+    # lê o total guardado: uma consulta por página, sem somar linhas
+    consulta = (
+        select(Consulta.id, Consulta.data_consulta, Consulta.paciente_id, Consulta.medico_id, Consulta.total)
+        .order_by(Consulta.id)
+        .limit(limit + 1)
+    )
+    if de:
+        consulta = consulta.where(Consulta.data_consulta >= de)
+    if ate:
+        consulta = consulta.where(Consulta.data_consulta <= ate)
+    if after is not None:
+        consulta = consulta.where(Consulta.id > after)
+
+    ligacao = session.connection()
+    if (de or ate) and alcanca_arquivo(ligacao, de):
+        linhas = juntar_com_arquivo(ligacao, consulta, ["id"], maximo=limit + 1)
+    else:
+        linhas = ligacao.execute(consulta).mappings().all()
+
+    next_cursor = None
+    if len(linhas) > limit:
+        linhas = linhas[:limit]
+        next_cursor = linhas[-1]["id"]
+    itens = [
+        ResumoFatura(
+            consulta_id=l["id"],
+            data_consulta=l["data_consulta"],
+            paciente_id=l["paciente_id"],
+            medico_id=l["medico_id"],
+            total=l["total"],
+        )
+        for l in linhas
+    ]
+    return responder(Pagina(items=itens, next_cursor=next_cursor))
+
+
+@app.post("/faturas/recalcular")
+def recalcular_faturas(session: DBSession):
+    recalcular_totais(session)
+    session.commit()
+    return {"mensagem": "Totais recalculados com sucesso"}
+
+
+
+
+    #### PAGAMENTO API ENDPOINTS ####
 
 
-# @app.get("/consulta_servico", response_model=List[Consulta_Servico])
-# def listar_consulta_servico():
-#     with Session(engine) as session:
-#         return session.exec(select(Consulta_Servico)).all()
+@app.post("/pagamentos", response_model=Pagamento)
+def criar_pagamento(pagamento: Pagamento, session: DBSession, idempotency_key: ChaveIdempotencia = None):
+    pagamento = validar(Pagamento, pagamento)
+    if idempotency_key:
+        repetida = reservar_pedido(session, Pagamento, idempotency_key, pagamento)
+        if repetida is not None:
+            return repetida
+    session.add(pagamento)
+    session.flush()
+    atualizar_resumos(session, Pagamento, [pagamento.id], 1)
+    session.commit()
+    session.refresh(pagamento)
+    return pagamento
+
+
+@app.get("/pagamentos", response_model=Pagina[Pagamento])
+def listar_pagamento(
+    session: DBSession,
+    lista: Annotated[Listagem, Depends(parametros_lista(Pagamento))],
+    limit: Limite = LIMITE_PADRAO,
+    after: Cursor = None,
+):
+    return responder(paginar(session, Pagamento, limit, after, lista))
 
 
-# @app.get("/consulta_serviso/{consulta_servico_id}", response_model=Consulta_Servico)
-# def buscar_consulta_servico(consulta_servico_id: uuid.UUID):
-#     with Session(engine) as session:
-#         consulta_servico = session.get(Consulta_Servico, consulta_servico_id)
-#         if not consulta_servico:
-#             raise HTTPException(status_code=404, detail="Consulta_servico não encontrado")
-#         return consulta_servico
+@app.get("/pagamentos/{pagamento_id}", response_model=Pagamento)
+def buscar_pagamento(pagamento_id: uuid.UUID, session: DBSession):
+    pagamento_db = session.get(Pagamento, pagamento_id) or buscar_arquivado(session.connection(), Pagamento, pagamento_id)
+    if not pagamento_db:
+        raise HTTPException(status_code=404, detail="Pagamento não encontrado")
+    return responder(pagamento_db)
 
+PagamentoParcial = modelo_parcial(Pagamento)
 
-# @app.put("/consulta_servico/{consulta_servico_id}", response_model=Consulta_Servico)
-# def atualizar_consulta_servico(consulta_servico_id: uuid.UUID, dados: Consulta_Servico):
-#     with Session(engine) as session:
-#         consulta_servico = session.get(Consulta_Servico, consulta_servico_id)
-#         if not consulta_servico:
-#             raise HTTPException(status_code=404, detail="Consulta_Serviço não encontrado")
 
-#         consulta_servico.consulta_id = dados.consulta_id
-#         consulta_servico.servico_id = dados.servico_id 
-#         consulta_servico. quantidade = dados.quantidade
-        
-#         session.add(consulta_servico)
-#         session.commit()
-#         session.refresh(consulta_servico)
-#         return consulta_servico
+@app.put("/pagamentos/{pagamento_id}", response_model=Pagamento)
+def atualizar_pagamento(request: Request, pagamento_id: uuid.UUID, dados: Pagamento, session: DBSession):
+    alteracoes, versao = pedido_put(request, Pagamento, dados)
+    return gravar_alteracoes(session, Pagamento, pagamento_id, alteracoes, versao, "Pagamentos não encontrado")
 
 
-# @app.delete("/consulta_servico/{consulta_servico_id}")
-# def eliminar_consulta_servico(consulta_servico_id: uuid.UUID):
-#     with Session(engine) as session:
-#         consulta_servico = session.get(Consulta_Serviço, consulta_servico_id)
-#         if not consulta_servico:
-#             raise HTTPException(status_code=404, detail="Consulta_Serviço não encontrado")
+@app.patch("/pagamentos/{pagamento_id}", response_model=Pagamento)
+def alterar_pagamento(request: Request, pagamento_id: uuid.UUID, dados: PagamentoParcial, session: DBSession):
+    alteracoes, versao = pedido_patch(request, dados)
+    return gravar_alteracoes(session, Pagamento, pagamento_id, alteracoes, versao, "Pagamentos não encontrado")
 
-#         session.delete(consulta_servico)
-#         session.commit()
-#         return {"mensagem": "Consulta_Serviço eliminado com sucesso"}
 
+@app.delete("/pagamentos/{pagamento_id}")
+def eliminar_pagamento(pagamento_id: uuid.UUID, session: DBSession):
+    pagamento = session.get(Pagamento, pagamento_id)
+    if not pagamento:
+        raise HTTPException(status_code=404, detail="Pagamento não encontrado")
+
+    atualizar_resumos(session, Pagamento, [pagamento_id], -1)
+    session.delete(pagamento)
+    session.commit()
+    return {"mensagem": "Pagamento eliminado com sucesso"}
+
+
+
+    #### RELATÓRIOS API ENDPOINTS ####
+
+# Os relatórios leem as tabelas ResumoReceita e ResumoConsultas, com uma linha
+# por dia e dimensão, por isso custam O(baldes) e não O(pagamentos). As tabelas
+# são mantidas na mesma transação que cada escrita: antes de alterar um registo
+# retira-se a sua contribuição (sinal -1) e depois do flush volta a somar-se
+# (sinal +1), com um INSERT ... SELECT ... ON CONFLICT DO UPDATE. As criações
+# fazem o mesmo: um médico ou uma consulta novos podem já ter consultas ou
+# pagamentos a apontar para eles (no balde sem médico/especialidade). Em caso de
+# dúvida, reconstruir_resumos refaz tudo a partir das tabelas de origem
+# (POST /relatorios/reconstruir ou "python gerir.py reconstruir-resumos").
+
+# balde dos pagamentos cuja consulta já não existe
+SEM_MEDICO = uuid.UUID(int=0)
+SEM_ESPECIALIDADE = ""
+
+
+def selecionar_receita(condicao=None, sinal: int = 1, pagamento=Pagamento.__table__, consulta=Consulta.__table__):
+    medico = func.coalesce(consulta.c.medico_id, SEM_MEDICO)
+    instrucao = (
+        select(
+            pagamento.c.data_pagamento,
+            pagamento.c.metodo_pagamento,
+            pagamento.c.estado_pagamento,
+            medico,
+            sinal * func.sum(pagamento.c.valor_pagamento),
+            sinal * func.count(),
+        )
+        .select_from(pagamento)
+        .outerjoin(consulta, consulta.c.id == pagamento.c.consulta_id)
+        .group_by(
+            pagamento.c.data_pagamento,
+            pagamento.c.metodo_pagamento,
+            pagamento.c.estado_pagamento,
+            medico,
+        )
+    )
+    # o WHERE é obrigatório antes do ON CONFLICT num INSERT ... SELECT no SQLite
+    return instrucao.where(condicao if condicao is not None else literal(True))
+
+
+def selecionar_consultas(condicao=None, sinal: int = 1, consulta=Consulta.__table__):
+    especialidade = func.coalesce(Medico.especialidade, SEM_ESPECIALIDADE)
+    instrucao = (
+        select(consulta.c.data_consulta, especialidade, sinal * func.count())
+        .select_from(consulta)
+        .outerjoin(Medico, Medico.id == consulta.c.medico_id)
+        .group_by(consulta.c.data_consulta, especialidade)
+    )
+    return instrucao.where(condicao if condicao is not None else literal(True))
+
+
+COLUNAS_RESUMO_RECEITA = ["dia", "metodo_pagamento", "estado_pagamento", "medico_id", "total", "quantidade"]
+COLUNAS_RESUMO_CONSULTAS = ["dia", "especialidade", "quantidade"]
+
+
+def somar_resumo(ligacao, instrucao, chaves: List[str], sinal: int):
+    # ao retirar, os baldes que ficam sem registos são apagados, como se
+    # nunca tivessem existido (reconstruir_resumos também não os cria)
+    tabela = instrucao.table
+    if sinal > 0:
+        ligacao.execute(instrucao)
+        return
+    colunas = [tabela.c[c] for c in chaves]
+    vazios = [
+        tuple(linha[:-1])
+        for linha in ligacao.execute(instrucao.returning(*colunas, tabela.c.quantidade))
+        if linha[-1] == 0
+    ]
+    if vazios:
+        ligacao.execute(delete(tabela).where(tuple_(*colunas).in_(vazios)))
+
+
+def somar_receita(ligacao, condicao, sinal: int, **tabelas):
+    tabela = ResumoReceita.__table__
+    chaves = ["dia", "metodo_pagamento", "estado_pagamento", "medico_id"]
+    instrucao = sqlite_insert(tabela).from_select(COLUNAS_RESUMO_RECEITA, selecionar_receita(condicao, sinal, **tabelas))
+    somar_resumo(ligacao, instrucao.on_conflict_do_update(
+        index_elements=chaves,
+        set_={
+            "total": func.round(tabela.c.total + instrucao.excluded.total, 2),
+            "quantidade": tabela.c.quantidade + instrucao.excluded.quantidade,
+        },
+    ), chaves, sinal)
+
+
+def somar_consultas(ligacao, condicao, sinal: int, **tabelas):
+    tabela = ResumoConsultas.__table__
+    chaves = ["dia", "especialidade"]
+    instrucao = sqlite_insert(tabela).from_select(COLUNAS_RESUMO_CONSULTAS, selecionar_consultas(condicao, sinal, **tabelas))
+    somar_resumo(ligacao, instrucao.on_conflict_do_update(
+        index_elements=chaves,
+        set_={"quantidade": tabela.c.quantidade + instrucao.excluded.quantidade},
+    ), chaves, sinal)
+
+
+# campos de cada modelo que mudam o balde de um resumo; alterar outros campos
+# não obriga a retirar e voltar a somar a contribuição do registo
+CAMPOS_RESUMO = {
+    Pagamento: {"valor_pagamento", "metodo_pagamento", "data_pagamento", "estado_pagamento", "consulta_id"},
+    Consulta: {"data_consulta", "medico_id"},
+    Medico: {"especialidade"},
+}
+
+
+def atualizar_resumos(ligacao, modelo, ids: list, sinal: int):
+    """Soma (sinal=1) ou retira (sinal=-1) a contribuição dos registos `ids`."""
+    if modelo is Pagamento:
+        somar_receita(ligacao, Pagamento.id.in_(ids), sinal)
+    elif modelo is Consulta:
+        somar_consultas(ligacao, Consulta.id.in_(ids), sinal)
+        # o médico da receita vem da consulta
+        somar_receita(ligacao, Pagamento.consulta_id.in_(ids), sinal)
+    elif modelo is Medico:
+        # a especialidade vem do médico, também para as consultas arquivadas
+        somar_consultas(ligacao, Consulta.medico_id.in_(ids), sinal)
+        arquivadas = TABELAS_ARQUIVO[Consulta]
+        somar_consultas(ligacao, arquivadas.c.medico_id.in_(ids), sinal, consulta=arquivadas)
+
+
+def reconstruir_resumos(ligacao):
+    ligacao.execute(delete(ResumoReceita))
+    ligacao.execute(delete(ResumoConsultas))
+    ligacao.execute(insert(ResumoReceita.__table__).from_select(COLUNAS_RESUMO_RECEITA, selecionar_receita()))
+    ligacao.execute(insert(ResumoConsultas.__table__).from_select(COLUNAS_RESUMO_CONSULTAS, selecionar_consultas()))
+    # o arquivo guarda grupos completos (consulta, pagamentos), por isso junta-se cada ficheiro consigo próprio
+    somar_receita(ligacao, None, 1, pagamento=TABELAS_ARQUIVO[Pagamento], consulta=TABELAS_ARQUIVO[Consulta])
+    somar_consultas(ligacao, None, 1, consulta=TABELAS_ARQUIVO[Consulta])
+
+
+class AgrupamentoReceita(str, Enum):
+    DIA = "dia"
+    MES = "mes"
+    METODO = "metodo"
+    MEDICO = "medico"
 
 
-        #### PAGAMENTO API ENDPOINTS ####
+class AgrupamentoConsultas(str, Enum):
+    ESPECIALIDADE = "especialidade"
+    DIA = "dia"
+    MES = "mes"
+
+
+class LinhaRelatorio(BaseModel):
+    chave: str
+    total: Optional[float] = None
+    quantidade: int
+
+
+@app.get("/relatorios/receita", response_model=List[LinhaRelatorio])
+def relatorio_receita(
+    session: DBSession,
+    agrupar: AgrupamentoReceita = AgrupamentoReceita.DIA,
+    de: Optional[date] = None,
+    ate: Optional[date] = None,
+    estado: Optional[str] = None,
+):
+    chaves = {
+        AgrupamentoReceita.DIA: ResumoReceita.dia,
+        AgrupamentoReceita.MES: func.strftime("%Y-%m", ResumoReceita.dia),
+        AgrupamentoReceita.METODO: ResumoReceita.metodo_pagamento,
+        AgrupamentoReceita.MEDICO: ResumoReceita.medico_id,
+    }
+    chave = chaves[agrupar]
+    consulta = (
+        select(chave, func.sum(ResumoReceita.total), func.sum(ResumoReceita.quantidade))
+        .group_by(chave)
+        .having(func.sum(ResumoReceita.quantidade) != 0)
+        .order_by(chave)
+    )
+    if de:
+        consulta = consulta.where(ResumoReceita.dia >= de)
+    if ate:
+        consulta = consulta.where(ResumoReceita.dia <= ate)
+    if estado:
+        consulta = consulta.where(ResumoReceita.estado_pagamento == estado)
+
+    return [
+        LinhaRelatorio(chave=str(c), total=round(t or 0, 2), quantidade=q)
+        for c, t, q in session.exec(consulta).all()
+    ]
+
+
+@app.get("/relatorios/consultas", response_model=List[LinhaRelatorio])
+def relatorio_consultas(
+    session: DBSession,
+    agrupar: AgrupamentoConsultas = AgrupamentoConsultas.ESPECIALIDADE,
+    de: Optional[date] = None,
+    ate: Optional[date] = None,
+):
+    chaves = {
+        AgrupamentoConsultas.ESPECIALIDADE: ResumoConsultas.especialidade,
+        AgrupamentoConsultas.DIA: ResumoConsultas.dia,
+        AgrupamentoConsultas.MES: func.strftime("%Y-%m", ResumoConsultas.dia),
+    }
+    chave = chaves[agrupar]
+    consulta = (
+        select(chave, func.sum(ResumoConsultas.quantidade))
+        .group_by(chave)
+        .having(func.sum(ResumoConsultas.quantidade) != 0)
+        .order_by(chave)
+    )
+    if de:
+        consulta = consulta.where(ResumoConsultas.dia >= de)
+    if ate:
+        consulta = consulta.where(ResumoConsultas.dia <= ate)
+
+    return [LinhaRelatorio(chave=str(c), quantidade=q) for c, q in session.exec(consulta).all()]
+
+
+@app.post("/relatorios/reconstruir")
+def reconstruir_relatorios(session: DBSession):
+    reconstruir_resumos(session.connection())
+    session.commit()
+    return {"mensagem": "Resumos reconstruídos com sucesso"}
+
+
+
+        #### CACHE API ENDPOINTS ####
+
+@app.get("/cache/estatisticas")
+def estatisticas_cache():
+    return cache_referencia.estatisticas()
+
+
+
+
+        #### TAREFAS API ENDPOINTS ####
 
+@app.on_event("startup")
+async def iniciar_tarefas():
+    if TAREFAS_ATIVAS:
+        agendador_tarefas.iniciar()
 
-@app.post("/pagamentos", response_model=Pagamento)
-def criar_pagamento(pagamento: Pagamento):
-    with Session(engine) as session:
-        session.add(pagamento)
-        session.commit()
-        session.refresh(pagamento)
-        return pagamento
 
+@app.on_event("shutdown")
+async def parar_tarefas():
+    await agendador_tarefas.terminar()
 
-@app.get("/pagamentos", response_model=list[Pagamento])
-def listar_pagamento():
-    with Session(engine) as session:
-        return session.exec(select(Pagamento)).all()
 
+@app.get("/tarefas", response_model=List[ExecucaoTarefa])
+def listar_execucoes(
+    session: DBSession,
+    tarefa: Optional[str] = None,
+    limit: Annotated[int, Query(ge=1, le=LIMITE_MAXIMO)] = LIMITE_PADRAO,
+):
+    consulta = select(ExecucaoTarefa).order_by(ExecucaoTarefa.id.desc()).limit(limit)
+    if tarefa is not None:
+        consulta = consulta.where(ExecucaoTarefa.tarefa == tarefa)
+    return session.exec(consulta).all()
 
-@app.get("/pagamentos/{pagamento_id}", response_model=Pagamento)
-def buscar_pagamento(pagamento_id: uuid.UUID):
-    with Session(engine) as session:
-        pagamento_db = session.get(Pagamento, pagamento_id)
-        if not pagamento_db:
-            raise HTTPException(status_code=404, detail="Pagamento não encontrado")
-        return pagamento_db
 
-@app.put("/pagamentos/{pagamento_id}", response_model=Pagamento)
-def atualizar_pagamento(pagamento_id: uuid.UUID, dados: Pagamento):
-    with Session(engine) as session:
-        pagamento = session.get(Pagamento, pagamento_id)
-        if not pagamento:
-            raise HTTPException(status_code=404, detail="Pagamentos não encontrado")
-
-        pagamento.valor_pagamento  = dados.valor_pagamento
-        pagamento.metodo_pagamento = dados.metodo_pagamento 
-        pagamento.data_pagamento = dados.data_pagamento
-        pagamento.estado = dados.estado
-        pagamento.paciente_id = dados.paciente_id
-        pagamento.consulta_id = dados.consulta_id
-
-        session.add(pagamento)
-        session.commit()
-        session.refresh(pagamento)
-        return pagamento
+@app.get("/tarefas/{execucao_id}", response_model=ExecucaoTarefa)
+def buscar_execucao(execucao_id: int, session: DBSession):
+    execucao = session.get(ExecucaoTarefa, execucao_id)
+    if not execucao:
+        raise HTTPException(status_code=404, detail="Execução não encontrada")
+    return execucao
 
 
-@app.delete("/pagamentos/{pagamento_id}")
-def eliminar_pagamento(pagamento_id: uuid.UUID):
-    with Session(engine) as session:
-        pagamento = session.get(Pagamento, pagamento_id)
-        if not pagamento:
-            raise HTTPException(status_code=404, detail="Pagamento não encontrado")
+@app.post("/tarefas/{tarefa}/executar", response_model=ExecucaoTarefa, status_code=202)
+def executar_tarefa(tarefa: str, session: DBSession, dia: Optional[date] = None):
+    """Põe a tarefa na fila para `dia` (hoje, por omissão); repete-a se já tinha corrido."""
+    if tarefa not in TAREFAS:
+        raise HTTPException(status_code=404, detail="Tarefa não encontrada")
+    execucao_id = agendar_execucao(session.connection(), tarefa, dia or date.today(), repetir=True)
+    if execucao_id is None:
+        session.rollback()
+        raise HTTPException(status_code=409, detail="A tarefa já está em curso para esse dia")
+    session.commit()
+    agendador_tarefas.avisar()
+    return session.get(ExecucaoTarefa, execucao_id)
 
-        session.delete(pagamento)
-        session.commit()
-        return {"mensagem": "Pagamento eliminado com sucesso"}
+
+
+        #### CÓPIAS API ENDPOINTS ####
+
+@app.get("/copias")
+def listar_copias_seguranca():
+    return listar_copias()
+
+
+@app.post("/copias", response_model=ExecucaoTarefa, status_code=202)
+def criar_copia_seguranca(session: DBSession):
+    """Põe na fila uma cópia de segurança, feita em segundo plano pela tarefa "copia"."""
+    return executar_tarefa("copia", session)
+
+
+@app.get("/copias/{nome}")
+def buscar_copia(nome: str):
+    try:
+        return ler_manifesto(nome)
+    except LookupError:
+        raise HTTPException(status_code=404, detail="Cópia não encontrada")
+
+
+@app.post("/copias/{nome}/verificar")
+def verificar_copia_seguranca(nome: str):
+    try:
+        return verificar_copia(nome)
+    except LookupError:
+        raise HTTPException(status_code=404, detail="Cópia não encontrada")
+
+
+
+        #### MÉTRICAS API ENDPOINTS ####
+
+# Cada pedido recebe um MetricasPedido numa ContextVar; os eventos do engine
+# (que correm na thread do handler, com uma cópia do contexto) somam-lhe as
+# instruções SQL e o tempo gasto. No fim do pedido o middleware junta tudo por
+# rota em Metricas, exposto em formato Prometheus em GET /metrics.
+# Instruções acima de SQL_LENTO_MS são registadas com o EXPLAIN QUERY PLAN.
+
+SQL_LENTO_MS = float(os.environ.get("CLINICA_SQL_LENTO_MS", 100))
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SEM_ROTA = "<sem rota>"
+
+log_sql = logging.getLogger("clinica.sql")
+
+
+class MetricasPedido:
+    def __init__(self):
+        self.instrucoes = 0
+        self.tempo_sql = 0.0
+
+
+metricas_pedido: ContextVar[Optional[MetricasPedido]] = ContextVar("metricas_pedido", default=None)
+
+
+class Metricas:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.pedidos = defaultdict(int)  # (metodo, rota, estado)
+        self.latencia = {}  # (metodo, rota) -> [contagens por bucket..., soma, total]
+        self.instrucoes = defaultdict(int)  # (metodo, rota)
+        self.tempo_sql = defaultdict(float)  # (metodo, rota)
+        self.sql_lento = 0
+        self.lock = threading.Lock()
+
+    def registar_pedido(self, metodo, rota, estado, duracao, pedido: MetricasPedido):
+        chave = (metodo, rota)
+        with self.lock:
+            self.pedidos[(metodo, rota, estado)] += 1
+            histograma = self.latencia.setdefault(chave, [0] * len(self.buckets) + [0.0, 0])
+            for i, limite in enumerate(self.buckets):
+                if duracao <= limite:
+                    histograma[i] += 1
+            histograma[-2] += duracao
+            histograma[-1] += 1
+            self.instrucoes[chave] += pedido.instrucoes
+            self.tempo_sql[chave] += pedido.tempo_sql
+
+    def registar_sql_lento(self):
+        with self.lock:
+            self.sql_lento += 1
+
+    def exportar(self):
+        def etiquetas(**valores):
+            pares = ",".join(
+                f'{nome}="{str(valor).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                for nome, valor in valores.items()
+            )
+            return "{" + pares + "}"
+
+        linhas = []
+        with self.lock:
+            linhas += [
+                "# HELP clinica_http_pedidos_total Pedidos HTTP por rota e estado.",
+                "# TYPE clinica_http_pedidos_total counter",
+            ]
+            for (metodo, rota, estado), n in sorted(self.pedidos.items()):
+                linhas.append(f"clinica_http_pedidos_total{etiquetas(metodo=metodo, rota=rota, estado=estado)} {n}")
+
+            linhas += [
+                "# HELP clinica_http_latencia_segundos Latência dos pedidos HTTP por rota.",
+                "# TYPE clinica_http_latencia_segundos histogram",
+            ]
+            for (metodo, rota), histograma in sorted(self.latencia.items()):
+                for limite, n in zip(self.buckets, histograma):
+                    linhas.append(
+                        f"clinica_http_latencia_segundos_bucket{etiquetas(metodo=metodo, rota=rota, le=limite)} {n}"
+                    )
+                linhas.append(
+                    f"clinica_http_latencia_segundos_bucket{etiquetas(metodo=metodo, rota=rota, le='+Inf')} {histograma[-1]}"
+                )
+                linhas.append(f"clinica_http_latencia_segundos_sum{etiquetas(metodo=metodo, rota=rota)} {histograma[-2]}")
+                linhas.append(f"clinica_http_latencia_segundos_count{etiquetas(metodo=metodo, rota=rota)} {histograma[-1]}")
+
+            linhas += [
+                "# HELP clinica_sql_instrucoes_total Instruções SQL executadas por rota.",
+                "# TYPE clinica_sql_instrucoes_total counter",
+            ]
+            for (metodo, rota), n in sorted(self.instrucoes.items()):
+                linhas.append(f"clinica_sql_instrucoes_total{etiquetas(metodo=metodo, rota=rota)} {n}")
+
+            linhas += [
+                "# HELP clinica_sql_segundos_total Tempo gasto em SQL por rota.",
+                "# TYPE clinica_sql_segundos_total counter",
+            ]
+            for (metodo, rota), t in sorted(self.tempo_sql.items()):
+                linhas.append(f"clinica_sql_segundos_total{etiquetas(metodo=metodo, rota=rota)} {t}")
+
+            linhas += [
+                "# HELP clinica_sql_lento_total Instruções SQL acima do limiar de lentidão.",
+                "# TYPE clinica_sql_lento_total counter",
+                f"clinica_sql_lento_total {self.sql_lento}",
+            ]
+
+        cache = cache_referencia.estatisticas()
+        linhas += [
+            "# HELP clinica_cache_hits_total Leituras servidas pela cache de referência.",
+            "# TYPE clinica_cache_hits_total counter",
+            f"clinica_cache_hits_total {cache['hits']}",
+            "# HELP clinica_cache_misses_total Leituras que foram à base de dados.",
+            "# TYPE clinica_cache_misses_total counter",
+            f"clinica_cache_misses_total {cache['misses']}",
+            "# HELP clinica_cache_entradas Entradas na cache de referência.",
+            "# TYPE clinica_cache_entradas gauge",
+            f"clinica_cache_entradas {cache['entradas']}",
+        ]
+
+        abertas = clinicas.estatisticas()
+        linhas += [
+            "# HELP clinica_clinicas_abertas Clínicas com engines abertos (com várias clínicas).",
+            "# TYPE clinica_clinicas_abertas gauge",
+            f"clinica_clinicas_abertas {abertas['abertas']}",
+            "# HELP clinica_clinicas_em_uso Clínicas com pedidos em curso.",
+            "# TYPE clinica_clinicas_em_uso gauge",
+            f"clinica_clinicas_em_uso {abertas['em_uso']}",
+        ]
+        return "\n".join(linhas) + "\n"
+
+
+metricas = Metricas(BUCKETS_LATENCIA)
+
+
+def explicar(ligacao, instrucao, parametros):
+    # só instruções DML simples; um executemany não tem um único plano
+    if not re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b", instrucao, re.IGNORECASE):
+        return None
+    try:
+        plano = ligacao.exec_driver_sql("EXPLAIN QUERY PLAN " + instrucao, parametros).all()
+    except Exception as erro:
+        return f"(sem plano: {erro})"
+    return "\n".join(f"  {linha[-1]}" for linha in plano)
+
+
+def instrumentar_engine(engine_bd):
+    @event.listens_for(engine_bd, "before_cursor_execute")
+    def _antes(ligacao, cursor, instrucao, parametros, contexto, executemany):
+        ligacao.info.setdefault("inicio_sql", []).append(relogio.perf_counter())
+
+    @event.listens_for(engine_bd, "after_cursor_execute")
+    def _depois(ligacao, cursor, instrucao, parametros, contexto, executemany):
+        inicios = ligacao.info.get("inicio_sql")
+        if not inicios:
+            return
+        duracao = relogio.perf_counter() - inicios.pop()
+        if ligacao.info.get("a_explicar"):
+            return
+
+        pedido = metricas_pedido.get()
+        if pedido is not None:
+            pedido.instrucoes += 1
+            pedido.tempo_sql += duracao
+
+        if duracao * 1000 >= SQL_LENTO_MS:
+            metricas.registar_sql_lento()
+            plano = None
+            if not executemany:
+                ligacao.info["a_explicar"] = True
+                try:
+                    plano = explicar(ligacao, instrucao, parametros)
+                finally:
+                    ligacao.info["a_explicar"] = False
+            log_sql.warning(
+                "SQL lento (%.1f ms): %s\n%s", duracao * 1000, instrucao, plano or "  (sem plano)"
+            )
+
+
+@app.middleware("http")
+async def medir_pedido(request: Request, call_next):
+    pedido = MetricasPedido()
+    token = metricas_pedido.set(pedido)
+    inicio = relogio.perf_counter()
+    estado = 500
+    try:
+        resposta = await call_next(request)
+        estado = resposta.status_code
+        return resposta
+    finally:
+        duracao = relogio.perf_counter() - inicio
+        metricas_pedido.reset(token)
+        rota = request.scope.get("route")
+        caminho = getattr(rota, "path", SEM_ROTA)
+        metricas.registar_pedido(request.method, caminho, estado, duracao, pedido)
+
+
+@app.get("/metrics")
+def exportar_metricas():
+    return Response(metricas.exportar(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+
+        #### CRIAÇÃO EM LOTE API ENDPOINTS ####
+
+# POST /{recurso}/bulk recebe um array JSON ou NDJSON (uma linha por registo).
+# Todas as linhas são validadas antes de escrever; as válidas são inseridas em
+# lotes executemany dentro de uma única transação. Cada lote corre num
+# SAVEPOINT: se falhar (por exemplo um email repetido), repete-se linha a linha
+# só esse lote para devolver o erro de cada linha sem abortar as restantes.
+
+TAMANHO_LOTE_BULK = 500
+LIMITE_LINHAS_BULK = 50_000
+
+RECURSOS_BULK = {
+    "usuarios": Usuario,
+    "pacientes": Paciente,
+    "medicos": Medico,
+    "funcionario": Funcionario,
+    "marcacao": Marcacao,
+    "servicos": Servico,
+    "consultas": Consulta,
+    "pagamentos": Pagamento,
+}
+
+
+def ler_linhas_bulk(corpo: bytes, content_type: str):
+    """Devolve [(indice, dados ou None, erro ou None)]."""
+    if "ndjson" in content_type:
+        linhas = []
+        for indice, linha in enumerate(l for l in corpo.splitlines() if l.strip()):
+            try:
+                linhas.append((indice, json.loads(linha), None))
+            except ValueError as erro:
+                linhas.append((indice, None, f"JSON inválido: {erro}"))
+        return linhas
+
+    try:
+        dados = json.loads(corpo)
+    except ValueError as erro:
+        raise HTTPException(status_code=400, detail=f"JSON inválido: {erro}")
+    if not isinstance(dados, list):
+        raise HTTPException(status_code=400, detail="O corpo deve ser um array JSON ou NDJSON")
+    return [(indice, linha, None) for indice, linha in enumerate(dados)]
+
+
+def verificar_slots_lote(session: Session, validos):
+    """Separa as marcações que cabem no horário do médico das restantes, como POST /marcacao."""
+    aceites = []
+    erros = []
+    slots = {}
+    # já dentro do BEGIN IMMEDIATE: lê com o mesmo lock de escrita
+    for indice, marcacao in validos:
+        try:
+            verificar_slot(session, marcacao, slots)
+        except HTTPException as erro:
+            erros.append({"indice": indice, "erro": erro.detail})
+            continue
+        aceites.append((indice, marcacao))
+    return aceites, erros
+
+
+def inserir_em_lote(session: Session, modelo, validos):
+    tabela = modelo.__table__
+    inseridos = []
+    erros = []
+
+    ligacao = session.connection()
+    # BEGIN explícito: sem ele o pysqlite deixaria o primeiro SAVEPOINT
+    # abrir (e o RELEASE fechar) a transação, e cada lote seria gravado à parte
+    ligacao.exec_driver_sql("BEGIN IMMEDIATE")
+    if modelo is Marcacao:
+        validos, erros = verificar_slots_lote(session, validos)
+    for inicio in range(0, len(validos), TAMANHO_LOTE_BULK):
+        lote = validos[inicio:inicio + TAMANHO_LOTE_BULK]
+        try:
+            with ligacao.begin_nested():
+                ids = [obj.id for _, obj in lote]
+                atualizar_resumos(ligacao, modelo, ids, -1)
+                ligacao.execute(insert(tabela), [obj.model_dump() for _, obj in lote])
+                atualizar_resumos(ligacao, modelo, ids, 1)
+                registar_alteracoes(ligacao, modelo, ALTERACAO_CRIADA, [campos_linha(obj) for _, obj in lote])
+            inseridos.extend(obj.id for _, obj in lote)
+        except IntegrityError:
+            for indice, obj in lote:
+                try:
+                    with ligacao.begin_nested():
+                        atualizar_resumos(ligacao, modelo, [obj.id], -1)
+                        ligacao.execute(insert(tabela), [obj.model_dump()])
+                        atualizar_resumos(ligacao, modelo, [obj.id], 1)
+                        registar_alteracoes(ligacao, modelo, ALTERACAO_CRIADA, [campos_linha(obj)])
+                    inseridos.append(obj.id)
+                except IntegrityError as erro:
+                    erros.append({"indice": indice, "erro": str(erro.orig)})
+    session.commit()
+
+    return inseridos, erros
+
+
+def validar_lote(modelo, corpo: bytes, content_type: str):
+    """Lê e valida as linhas de um pedido bulk; devolve (válidas como (índice, objeto), erros)."""
+    linhas = ler_linhas_bulk(corpo, content_type)
+    if len(linhas) > LIMITE_LINHAS_BULK:
+        raise HTTPException(status_code=413, detail=f"No máximo {LIMITE_LINHAS_BULK} linhas por pedido")
+
+    validos = []
+    erros = []
+    for indice, dados, erro in linhas:
+        if erro:
+            erros.append({"indice": indice, "erro": erro})
+            continue
+        try:
+            obj = validar_modelo(modelo, dados)
+        except ValidationError as erro_validacao:
+            erros.append({
+                "indice": indice,
+                "erro": erro_validacao.errors(include_url=False, include_context=False),
+            })
+            continue
+        # o import em massa não ocupa o pool das senhas, que serve os logins:
+        # recebe os hashes já feitos, com os parâmetros de custo desta API
+        if modelo is Usuario and hash_desatualizado(obj.senha_has):
+            erros.append({
+                "indice": indice,
+                "erro": f"senha_has tem de vir em formato scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$sal$chave; use POST /usuarios",
+            })
+            continue
+        validos.append((indice, obj))
+    return validos, erros
+
+
+async def ler_lote(recurso: str, request: Request):
+    if recurso not in RECURSOS_BULK:
+        raise HTTPException(status_code=404, detail="Recurso não encontrado")
+    modelo = RECURSOS_BULK[recurso]
+
+    # o corpo é lido no event loop; o parse e as dezenas de milhares de
+    # validações correm numa thread, como a inserção, para não parar os
+    # outros pedidos (nem o stream de marcações)
+    corpo = await request.body()
+    validos, erros = await run_in_threadpool(validar_lote, modelo, corpo, request.headers.get("content-type", ""))
+    return modelo, validos, erros
+
+
+def resultado_lote(modelo, inseridos, erros):
+    if inseridos:
+        invalidar_cache(modelo)
+        publicar_alteracoes(modelo)
+    erros.sort(key=lambda e: e["indice"])
+    return {"inseridos": len(inseridos), "ids": inseridos, "erros": erros}
+
+
+@app.post("/{recurso}/bulk")
+async def criar_em_lote(recurso: str, request: Request, session: DBSession):
+    modelo, validos, erros = await ler_lote(recurso, request)
+    inseridos = []
+    if validos:
+        inseridos, erros_bd = await run_in_threadpool(inserir_em_lote, session, modelo, validos)
+        erros.extend(erros_bd)
+    return resultado_lote(modelo, inseridos, erros)
+
+
+
+        #### EXPORTAÇÃO API ENDPOINTS ####
+
+# As exportações são lidas com um cursor do lado do servidor (yield_per) e
+# enviadas em lotes de tamanho fixo, por isso a memória não cresce com o número
+# de linhas e o primeiro lote sai antes de a consulta terminar.
+
+TAMANHO_LOTE_EXPORTACAO = 1000
+
+# tabela exportável -> (modelo, coluna de data usada nos filtros de/ate)
+TABELAS_EXPORTACAO = {
+    "pacientes": (Paciente, Paciente.data_registro),
+    "medicos": (Medico, None),
+    "funcionarios": (Funcionario, None),
+    "marcacao": (Marcacao, Marcacao.data_marcacao),
+    "servicos": (Servico, None),
+    "consultas": (Consulta, Consulta.data_consulta),
+    "pagamentos": (Pagamento, Pagamento.data_pagamento),
+}
+
+
+class FormatoExportacao(str, Enum):
+    NDJSON = "ndjson"
+    CSV = "csv"
+
+
+def valor_exportacao(valor):
+    if isinstance(valor, uuid.UUID):
+        return str(valor)
+    if isinstance(valor, (date, time)):
+        return valor.isoformat()
+    if isinstance(valor, Enum):
+        return valor.value
+    return valor
+
+
+def em_lotes(linhas, tamanho: int):
+    iterador = iter(linhas)
+    while lote := list(islice(iterador, tamanho)):
+        yield lote
+
+
+def sem_ids_repetidos(linhas, posicao_id: int):
+    # as linhas vêm ordenadas por (..., id): as repetidas ficam seguidas
+    anterior = None
+    for linha in linhas:
+        if linha[posicao_id] != anterior:
+            yield linha
+        anterior = linha[posicao_id]
+
+
+def gerar_exportacao(
+    session: Session, consulta, colunas: List[str], formato: FormatoExportacao, coluna_arquivo: Optional[str] = None
+):
+    resultado = session.execute(
+        consulta.execution_options(yield_per=TAMANHO_LOTE_EXPORTACAO)
+    )
+    lotes = resultado.partitions()
+    if coluna_arquivo is not None:
+        # dois cursores abertos na mesma ligação, ambos por (data, id) e
+        # juntados pela mesma chave; uma linha a meio de ser arquivada está nos
+        # dois ficheiros e sai uma só vez, como em juntar_com_arquivo
+        arquivadas = session.execute(
+            consulta, execution_options={**SCHEMA_ARQUIVO, "yield_per": TAMANHO_LOTE_EXPORTACAO}
+        )
+        posicao_id = colunas.index("id")
+        chave = itemgetter(colunas.index(coluna_arquivo), posicao_id)
+        linhas = sem_ids_repetidos(heapq.merge(arquivadas, resultado, key=chave), posicao_id)
+        lotes = em_lotes(linhas, TAMANHO_LOTE_EXPORTACAO)
+
+    if formato == FormatoExportacao.CSV:
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer)
+        escritor.writerow(colunas)
+        for lote in lotes:
+            escritor.writerows([valor_exportacao(v) for v in linha] for linha in lote)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for lote in lotes:
+            yield "".join(
+                json.dumps(
+                    {c: valor_exportacao(v) for c, v in zip(colunas, linha)},
+                    ensure_ascii=False,
+                ) + "\n"
+                for linha in lote
+            )
+
+
+@app.get("/export/{tabela}")
+def exportar_tabela(
+    session: DBSessionStreaming,
+    tabela: str,
+    formato: FormatoExportacao = FormatoExportacao.NDJSON,
+    de: Optional[date] = None,
+    ate: Optional[date] = None,
+):
+    if tabela not in TABELAS_EXPORTACAO:
+        raise HTTPException(status_code=404, detail="Tabela não encontrada")
+
+    modelo, coluna_data = TABELAS_EXPORTACAO[tabela]
+    if coluna_data is None and (de or ate):
+        raise HTTPException(status_code=400, detail="Esta tabela não tem filtro por data")
+
+    colunas = list(modelo.__table__.columns.keys())
+    consulta = select(*modelo.__table__.columns)
+    if coluna_data is not None:
+        # o índice da coluna de data serve o filtro e a ordenação; o id
+        # desempata, para a junção com o arquivo ser por uma ordem total
+        consulta = consulta.order_by(coluna_data, modelo.id)
+        if de:
+            consulta = consulta.where(coluna_data >= de)
+        if ate:
+            consulta = consulta.where(coluna_data < ate + timedelta(days=1))
+    else:
+        consulta = consulta.order_by(modelo.id)
+
+    coluna_arquivo = None
+    if modelo in COLUNA_DATA_ARQUIVO and (de or ate) and alcanca_arquivo(session.connection(), de):
+        coluna_arquivo = coluna_data.name
+
+    if formato == FormatoExportacao.CSV:
+        media_type = "text/csv"
+    else:
+        media_type = "application/x-ndjson"
+
+    return StreamingResponse(
+        gerar_exportacao(session, consulta, colunas, formato, coluna_arquivo),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{tabela}.{formato.value}"'},
+    )
+
+
+
+        #### MODO ASYNC ####
+
+# Com CLINICA_MODO=async os CRUD de todos os recursos passam a ser servidos por
+# handlers async def sobre um AsyncEngine (aiosqlite), sem passar pelo
+# threadpool do FastAPI. As rotas têm os mesmos caminhos e respostas que as
+# versões sync acima, que continuam a ser o modo por omissão.
+# Todas as escritas dos pedidos passam pela única ligação de escrita do
+# engine aiosqlite: as rotas de escrita sync que não têm versão própria aqui
+# (consulta_servico, horário, faturas, relatórios, tarefas, cópias) são
+# embrulhadas por escrita_async, que corre o mesmo handler com run_sync nessa
+# ligação, e o bulk tem a sua versão. O engine de escrita sync fica só para o
+# arranque (migrações) e para as tarefas em segundo plano, que escrevem em
+# lotes curtos e esperam pelo lock com o busy_timeout, como o gerir.py do cron.
+
+# (caminho da lista, caminho do item, modelo, mensagem 404, mensagem do DELETE
+# igual à da rota sync)
+RECURSOS_CRUD = [
+    ("/usuarios", "/usuarios/{item_id}", Usuario, "Usuário não encontrado", "Usuário eliminado com sucesso"),
+    ("/pacientes", "/pacientes/{item_id}", Paciente, "Paciente não encontrado", "Paciente eliminado com sucesso"),
+    ("/medicos", "/medicos/{item_id}", Medico, "Médico não encontrado", "Médico eliminado com sucesso"),
+    ("/funcionario", "/funcionarios/{item_id}", Funcionario, "Funcionário não encontrado", "Funcionario eliminado com sucesso"),
+    ("/marcacao", "/marcacao/{item_id}", Marcacao, "Marcação não encontrado", "Marcação eliminado com sucesso"),
+    ("/servicos", "/servicos/{item_id}", Servico, "Serviço não encontrado", "Serviço eliminado com sucesso"),
+    ("/consultas", "/consultas/{item_id}", Consulta, "Consulta não encontrado", "Consulta eliminado com sucesso"),
+    ("/pagamentos", "/pagamentos/{item_id}", Pagamento, "Pagamento não encontrado", "Pagamento eliminado com sucesso"),
+]
+
+
+# atualizações com passos extra (horário, totais das consultas) que o router
+# async também usa, através de run_sync
+ATUALIZACOES_ESPECIAIS = {
+    Usuario: gravar_alteracoes_usuario,
+    Marcacao: gravar_alteracoes_marcacao,
+    Servico: gravar_alteracoes_servico,
+}
+
+
+# passos extra ao apagar, que as rotas sync fazem antes do DELETE; recebem a
+# sessão sync (run_sync) e o registo
+ANTES_DE_ELIMINAR = {
+    Servico: lambda session, servico: ajustar_totais_servico(session, servico.id, -servico.preco),
+}
+
+
+def criar_router_async():
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    router = APIRouter()
+
+    def registar(caminho_lista, caminho_item, modelo, nao_encontrado, eliminado):
+        async def gravar_novo(dados, idempotency_key: Optional[str]):
+            dados = validar(modelo, dados)
+            if modelo is Usuario:
+                dados.senha_has = await hash_para_guardar(dados.senha_has)
+            async with AsyncSession(clinica().engine_async) as session:
+                if idempotency_key:
+                    repetida = await session.run_sync(reservar_pedido, modelo, idempotency_key, dados)
+                    if repetida is not None:
+                        return repetida
+                if modelo is Marcacao:
+                    # horário do médico e slot único (409) pelo mesmo caminho da rota sync
+                    return await session.run_sync(gravar_marcacao, dados)
+                await session.run_sync(atualizar_resumos, modelo, [dados.id], -1)
+                session.add(dados)
+                await session.flush()
+                await session.run_sync(atualizar_resumos, modelo, [dados.id], 1)
+                await session.run_sync(registar_alteracoes, modelo, ALTERACAO_CRIADA, [campos_linha(dados)])
+                await session.commit()
+                invalidar_cache(modelo)
+                publicar_alteracoes(modelo)
+                await session.refresh(dados)
+                return publico(modelo, dados)
+
+        async def criar(dados: modelo):
+            return await gravar_novo(dados, None)
+
+        async def criar_idempotente(dados: modelo, idempotency_key: ChaveIdempotencia = None):
+            return await gravar_novo(dados, idempotency_key)
+
+        async def listar(
+            request: Request,
+            lista: Annotated[Listagem, Depends(parametros_lista(modelo))],
+            limit: Limite = LIMITE_PADRAO,
+            after: Cursor = None,
+        ):
+            async def carregar():
+                consulta = consulta_pagina(modelo, limit, after, lista)
+                async with AsyncSession(clinica().engine_async_leitura) as session:
+                    if COLUNA_DATA_ARQUIVO.get(modelo) in lista.inicios:
+                        # o intervalo de datas pode chegar ao arquivo: mesma via das rotas sync
+                        return await session.run_sync(paginar, modelo, limit, after, lista)
+                    if not JSON_RAPIDO and lista.campos is None:
+                        linhas = (await session.exec(consulta)).all()
+                        return montar_pagina(linhas, limit)
+                    # como paginar(): só as colunas que saem (sem as de MODELOS_PUBLICOS)
+                    resultado = await session.execute(consulta.with_only_columns(*lista.colunas()))
+                    return pagina_de_linhas(resultado, limit, Pagina if lista.campos is None else PaginaParcial)
+
+            # serviços e médicos passam pela cache de referência, como nas rotas sync
+            if modelo in GRUPOS_CACHE:
+                return await resposta_em_cache_async(request, modelo, carregar)
+            return responder(await carregar())
+
+        async def buscar(request: Request, item_id: uuid.UUID):
+            async def carregar():
+                async with AsyncSession(clinica().engine_async_leitura) as session:
+                    obj = await session.get(modelo, item_id) or await session.run_sync(
+                        lambda s: buscar_arquivado(s.connection(), modelo, item_id)
+                    )
+                if not obj:
+                    raise HTTPException(status_code=404, detail=nao_encontrado)
+                return publico(modelo, obj)
+
+            if modelo in GRUPOS_CACHE:
+                return await resposta_em_cache_async(request, modelo, carregar)
+            return responder(await carregar())
+
+        async def gravar(item_id: uuid.UUID, alteracoes: dict, versao: Optional[int]):
+            if modelo is Usuario:
+                # o scrypt corre no pool; gravar_alteracoes_usuario recebe já o hash
+                await hash_das_alteracoes(alteracoes)
+            async with AsyncSession(clinica().engine_async) as session:
+                especial = ATUALIZACOES_ESPECIAIS.get(modelo)
+                if especial:
+                    return await session.run_sync(especial, item_id, alteracoes, versao)
+                return await session.run_sync(gravar_alteracoes, modelo, item_id, alteracoes, versao, nao_encontrado)
+
+        async def atualizar(request: Request, item_id: uuid.UUID, dados: modelo):
+            return await gravar(item_id, *pedido_put(request, modelo, dados))
+
+        async def alterar(request: Request, item_id: uuid.UUID, dados: modelo_parcial(modelo)):
+            return await gravar(item_id, *pedido_patch(request, dados))
+
+        async def eliminar(item_id: uuid.UUID):
+            async with AsyncSession(clinica().engine_async) as session:
+                obj = await session.get(modelo, item_id)
+                if not obj:
+                    raise HTTPException(status_code=404, detail=nao_encontrado)
+
+                antes = ANTES_DE_ELIMINAR.get(modelo)
+                if antes:
+                    await session.run_sync(antes, obj)
+                await session.run_sync(atualizar_resumos, modelo, [item_id], -1)
+                await session.run_sync(registar_alteracoes, modelo, ALTERACAO_ELIMINADA, [campos_linha(obj)])
+                if modelo is Usuario:
+                    await session.run_sync(revogar_sessoes, item_id)
+                await session.delete(obj)
+                await session.flush()
+                await session.run_sync(atualizar_resumos, modelo, [item_id], 1)
+                await session.commit()
+                invalidar_cache(modelo)
+                publicar_alteracoes(modelo)
+                return {"mensagem": eliminado}
+
+        nome = modelo.__name__.lower()
+        resposta = MODELOS_PUBLICOS.get(modelo, modelo)
+        router.add_api_route(
+            caminho_lista,
+            criar_idempotente if modelo in ROTAS_IDEMPOTENTES else criar,
+            methods=["POST"],
+            response_model=resposta,
+            name=f"criar_{nome}_async",
+        )
+        router.add_api_route(caminho_lista, listar, methods=["GET"], response_model=Pagina[resposta], name=f"listar_{nome}_async")
+        router.add_api_route(caminho_item, buscar, methods=["GET"], response_model=resposta, name=f"buscar_{nome}_async")
+        router.add_api_route(caminho_item, atualizar, methods=["PUT"], response_model=resposta, name=f"atualizar_{nome}_async")
+        router.add_api_route(caminho_item, alterar, methods=["PATCH"], response_model=resposta, name=f"alterar_{nome}_async")
+        router.add_api_route(caminho_item, eliminar, methods=["DELETE"], name=f"eliminar_{nome}_async")
+
+    for recurso in RECURSOS_CRUD:
+        registar(*recurso)
+
+    # autenticação e senha: as mesmas funções das rotas sync, na sessão de
+    # escrita aiosqlite em vez de uma segunda ligação de escrita sync
+    async def login(credenciais: Credenciais):
+        async with AsyncSession(clinica().engine_async) as session:
+            return await autenticar(credenciais, session.run_sync)
+
+    async def logout(sessao: UsuarioAutenticado, authorization: Annotated[str, Header()]):
+        async with AsyncSession(clinica().engine_async) as session:
+            return await session.run_sync(terminar_sessao, authorization)
+
+    async def definir_senha(usuario_id: uuid.UUID, dados: NovaSenha):
+        senha_has = await asyncio.wrap_future(submeter_calculo(gerar_hash_senha, dados.senha))
+        async with AsyncSession(clinica().engine_async) as session:
+            return await session.run_sync(gravar_senha, usuario_id, senha_has)
+
+    router.add_api_route("/auth/login", login, methods=["POST"], response_model=Token, name="login_async")
+    router.add_api_route("/auth/logout", logout, methods=["POST"], name="logout_async")
+    router.add_api_route("/usuarios/{usuario_id}/senha", definir_senha, methods=["PUT"], name="definir_senha_async")
+
+    async def criar_em_lote(recurso: str, request: Request):
+        modelo, validos, erros = await ler_lote(recurso, request)
+        inseridos = []
+        if validos:
+            async with AsyncSession(clinica().engine_async) as session:
+                inseridos, erros_bd = await session.run_sync(inserir_em_lote, modelo, validos)
+            erros.extend(erros_bd)
+        return resultado_lote(modelo, inseridos, erros)
+
+    router.add_api_route("/{recurso}/bulk", criar_em_lote, methods=["POST"], name="criar_em_lote_async")
+
+    # as restantes rotas de escrita sync (consulta_servico, horário, faturas,
+    # relatórios, tarefas, cópias) correm o próprio handler na sessão aiosqlite
+    ja_async = set().union(*(chaves_rota(rota) for rota in router.routes))
+    for rota in list(app.router.routes):
+        if not isinstance(rota, APIRoute) or chaves_rota(rota) & ja_async:
+            continue
+        if rota.methods <= {"GET", "HEAD", "OPTIONS"} or inspect.iscoroutinefunction(rota.endpoint):
+            continue
+        if "session" not in inspect.signature(rota.endpoint).parameters:
+            continue
+        router.add_api_route(
+            rota.path, escrita_async(rota.endpoint), methods=list(rota.methods),
+            response_model=rota.response_model, status_code=rota.status_code, name=f"{rota.name}_async",
+        )
+    return router
+
+
+def escrita_async(endpoint):
+    """Versão async de um handler sync de escrita, corrido com run_sync na ligação de escrita aiosqlite."""
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    assinatura = inspect.signature(endpoint)
+
+    async def handler(**valores):
+        async with AsyncSession(clinica().engine_async) as session:
+            return await session.run_sync(lambda sessao: endpoint(session=sessao, **valores))
+
+    handler.__name__ = f"{endpoint.__name__}_async"
+    handler.__doc__ = endpoint.__doc__
+    handler.__signature__ = assinatura.replace(
+        parameters=[parametro for nome, parametro in assinatura.parameters.items() if nome != "session"]
+    )
+    return handler
+
+
+def chaves_rota(rota):
+    # caminho sem o nome dos parâmetros, para /x/{id} e /x/{item_id} coincidirem
+    caminho = re.sub(r"\{[^}]+\}", "{}", rota.path)
+    return {(caminho, metodo) for metodo in rota.methods}
+
+
+def substituir_rotas(aplicacao: FastAPI, router: APIRouter):
+    # a rota async substitui a sync com o mesmo caminho (ignorando o nome dos
+    # parâmetros) e o mesmo método
+    novas = set().union(*(chaves_rota(rota) for rota in router.routes))
+    aplicacao.router.routes[:] = [
+        rota for rota in aplicacao.router.routes
+        if not (isinstance(rota, APIRoute) and chaves_rota(rota) & novas)
+    ]
+    aplicacao.include_router(router)
+
+
+if MODO_API == "async":
+    substituir_rotas(app, criar_router_async())
 
 
 # end of file api.py
\ No newline at end of file
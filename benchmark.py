@@ -0,0 +1,498 @@
+"""Benchmarks de carga da API.
+
+    python benchmark.py suite --tamanho pequeno --clientes 20 --duracao 30 \\
+        --saida resultados.json --baseline baseline.json
+    python benchmark.py serializacao --limite 500
+    python benchmark.py modos --clientes 50 100 250 500 --duracao 10
+
+"suite" povoa uma base temporária com uma clínica sintética (gerador.py, sempre
+a mesma para a mesma semente e tamanho), corre uma carga mista de leituras e
+escritas contra a app (em processo via ASGI ou num uvicorn local) e mostra
+débito e latências p50/p95/p99 por endpoint. O resultado fica em JSON; com
+--baseline é comparado com uma corrida anterior e as regressões acima da
+tolerância fazem o comando sair com código 1.
+
+"serializacao" mede o CPU por pedido das listagens grandes com e sem o caminho
+JSON rápido (CLINICA_JSON_RAPIDO) e confirma que as respostas são iguais.
+
+"modos" compara o modo sync com o modo async (CLINICA_MODO) em vários números
+de clientes concorrentes.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import httpx
+
+
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    indice = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return ordenados[indice]
+
+
+def arrancar_servidor(modo, db_file, porta):
+    env = dict(os.environ, CLINICA_MODO=modo, CLINICA_DB=db_file)
+    processo = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--port", str(porta), "--log-level", "warning"],
+        env=env,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    base = f"http://127.0.0.1:{porta}"
+    for _ in range(100):
+        try:
+            httpx.get(f"{base}/servicos", timeout=1)
+            return processo, base
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    processo.terminate()
+    raise RuntimeError(f"O servidor em modo {modo} não arrancou")
+
+
+def povoar(base, usuarios=200, servicos=20):
+    with httpx.Client(base_url=base) as cliente:
+        for i in range(usuarios):
+            cliente.post("/usuarios", json={
+                "username": f"benchmark{i}",
+                "senha_has": f"benchmark{i}",
+                "email": f"benchmark{i}@clinica.local",
+                "tipo_usuario": "paciente",
+            })
+        return [
+            cliente.post("/servicos", json={
+                "nome_servico": f"Serviço {i}",
+                "descricao": "benchmark",
+                "preco": 1000 + i,
+            }).json()["id"]
+            for i in range(servicos)
+        ]
+
+
+async def carga(base, servicos, clientes, duracao):
+    latencias = []
+    erros = 0
+    fim = time.perf_counter() + duracao
+    limites = httpx.Limits(max_connections=clientes, max_keepalive_connections=clientes)
+
+    async with httpx.AsyncClient(base_url=base, limits=limites, timeout=30) as cliente:
+        async def trabalhador():
+            nonlocal erros
+            while time.perf_counter() < fim:
+                sorteio = random.random()
+                inicio = time.perf_counter()
+                try:
+                    if sorteio < 0.5:
+                        r = await cliente.get("/usuarios", params={"limit": 20})
+                    elif sorteio < 0.9:
+                        r = await cliente.get(f"/servicos/{random.choice(servicos)}")
+                    else:
+                        r = await cliente.post("/servicos", json={
+                            "nome_servico": "carga", "descricao": "benchmark", "preco": 1,
+                        })
+                    if r.status_code >= 400:
+                        erros += 1
+                except httpx.HTTPError:
+                    erros += 1
+                latencias.append(time.perf_counter() - inicio)
+
+        await asyncio.gather(*(trabalhador() for _ in range(clientes)))
+
+    return {
+        "pedidos": len(latencias),
+        "erros": erros,
+        "rps": len(latencias) / duracao,
+        "p50_ms": percentil(latencias, 50) * 1000,
+        "p99_ms": percentil(latencias, 99) * 1000,
+    }
+
+
+def comparar_modos(modos, lista_clientes, duracao):
+    resultados = []
+    for modo in modos:
+        with tempfile.TemporaryDirectory() as pasta:
+            processo, base = arrancar_servidor(modo, os.path.join(pasta, "benchmark.db"), porta_livre())
+            try:
+                servicos = povoar(base)
+                for clientes in lista_clientes:
+                    r = asyncio.run(carga(base, servicos, clientes, duracao))
+                    resultados.append({"modo": modo, "clientes": clientes, **r})
+                    print(
+                        f"{modo:>5}  {clientes:>4} clientes  {r['rps']:>8.1f} req/s  "
+                        f"p50 {r['p50_ms']:>7.1f} ms  p99 {r['p99_ms']:>7.1f} ms  erros {r['erros']}"
+                    )
+            finally:
+                processo.terminate()
+                processo.wait()
+    return resultados
+
+
+# Carga mista da suite: (peso, endpoint, função que faz o pedido). O nome do
+# endpoint é o caminho da rota, para bater com as etiquetas de GET /metrics.
+
+def dia_util(dias):
+    # a agenda por omissão só tem slots de segunda a sexta
+    dia = date.today() + timedelta(days=dias)
+    while dia.weekday() >= 5:
+        dia += timedelta(days=1)
+    return dia.isoformat()
+
+
+def pedido_listar_pacientes(cliente, dados, rnd):
+    return cliente.get("/pacientes", params={"limit": 20})
+
+
+def pedido_buscar_paciente(cliente, dados, rnd):
+    return cliente.get(f"/pacientes/{rnd.choice(dados['pacientes'])[0]}")
+
+
+def pedido_historico(cliente, dados, rnd):
+    return cliente.get(f"/pacientes/{rnd.choice(dados['pacientes'])[0]}/historico")
+
+
+def pedido_pesquisa(cliente, dados, rnd):
+    nome = rnd.choice(dados["pacientes"])[1].split()
+    return cliente.get("/pacientes/pesquisa", params={"q": f"{nome[0][:3]} {nome[-1][:3]}"})
+
+
+def pedido_buscar_servico(cliente, dados, rnd):
+    return cliente.get(f"/servicos/{rnd.choice(dados['servicos'])}")
+
+
+def pedido_disponibilidade(cliente, dados, rnd):
+    return cliente.get(
+        f"/medicos/{rnd.choice(dados['medicos'])}/disponibilidade", params={"data": dia_util(rnd.randint(1, 30))}
+    )
+
+
+def pedido_fatura(cliente, dados, rnd):
+    return cliente.get(f"/consultas/{rnd.choice(dados['consultas'])[0]}/fatura")
+
+
+def pedido_relatorio(cliente, dados, rnd):
+    return cliente.get("/relatorios/receita", params={"agrupar": "mes"})
+
+
+def pedido_criar_marcacao(cliente, dados, rnd):
+    minutos = 8 * 60 + 30 * rnd.randrange(18)
+    return cliente.post("/marcacao", json={
+        "data_marcacao": dia_util(rnd.randint(31, 120)),
+        "hora_marcacao": f"{minutos // 60:02d}:{minutos % 60:02d}",
+        "estado_marcacao": "agendada",
+        "paciente_id": str(rnd.choice(dados["pacientes"])[0]),
+        "medico_id": str(rnd.choice(dados["medicos"])),
+    })
+
+
+def pedido_criar_pagamento(cliente, dados, rnd):
+    consulta_id, paciente_id = rnd.choice(dados["consultas"])
+    return cliente.post("/pagamentos", json={
+        "valor_pagamento": 1000,
+        "metodo_pagamento": "multicaixa",
+        "data_pagamento": date.today().isoformat(),
+        "estado_pagamento": "pago",
+        "paciente_id": str(paciente_id),
+        "consulta_id": str(consulta_id),
+    })
+
+
+CARGA_MISTA = [
+    (10, "GET /pacientes", pedido_listar_pacientes),
+    (15, "GET /pacientes/{paciente_id}", pedido_buscar_paciente),
+    (10, "GET /pacientes/{paciente_id}/historico", pedido_historico),
+    (10, "GET /pacientes/pesquisa", pedido_pesquisa),
+    (10, "GET /servicos/{servico_id}", pedido_buscar_servico),
+    (10, "GET /medicos/{medico_id}/disponibilidade", pedido_disponibilidade),
+    (10, "GET /consultas/{consulta_id}/fatura", pedido_fatura),
+    (5, "GET /relatorios/receita", pedido_relatorio),
+    (12, "POST /marcacao", pedido_criar_marcacao),
+    (8, "POST /pagamentos", pedido_criar_pagamento),
+]
+
+# respostas esperadas numa carga concorrente: slot já ocupado
+ESTADOS_ESPERADOS = {409}
+
+
+def resumir(latencias, erros, duracao):
+    return {
+        "pedidos": len(latencias),
+        "erros": erros,
+        "rps": len(latencias) / duracao,
+        "p50_ms": percentil(latencias, 50) * 1000,
+        "p95_ms": percentil(latencias, 95) * 1000,
+        "p99_ms": percentil(latencias, 99) * 1000,
+    }
+
+
+async def carga_mista(cliente, dados, clientes, duracao, semente, medir=True):
+    latencias = {nome: [] for _, nome, _ in CARGA_MISTA}
+    erros = dict.fromkeys(latencias, 0)
+    pesos = [peso for peso, _, _ in CARGA_MISTA]
+    fim = time.perf_counter() + duracao
+
+    async def trabalhador(indice):
+        # cada cliente tem o seu gerador: a sequência de pedidos é reprodutível
+        rnd = random.Random(semente * 1000 + indice)
+        while time.perf_counter() < fim:
+            _, nome, fazer_pedido = rnd.choices(CARGA_MISTA, weights=pesos)[0]
+            inicio = time.perf_counter()
+            try:
+                r = await fazer_pedido(cliente, dados, rnd)
+                if r.status_code >= 400 and r.status_code not in ESTADOS_ESPERADOS:
+                    erros[nome] += 1
+            except httpx.HTTPError:
+                erros[nome] += 1
+            latencias[nome].append(time.perf_counter() - inicio)
+
+    await asyncio.gather(*(trabalhador(i) for i in range(clientes)))
+    if not medir:
+        return None
+
+    todas = [l for valores in latencias.values() for l in valores]
+    return {
+        "endpoints": {nome: resumir(latencias[nome], erros[nome], duracao) for nome in latencias},
+        "total": resumir(todas, sum(erros.values()), duracao),
+    }
+
+
+def versao_git():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def conduzir(base_ou_app, dados, args):
+    if isinstance(base_ou_app, str):
+        transporte = None
+        base = base_ou_app
+    else:
+        transporte = httpx.ASGITransport(app=base_ou_app)
+        base = "http://clinica"
+    limites = httpx.Limits(max_connections=args.clientes, max_keepalive_connections=args.clientes)
+    async with httpx.AsyncClient(base_url=base, transport=transporte, limits=limites, timeout=30) as cliente:
+        if args.aquecimento > 0:
+            await carga_mista(cliente, dados, args.clientes, args.aquecimento, args.semente + 1, medir=False)
+        return await carga_mista(cliente, dados, args.clientes, args.duracao, args.semente)
+
+
+def correr_suite(args):
+    import gerador  # só depois de CLINICA_DB apontar para a base temporária
+
+    parametros = gerador.Parametros(semente=args.semente, **gerador.TAMANHOS[args.tamanho])
+    inicio = time.perf_counter()
+    contagem, amostra = gerador.povoar(parametros)
+    print(f"Base povoada em {time.perf_counter() - inicio:.1f} s: {contagem}")
+    dados = amostra.itens
+
+    if args.transporte == "asgi":
+        resultado = asyncio.run(conduzir(gerador.api.app, dados, args))
+    else:
+        processo, base = arrancar_servidor(args.modo, os.environ["CLINICA_DB"], porta_livre())
+        try:
+            resultado = asyncio.run(conduzir(base, dados, args))
+        finally:
+            processo.terminate()
+            processo.wait()
+
+    return {
+        "data": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git": versao_git(),
+        "python": platform.python_version(),
+        "parametros": {
+            "tamanho": args.tamanho,
+            "semente": args.semente,
+            "transporte": args.transporte,
+            "modo": args.modo,
+            "clientes": args.clientes,
+            "duracao": args.duracao,
+            "linhas": contagem,
+        },
+        **resultado,
+    }
+
+
+def mostrar_resultado(resultado):
+    print(f"{'endpoint':<42} {'pedidos':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'erros':>6}")
+    for nome, r in [*resultado["endpoints"].items(), ("TOTAL", resultado["total"])]:
+        print(
+            f"{nome:<42} {r['pedidos']:>8} {r['rps']:>8.1f} {r['p50_ms']:>8.1f} "
+            f"{r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f} {r['erros']:>6}"
+        )
+
+
+def comparar_com_baseline(resultado, baseline, tolerancia):
+    """Lista as regressões: p95 mais lento ou débito mais baixo do que a tolerância permite."""
+    regressoes = []
+    atuais = {**resultado["endpoints"], "TOTAL": resultado["total"]}
+    anteriores = {**baseline["endpoints"], "TOTAL": baseline["total"]}
+    print(f"\n{'endpoint':<42} {'p95 base':>9} {'p95 agora':>9} {'Δ':>7} {'rps base':>9} {'rps agora':>9} {'Δ':>7}")
+    for nome, atual in atuais.items():
+        anterior = anteriores.get(nome)
+        if not anterior or not anterior["pedidos"] or not atual["pedidos"]:
+            continue
+        delta_p95 = atual["p95_ms"] / anterior["p95_ms"] - 1 if anterior["p95_ms"] else 0.0
+        delta_rps = atual["rps"] / anterior["rps"] - 1 if anterior["rps"] else 0.0
+        marca = ""
+        if delta_p95 > tolerancia:
+            regressoes.append(f"{nome}: p95 {anterior['p95_ms']:.1f} -> {atual['p95_ms']:.1f} ms")
+            marca = "  <- regressão"
+        if delta_rps < -tolerancia:
+            regressoes.append(f"{nome}: {anterior['rps']:.1f} -> {atual['rps']:.1f} req/s")
+            marca = "  <- regressão"
+        print(
+            f"{nome:<42} {anterior['p95_ms']:>9.1f} {atual['p95_ms']:>9.1f} {delta_p95:>+7.0%} "
+            f"{anterior['rps']:>9.1f} {atual['rps']:>9.1f} {delta_rps:>+7.0%}{marca}"
+        )
+    return regressoes
+
+
+def suite(args):
+    with tempfile.TemporaryDirectory() as pasta:
+        os.environ["CLINICA_DB"] = os.path.join(pasta, "benchmark.db")
+        os.environ["CLINICA_MODO"] = args.modo
+        resultado = correr_suite(args)
+
+    mostrar_resultado(resultado)
+    with open(args.saida, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    print(f"\nResultados gravados em {args.saida}")
+
+    if not args.baseline:
+        return 0
+    if args.atualizar_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2)
+        print(f"Baseline gravada em {args.baseline}")
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    diferentes = [
+        chave for chave in ("tamanho", "semente", "transporte", "modo", "clientes")
+        if baseline["parametros"].get(chave) != resultado["parametros"][chave]
+    ]
+    if diferentes:
+        print(f"Aviso: a baseline foi medida com outros parâmetros ({', '.join(diferentes)})")
+    regressoes = comparar_com_baseline(resultado, baseline, args.tolerancia)
+    if regressoes:
+        print(f"\n{len(regressoes)} regressões acima de {args.tolerancia:.0%}:")
+        for regressao in regressoes:
+            print(f"  {regressao}")
+        return 1
+    print(f"\nSem regressões acima de {args.tolerancia:.0%}")
+    return 0
+
+
+LISTAGENS_SERIALIZACAO = ["/pacientes", "/marcacao", "/consultas", "/pagamentos", "/consulta_servico"]
+
+
+async def medir_listagens(app, limite, repeticoes):
+    medidas = {}
+    corpos = {}
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://clinica") as cliente:
+        for caminho in LISTAGENS_SERIALIZACAO:
+            r = await cliente.get(caminho, params={"limit": limite})
+            r.raise_for_status()
+            corpos[caminho] = r.json()
+            inicio_cpu = time.process_time()
+            inicio = time.perf_counter()
+            for _ in range(repeticoes):
+                await cliente.get(caminho, params={"limit": limite})
+            medidas[caminho] = {
+                "cpu_ms": (time.process_time() - inicio_cpu) / repeticoes * 1000,
+                "ms": (time.perf_counter() - inicio) / repeticoes * 1000,
+            }
+    return medidas, corpos
+
+
+def serializacao(args):
+    """CPU por pedido das listagens grandes com e sem o caminho JSON rápido."""
+    with tempfile.TemporaryDirectory() as pasta:
+        os.environ["CLINICA_DB"] = os.path.join(pasta, "benchmark.db")
+        import gerador
+
+        gerador.povoar(gerador.Parametros(semente=args.semente, **gerador.TAMANHOS["pequeno"]))
+        api = gerador.api
+        resultados = {}
+        for rapido in (False, True):
+            api.JSON_RAPIDO = rapido
+            resultados[rapido] = asyncio.run(medir_listagens(api.app, args.limite, args.repeticoes))
+
+    print(f"{'listagem (limit=' + str(args.limite) + ')':<26} {'CPU normal':>11} {'CPU rápido':>11} {'poupado':>8}")
+    diferentes = []
+    for caminho in LISTAGENS_SERIALIZACAO:
+        antes = resultados[False][0][caminho]["cpu_ms"]
+        depois = resultados[True][0][caminho]["cpu_ms"]
+        print(f"{caminho:<26} {antes:>9.2f}ms {depois:>9.2f}ms {1 - depois / antes:>8.0%}")
+        if resultados[False][1][caminho] != resultados[True][1][caminho]:
+            diferentes.append(caminho)
+    if diferentes:
+        print(f"As respostas dos dois caminhos diferem em: {', '.join(diferentes)}")
+        return 1
+    return 0
+
+
+def modos(args):
+    comparar_modos(args.modos, args.clientes, args.duracao)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    comandos = parser.add_subparsers(dest="comando", required=True)
+
+    comando = comandos.add_parser("suite", help="carga mista sobre uma clínica sintética, com baseline")
+    comando.add_argument("--tamanho", choices=["pequeno", "medio", "grande"], default="pequeno")
+    comando.add_argument("--semente", type=int, default=42)
+    comando.add_argument("--transporte", choices=["asgi", "uvicorn"], default="asgi",
+                         help="asgi: app no próprio processo; uvicorn: servidor local numa porta livre")
+    comando.add_argument("--modo", choices=["sync", "async"], default="sync")
+    comando.add_argument("--clientes", type=int, default=20)
+    comando.add_argument("--duracao", type=float, default=30, help="segundos de medição")
+    comando.add_argument("--aquecimento", type=float, default=3, help="segundos de carga antes de medir")
+    comando.add_argument("--saida", default="benchmark-resultados.json")
+    comando.add_argument("--baseline", help="JSON de uma corrida anterior; criado se não existir")
+    comando.add_argument("--atualizar-baseline", action="store_true", help="grava esta corrida como baseline")
+    comando.add_argument("--tolerancia", type=float, default=0.15, help="variação aceite (0.15 = 15%%)")
+    comando.set_defaults(funcao=suite)
+
+    comando = comandos.add_parser("serializacao", help="CPU das listagens com e sem CLINICA_JSON_RAPIDO")
+    comando.add_argument("--semente", type=int, default=42)
+    comando.add_argument("--limite", type=int, default=500, help="linhas por página")
+    comando.add_argument("--repeticoes", type=int, default=50)
+    comando.set_defaults(funcao=serializacao)
+
+    comando = comandos.add_parser("modos", help="compara os modos sync e async da API")
+    comando.add_argument("--modos", nargs="+", default=["sync", "async"])
+    comando.add_argument("--clientes", nargs="+", type=int, default=[50, 100, 250, 500])
+    comando.add_argument("--duracao", type=float, default=10, help="segundos por medição")
+    comando.set_defaults(funcao=modos)
+
+    args = parser.parse_args()
+    sys.exit(args.funcao(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+"""Gerador determinístico de uma clínica sintética.
+
+A mesma semente e os mesmos parâmetros produzem sempre as mesmas linhas
+(incluindo os ids), por isso duas corridas do benchmark sobre o mesmo tamanho
+medem exatamente os mesmos dados. As linhas são geradas em streaming, pela
+ordem das FKs (Usuario -> Paciente/Medico/Funcionario -> Marcacao -> Consulta
+-> ConsultaService/Pagamento), e gravadas em lotes com executemany, em
+transações grandes e com os índices secundários adiados para o fim. A memória
+usada não depende do número de linhas, além de 16 bytes por paciente.
+
+    python gerir.py gerar-dados --tamanho enorme --semente 7
+
+O caminho da base de dados vem de CLINICA_DB, lido quando o módulo api é
+importado.
+"""
+
+import hashlib
+import random
+import uuid
+from datetime import date, datetime, time, timedelta, timezone
+from operator import itemgetter
+from typing import Optional
+
+from pydantic import BaseModel
+import api
+
+
+TAMANHOS = {
+    "pequeno": {"pacientes": 1_000, "medicos": 10, "funcionarios": 5, "anos": 1, "marcacoes_dia": 40},
+    "medio": {"pacientes": 20_000, "medicos": 40, "funcionarios": 20, "anos": 3, "marcacoes_dia": 200},
+    "grande": {"pacientes": 200_000, "medicos": 150, "funcionarios": 60, "anos": 5, "marcacoes_dia": 800},
+    # ~12 milhões de linhas
+    "enorme": {"pacientes": 1_000_000, "medicos": 300, "funcionarios": 100, "anos": 5, "marcacoes_dia": 1_800},
+}
+
+NOMES = [
+    "Ana", "António", "Beatriz", "Carlos", "Domingos", "Esperança", "Fátima", "Francisco",
+    "Graça", "Helena", "Isabel", "João", "Joaquim", "Luísa", "Manuel", "Maria", "Miguel",
+    "Nzinga", "Paulo", "Paulina", "Pedro", "Rosa", "Teresa", "Victor",
+]
+APELIDOS = [
+    "Afonso", "Baptista", "Cardoso", "Costa", "Domingos", "Fernandes", "Gomes", "Kiala",
+    "Lopes", "Mendes", "Neto", "Pereira", "Quintas", "Santos", "Silva", "Sousa", "Tavares",
+]
+BAIRROS = ["Maianga", "Ingombota", "Rangel", "Cazenga", "Viana", "Talatona", "Kilamba", "Cacuaco"]
+ESPECIALIDADES = ["Clínica Geral", "Pediatria", "Cardiologia", "Ginecologia", "Ortopedia", "Dermatologia"]
+CARGOS = ["Rececionista", "Enfermeiro", "Administrativo", "Técnico de Laboratório"]
+CATALOGO = [
+    ("Consulta geral", 5000), ("Consulta de especialidade", 9000), ("Análises clínicas", 7500),
+    ("Raio-X", 12000), ("Ecografia", 15000), ("Eletrocardiograma", 8000), ("Vacinação", 3000),
+    ("Curativo", 2500), ("Injeção", 1500), ("Pequena cirurgia", 30000),
+]
+METODOS_PAGAMENTO = ["numerario", "multicaixa", "transferencia", "seguro"]
+
+# horário por omissão da agenda (api.HORARIO_PADRAO): dias úteis, 08:00-17:00 em blocos de 30 min
+SLOTS_POR_DIA = 18
+
+
+class Parametros(BaseModel):
+    semente: int = 42
+    pacientes: int = 1_000
+    medicos: int = 10
+    funcionarios: int = 5
+    servicos: int = 20
+    anos: float = 1
+    marcacoes_dia: int = 40
+    ate: Optional[date] = None  # último dia com marcações passadas; por omissão hoje
+
+
+class Amostra:
+    """Amostra de tamanho fixo (reservoir sampling) dos ids gerados, para a carga."""
+
+    def __init__(self, rnd: random.Random, tamanho: int = 5_000):
+        self.rnd = rnd
+        self.tamanho = tamanho
+        self.itens = {}
+        self.vistos = {}
+
+    def adicionar(self, grupo: str, item):
+        itens = self.itens.setdefault(grupo, [])
+        vistos = self.vistos[grupo] = self.vistos.get(grupo, 0) + 1
+        if len(itens) < self.tamanho:
+            itens.append(item)
+        else:
+            j = self.rnd.randrange(vistos)
+            if j < self.tamanho:
+                itens[j] = item
+
+
+def id_temporal(rnd: random.Random, momento: datetime):
+    # uuid7 (ordenado pelo tempo, como os ids criados pela API) mas com os bits
+    # aleatórios tirados do gerador com semente
+    aleatorio = rnd.getrandbits(74)
+    valor = (
+        (int(momento.timestamp() * 1000) << 80)
+        | (0x7 << 76)
+        | ((aleatorio >> 62) << 64)
+        | (0b10 << 62)
+        | (aleatorio & ((1 << 62) - 1))
+    )
+    return uuid.UUID(int=valor)
+
+
+def id_aleatorio(rnd: random.Random):
+    return uuid.UUID(int=rnd.getrandbits(128), version=4)
+
+
+# todas as contas sintéticas entram com esta senha; o hash é um só, com o sal
+# tirado da semente, para não calcular um scrypt por conta
+SENHA_SINTETICA = "clinica"
+
+
+def usuario(rnd, momento, username, tipo, senha_has):
+    return {
+        "id": id_temporal(rnd, momento),
+        "username": username,
+        "senha_has": senha_has,
+        "email": f"{username}@clinica.local",
+        "tipo_usuario": tipo,
+    }
+
+
+def telefone(rnd):
+    return f"9{rnd.randrange(10**8):08d}"
+
+
+def nome_completo(rnd):
+    return f"{rnd.choice(NOMES)} {rnd.choice(APELIDOS)} {rnd.choice(APELIDOS)}"
+
+
+def gerar_clinica(p: Parametros, amostra: Amostra):
+    """Gera (modelo, linha) pela ordem das FKs."""
+    rnd = random.Random(p.semente)
+    ate = p.ate or date.today()
+    inicio = ate - timedelta(days=int(p.anos * 365))
+    momento_inicio = datetime.combine(inicio, time(8), tzinfo=timezone.utc)
+    duracao = datetime.combine(ate, time(8), tzinfo=timezone.utc) - momento_inicio
+    senha_has = api.gerar_hash_senha(SENHA_SINTETICA, hashlib.sha256(f"senha-{p.semente}".encode()).digest()[:16])
+
+    servicos = []
+    for i in range(p.servicos):
+        nome, preco = CATALOGO[i % len(CATALOGO)]
+        if i >= len(CATALOGO):
+            nome = f"{nome} {i // len(CATALOGO) + 1}"
+        linha = {"id": id_temporal(rnd, momento_inicio), "nome_servico": nome, "descricao": nome, "preco": float(preco)}
+        servicos.append((linha["id"], linha["preco"]))
+        amostra.adicionar("servicos", linha["id"])
+        yield api.Servico, linha
+
+    medicos = []
+    for i in range(p.medicos):
+        conta = usuario(rnd, momento_inicio, f"medico{i}", api.TipoUsuario.MEDICO, senha_has)
+        yield api.Usuario, conta
+        linha = {
+            "id": id_temporal(rnd, momento_inicio),
+            "nome_medico": "Dr(a). " + nome_completo(rnd),
+            "especialidade": ESPECIALIDADES[i % len(ESPECIALIDADES)],
+            "telefone": telefone(rnd),
+            "email": f"medico{i}@clinica.local",
+            "usuario_id": conta["id"],
+        }
+        medicos.append(linha["id"])
+        amostra.adicionar("medicos", linha["id"])
+        yield api.Medico, linha
+
+    for i in range(p.funcionarios):
+        conta = usuario(rnd, momento_inicio, f"funcionario{i}", api.TipoUsuario.FUNCIONARIO, senha_has)
+        yield api.Usuario, conta
+        yield api.Funcionario, {
+            "id": id_temporal(rnd, momento_inicio),
+            "nome_funcionario": nome_completo(rnd),
+            "cargo": rnd.choice(CARGOS),
+            "telefone": telefone(rnd),
+            "email": f"funcionario{i}@clinica.local",
+            "usuario_id": conta["id"],
+        }
+
+    # 16 bytes por paciente em vez de uma lista de objetos UUID
+    ids_pacientes = bytearray()
+    for i in range(p.pacientes):
+        registo = momento_inicio + duracao * (i / max(p.pacientes, 1))
+        conta = usuario(rnd, registo, f"paciente{i}", api.TipoUsuario.PACIENTE, senha_has)
+        yield api.Usuario, conta
+        linha = {
+            "id": id_aleatorio(rnd),
+            "nome": nome_completo(rnd),
+            "idade": rnd.randrange(0, 95),
+            "genero": rnd.choice("FM"),
+            "num_bi": f"{rnd.randrange(10**9):09d}LA{rnd.randrange(1000):03d}",
+            "telefone": telefone(rnd),
+            "endereco": f"{rnd.choice(BAIRROS)}, Luanda",
+            "email": f"paciente{i}@clinica.local",
+            "data_registro": registo,
+            "usuario_id": conta["id"],
+        }
+        ids_pacientes += linha["id"].bytes
+        amostra.adicionar("pacientes", (linha["id"], linha["nome"]))
+        yield api.Paciente, linha
+
+    def paciente_ao_acaso():
+        k = rnd.randrange(p.pacientes) * 16
+        return uuid.UUID(bytes=bytes(ids_pacientes[k:k + 16]))
+
+    por_dia = min(p.marcacoes_dia, len(medicos) * SLOTS_POR_DIA)
+    if not p.pacientes or not por_dia:
+        return
+
+    # marcações passadas (concluídas, canceladas ou faltas) e 30 dias de agenda futura
+    dia = inicio
+    while dia <= ate + timedelta(days=30):
+        if dia.weekday() >= 5:
+            dia += timedelta(days=1)
+            continue
+        momento = datetime.combine(dia, time(8), tzinfo=timezone.utc)
+        for k in range(por_dia):
+            # médico k % M fica com o slot k // M: nunca dois no mesmo (médico, dia, hora)
+            medico_id = medicos[k % len(medicos)]
+            minutos = 8 * 60 + 30 * (k // len(medicos))
+            hora = time(minutos // 60, minutos % 60)
+            paciente_id = paciente_ao_acaso()
+            if dia > ate:
+                estado = "agendada"
+            else:
+                sorteio = rnd.random()
+                estado = api.ESTADO_MARCACAO_CONCLUIDA if sorteio < 0.88 else api.ESTADO_MARCACAO_CANCELADA if sorteio < 0.95 else "faltou"
+            marcacao = {
+                "id": id_temporal(rnd, momento),
+                "data_marcacao": dia,
+                "hora_marcacao": hora,
+                "estado_marcacao": estado,
+                "paciente_id": paciente_id,
+                "medico_id": medico_id,
+            }
+            yield api.Marcacao, marcacao
+            if estado != api.ESTADO_MARCACAO_CONCLUIDA:
+                continue
+
+            linhas = [
+                {"id": id_temporal(rnd, momento), "servico_id": servico_id, "quantidade": rnd.randint(1, 2), "preco": preco}
+                for servico_id, preco in rnd.sample(servicos, min(len(servicos), rnd.randint(1, 3)))
+            ]
+            total = round(sum(l["quantidade"] * l.pop("preco") for l in linhas), 2)
+            consulta = {
+                "id": id_temporal(rnd, momento),
+                "data_consulta": dia,
+                "hora_consulta": hora,
+                "marcacao_id": marcacao["id"],
+                "paciente_id": paciente_id,
+                "medico_id": medico_id,
+                "servico_id": linhas[0]["servico_id"],
+                "total": total,
+            }
+            yield api.Consulta, consulta
+            amostra.adicionar("consultas", (consulta["id"], paciente_id))
+            for linha in linhas:
+                linha["consulta_id"] = consulta["id"]
+                yield api.ConsultaService, linha
+
+            if rnd.random() < 0.95:
+                yield api.Pagamento, {
+                    "id": id_temporal(rnd, momento),
+                    "valor_pagamento": total,
+                    "metodo_pagamento": rnd.choice(METODOS_PAGAMENTO),
+                    "data_pagamento": dia + timedelta(days=rnd.choice((0, 0, 0, 1, 3))),
+                    "estado_pagamento": "pago" if rnd.random() < 0.9 else "pendente",
+                    "paciente_id": paciente_id,
+                    "consulta_id": consulta["id"],
+                }
+        dia += timedelta(days=1)
+
+
+ORDEM = [
+    api.Usuario, api.Servico, api.Medico, api.Funcionario, api.Paciente,
+    api.Marcacao, api.Consulta, api.ConsultaService, api.Pagamento,
+]
+
+
+class BaseNaoVazia(RuntimeError):
+    pass
+
+
+def preparar_insercao(ligacao, modelo):
+    # INSERT posicional com os conversores de tipo de cada coluna (uuid -> hex,
+    # date -> texto, enum -> nome) obtidos uma vez por tabela: o executemany vai
+    # direto ao cursor, sem o processamento por linha de um insert() core
+    # (as linhas do gerador trazem sempre todas as colunas menos a versao, que
+    # entra como constante)
+    tabela = modelo.__table__
+    colunas = [c for c in tabela.columns if c.name != "versao"]
+    obter = itemgetter(*(c.name for c in colunas))
+    conversores = [
+        (i, conversor)
+        for i, c in enumerate(colunas)
+        if (conversor := c.type.dialect_impl(ligacao.dialect).bind_processor(ligacao.dialect))
+    ]
+    nomes = [c.name for c in colunas]
+    valores = ["?"] * len(colunas)
+    if "versao" in tabela.c:
+        nomes.append("versao")
+        valores.append(str(tabela.c.versao.default.arg))
+    sql = f"INSERT INTO {modelo.__tablename__} ({', '.join(nomes)}) VALUES ({', '.join(valores)})"
+
+    def converter(linha):
+        valores = list(obter(linha))
+        for i, conversor in conversores:
+            valores[i] = conversor(valores[i])
+        return tuple(valores)
+
+    return sql, converter
+
+
+def carregar(ligacao, linhas, tamanho_lote: int = 5_000, linhas_por_transacao: int = 1_000_000, progresso=None):
+    """Grava as linhas em lotes por tabela, com um commit a cada linhas_por_transacao.
+
+    Antes do lote de uma tabela despeja os das tabelas-mãe, para que cada
+    transação só tenha linhas cujas FKs já existem. Em memória fica no máximo
+    um lote por tabela.
+    """
+    insercoes = {modelo: preparar_insercao(ligacao, modelo) for modelo in ORDEM}
+    lotes = {modelo: [] for modelo in ORDEM}
+    contagem = {modelo.__tablename__: 0 for modelo in ORDEM}
+    pendentes = 0
+
+    def despejar(ate_modelo):
+        nonlocal pendentes
+        for modelo in ORDEM[:ORDEM.index(ate_modelo) + 1]:
+            if lotes[modelo]:
+                sql, _ = insercoes[modelo]
+                ligacao.exec_driver_sql(sql, lotes[modelo])
+                contagem[modelo.__tablename__] += len(lotes[modelo])
+                pendentes += len(lotes[modelo])
+                lotes[modelo] = []
+        if pendentes >= linhas_por_transacao:
+            ligacao.commit()
+            pendentes = 0
+            if progresso:
+                progresso(contagem)
+
+    for modelo, linha in linhas:
+        lote = lotes[modelo]
+        lote.append(insercoes[modelo][1](linha))
+        if len(lote) >= tamanho_lote:
+            despejar(modelo)
+    despejar(ORDEM[-1])
+    ligacao.commit()
+    return contagem
+
+
+def adiar_indices(ligacao):
+    # sem índices secundários nem FTS, cada INSERT só escreve na tabela; no fim
+    # api.create_db_and_tables() recria os índices em falta e reconstrói a
+    # pesquisa de uma vez. A versão do esquema volta a 0 na mesma transação:
+    # se a carga for interrompida, o próximo arranque da API faz o mesmo.
+    for modelo in ORDEM:
+        for indice in modelo.__table__.indexes:
+            ligacao.exec_driver_sql(f"DROP INDEX IF EXISTS {indice.name}")
+    api.remover_pesquisa_pacientes(ligacao)
+    api.esquema_incompleto(ligacao)
+    ligacao.commit()
+
+
+def povoar(
+    parametros: Parametros,
+    tamanho_lote: int = 5_000,
+    linhas_por_transacao: int = 1_000_000,
+    progresso=None,
+):
+    """Grava a clínica sintética numa base vazia e reconstrói índices, pesquisa e resumos."""
+    api.create_db_and_tables()
+    amostra = Amostra(random.Random(parametros.semente + 1))
+    with api.clinica().engine.connect() as ligacao:
+        if ligacao.exec_driver_sql("SELECT 1 FROM usuario LIMIT 1").first():
+            raise BaseNaoVazia(f"A base de dados {api.clinica().db_file} já tem dados")
+
+        anteriores = {
+            pragma: ligacao.exec_driver_sql(f"PRAGMA {pragma}").scalar()
+            for pragma in ("synchronous", "cache_size")
+        }
+        # numa base nova, perder a carga num crash só obriga a repeti-la
+        ligacao.exec_driver_sql("PRAGMA synchronous=OFF")
+        ligacao.exec_driver_sql("PRAGMA cache_size=-262144")  # 256 MiB
+        try:
+            adiar_indices(ligacao)
+            contagem = carregar(
+                ligacao, gerar_clinica(parametros, amostra), tamanho_lote, linhas_por_transacao, progresso
+            )
+        finally:
+            ligacao.rollback()
+            for pragma, valor in anteriores.items():
+                ligacao.exec_driver_sql(f"PRAGMA {pragma}={valor}")
+
+    api.create_db_and_tables()
+    with api.clinica().engine.begin() as ligacao:
+        api.reconstruir_resumos(ligacao)
+        ligacao.exec_driver_sql("ANALYZE")
+    return contagem, amostra
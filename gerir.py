@@ -0,0 +1,324 @@
+"""Comandos de manutenção da base de dados da clínica.
+
+    python gerir.py reconstruir-resumos
+    python gerir.py reconstruir-pesquisa
+    python gerir.py gerar-dados --tamanho grande --semente 42
+    python gerir.py verificar-indices
+    python gerir.py arquivar --dias 730 --vacuum
+    python gerir.py tarefa fechar-marcacoes --dia 2025-01-31
+    python gerir.py migrar --verificar
+    python gerir.py copias
+    python gerir.py restaurar copia-20250131T020000.000Z   (com a API parada)
+    python gerir.py --clinica norte gerar-dados   (com CLINICA_CLINICAS_DIR)
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from enum import Enum
+
+from sqlalchemy import event, select
+
+import api
+
+
+def reconstruir_resumos(_args):
+    api.create_db_and_tables()
+    with api.clinica().engine.begin() as ligacao:
+        api.reconstruir_resumos(ligacao)
+    print("Resumos reconstruídos")
+
+
+def reconstruir_pesquisa(_args):
+    api.create_db_and_tables()
+    with api.clinica().engine.begin() as ligacao:
+        api.reconstruir_pesquisa_pacientes(ligacao)
+    print("Índice de pesquisa de pacientes reconstruído")
+
+
+def gerar_dados(args):
+    import gerador
+
+    valores = dict(gerador.TAMANHOS[args.tamanho], semente=args.semente, ate=args.ate)
+    for campo in ("pacientes", "medicos", "funcionarios", "servicos", "anos", "marcacoes_dia"):
+        if getattr(args, campo) is not None:
+            valores[campo] = getattr(args, campo)
+    parametros = gerador.Parametros(**valores)
+
+    inicio = time.perf_counter()
+
+    def progresso(contagem):
+        total = sum(contagem.values())
+        decorrido = time.perf_counter() - inicio
+        print(f"{total:>12,} linhas  {decorrido:>7.1f} s  {total / decorrido:>9,.0f} linhas/s", flush=True)
+
+    try:
+        contagem, _ = gerador.povoar(parametros, args.lote, args.linhas_por_transacao, progresso)
+    except gerador.BaseNaoVazia as erro:
+        sys.exit(f"{erro}; use uma base nova (CLINICA_DB)")
+
+    total = sum(contagem.values())
+    print(f"{total:,} linhas em {time.perf_counter() - inicio:.1f} s (com índices, pesquisa e resumos)")
+    for tabela, n in contagem.items():
+        print(f"  {tabela:<16} {n:>12,}")
+
+
+def plano(ligacao, consulta):
+    # corre a consulta para obter o SQL e os parâmetros já convertidos e pede
+    # o plano dessa mesma instrução
+    capturadas = []
+
+    def capturar(_ligacao, _cursor, instrucao, parametros, _contexto, _executemany):
+        capturadas.append((instrucao, parametros))
+
+    event.listen(ligacao, "before_cursor_execute", capturar)
+    try:
+        ligacao.execute(consulta).all()
+    finally:
+        event.remove(ligacao, "before_cursor_execute", capturar)
+    instrucao, parametros = capturadas[0]
+    return [linha[-1] for linha in ligacao.exec_driver_sql("EXPLAIN QUERY PLAN " + instrucao, parametros)]
+
+
+def valor_exemplo(ligacao, modelo, campo):
+    valor = ligacao.execute(select(getattr(modelo, campo)).limit(1)).scalar()
+    if valor is not None:
+        return valor
+    tipo = modelo.model_fields[campo].annotation
+    exemplos = {uuid.UUID: uuid.UUID(int=0), date: date.today(), datetime: datetime.now(timezone.utc)}
+    if tipo in exemplos:
+        return exemplos[tipo]
+    if issubclass(tipo, Enum):
+        return next(iter(tipo))
+    return tipo()
+
+
+def casos_listas(ligacao):
+    """(descrição, consulta, exige_ordem_do_indice) para cada filtro e ordenação das listas."""
+    for modelo, filtros in api.FILTROS_LISTA.items():
+        tabela = modelo.__tablename__
+        for campo in filtros:
+            coluna = getattr(modelo, campo)
+            valor = valor_exemplo(ligacao, modelo, campo)
+            lista = api.Listagem(modelo, condicoes=[coluna == valor])
+            yield f"{tabela}?{campo}=", api.consulta_pagina(modelo, api.LIMITE_PADRAO, None, lista), False
+            if isinstance(valor, (date, datetime)):
+                lista = api.Listagem(modelo, condicoes=[coluna >= valor, coluna <= valor])
+                yield f"{tabela}?{campo}_de=&{campo}_ate=", api.consulta_pagina(modelo, api.LIMITE_PADRAO, None, lista), False
+        cursor = ligacao.execute(select(modelo.id).limit(1)).scalar() or uuid.UUID(int=0)
+        for ordenacao in api.ORDENACOES_LISTA.get(modelo, []):
+            for descendente in (False, True):
+                lista = api.Listagem(modelo, ordenacao=ordenacao, descendente=descendente)
+                sort = ",".join(("-" if descendente else "") + c for c in ordenacao)
+                yield f"{tabela}?sort={sort}&after=", api.consulta_pagina(modelo, api.LIMITE_PADRAO, cursor, lista), True
+
+
+def problemas_plano(ligacao, consulta, exige_ordem):
+    """Devolve (passo principal do plano, problemas encontrados) de uma consulta de lista."""
+    tabela = consulta.get_final_froms()[0].name
+    linhas = plano(ligacao, consulta)
+    # o primeiro passo sobre a tabela é o da consulta principal (o cursor é
+    # uma subconsulta pela PK)
+    principal = next(l for l in linhas if l.startswith(("SCAN", "SEARCH")) and f" {tabela}" in l)
+    problemas = []
+    if exige_ordem:
+        if " INDEX ix_" not in principal:
+            problemas.append("sem índice de ordenação")
+        if any("TEMP B-TREE FOR ORDER BY" in l for l in linhas):
+            problemas.append("ordena em memória")
+    elif not principal.startswith("SEARCH"):
+        problemas.append("percorre a tabela inteira")
+    # subconsultas e junções também não podem percorrer tabelas principais
+    percorridas = {l.split()[1] for l in linhas if l.startswith("SCAN ")} & set(api.SQLModel.metadata.tables)
+    problemas.extend(f"percorre {t}" for t in sorted(percorridas - {tabela}))
+    return principal, problemas
+
+
+def verificar_indices(_args):
+    api.create_db_and_tables()
+    falhas = 0
+    with api.clinica().engine.connect() as ligacao:
+        for descricao, consulta, exige_ordem in casos_listas(ligacao):
+            principal, problemas = problemas_plano(ligacao, consulta, exige_ordem)
+            falhas += bool(problemas)
+            estado = "FALHA " + ", ".join(problemas) if problemas else "ok"
+            print(f"{descricao:<55} {estado:<30} {principal}")
+    if falhas:
+        sys.exit(f"{falhas} consulta(s) de lista sem índice adequado")
+
+
+def arquivar(args):
+    api.create_db_and_tables()
+    limite = date.today() - timedelta(days=args.dias)
+    inicio = time.perf_counter()
+
+    def progresso(contagem):
+        print(f"{sum(contagem.values()):>12,} linhas  {time.perf_counter() - inicio:>7.1f} s", flush=True)
+
+    contagem = api.arquivar(limite, args.lote, progresso)
+    print(f"Arquivado tudo o que é anterior a {limite} em {api.clinica().arquivo_file}")
+    for tabela, n in contagem.items():
+        print(f"  {tabela:<16} {n:>12,}")
+    if args.vacuum:
+        # devolve ao sistema as páginas libertadas no ficheiro principal
+        with api.clinica().engine.connect() as ligacao:
+            ligacao.exec_driver_sql("VACUUM main")
+        print("Ficheiro principal compactado")
+
+
+def tarefa(args):
+    api.create_db_and_tables()
+    with api.clinica().engine.begin() as ligacao:
+        api.agendar_execucao(ligacao, args.nome, args.dia, repetir=True)
+        execucao_id = ligacao.execute(
+            select(api.ExecucaoTarefa.id).where(api.ExecucaoTarefa.tarefa == args.nome, api.ExecucaoTarefa.dia == args.dia)
+        ).scalar()
+        execucao = api.reclamar_execucao(ligacao, execucao_id)
+    if execucao is None:
+        sys.exit(f"A tarefa {args.nome} ({args.dia}) já está em curso noutro processo")
+    inicio = time.perf_counter()
+
+    def mostrar(progresso):
+        print(f"{progresso.processados:>12,} linhas  {progresso.lotes:>6} lotes  {time.perf_counter() - inicio:>7.1f} s", flush=True)
+
+    progresso = api.executar_execucao(execucao, threading.Event(), mostrar)
+    print(
+        f"{args.nome} ({args.dia}): {progresso.processados:,} linhas em {progresso.lotes} lotes, "
+        f"{time.perf_counter() - inicio:.1f} s, lote mais longo {progresso.lote_max_ms:.0f} ms"
+    )
+    for chave, valor in progresso.resultado.items():
+        print(f"  {chave:<20} {valor:>12,}" if isinstance(valor, int) else f"  {chave:<20} {valor}")
+    with api.clinica().engine.connect() as ligacao:
+        erro = ligacao.execute(select(api.ExecucaoTarefa.erro).where(api.ExecucaoTarefa.id == execucao.id)).scalar()
+    if erro:
+        sys.exit(erro)
+
+
+def migrar(args):
+    # sem --clinica e com várias clínicas, migra todas as que existem
+    nomes = api.clinicas.conhecidas() if args.clinica is None else [args.clinica]
+    pendentes = 0
+    inicio = time.perf_counter()
+
+    def mostrar(ficheiro, versao, descricao):
+        print(f"  {ficheiro} versão {versao} ({descricao}) aplicada  {time.perf_counter() - inicio:>7.1f} s", flush=True)
+
+    for nome in nomes:
+        atual = api.clinicas.adquirir(nome)
+        token = api.clinica_atual.set(atual)
+        try:
+            if atual.nome is not None:
+                os.makedirs(os.path.dirname(atual.db_file), exist_ok=True)
+            with atual.engine.connect() as ligacao:
+                estado = api.estado_migracoes(ligacao)
+            for ficheiro, (versao, ultima, descricoes) in estado.items():
+                print(f"{atual.db_file} {ficheiro}: versão {versao} de {ultima}")
+                for numero, descricao in enumerate(descricoes, versao + 1):
+                    print(f"  pendente {numero}: {descricao}")
+                pendentes += len(descricoes)
+            if not args.verificar:
+                api.migrar(mostrar)
+        finally:
+            api.clinica_atual.reset(token)
+            api.clinicas.libertar(atual)
+    if args.verificar and pendentes:
+        sys.exit(f"{pendentes} migração(ões) pendente(s)")
+
+
+def copias(_args):
+    api.create_db_and_tables()
+    for manifesto in api.listar_copias():
+        linhas = sum(sum(contagem.values()) for contagem in manifesto["contagens"].values())
+        print(
+            f"{manifesto['nome']}  {manifesto['bytes'] / 2**20:>9,.1f} MiB  {linhas:>12,} linhas  "
+            f"{manifesto['duracao_ms'] / 1000:>7.1f} s  {manifesto['integridade']}"
+        )
+
+
+def restaurar(args):
+    api.create_db_and_tables()
+    inicio = time.perf_counter()
+    try:
+        anterior = api.restaurar_copia(args.nome)
+    except (LookupError, api.CopiaInvalida, api.EsquemaDesatualizado) as erro:
+        sys.exit(str(erro))
+    print(f"Cópia {args.nome} restaurada em {time.perf_counter() - inicio:.1f} s")
+    print(f"A base anterior ficou na cópia {anterior['nome']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clinica", help="clínica a usar, quando há várias (CLINICA_CLINICAS_DIR)")
+    comandos = parser.add_subparsers(dest="comando", required=True)
+
+    comando = comandos.add_parser("reconstruir-resumos", help="refaz as tabelas de resumo dos relatórios")
+    comando.set_defaults(funcao=reconstruir_resumos)
+
+    comando = comandos.add_parser("reconstruir-pesquisa", help="refaz o índice FTS5 de pesquisa de pacientes")
+    comando.set_defaults(funcao=reconstruir_pesquisa)
+
+    comando = comandos.add_parser("gerar-dados", help="povoa uma base vazia com uma clínica sintética determinística")
+    comando.add_argument("--tamanho", choices=["pequeno", "medio", "grande", "enorme"], default="pequeno")
+    comando.add_argument("--semente", type=int, default=42)
+    comando.add_argument("--ate", type=date.fromisoformat, help="último dia de histórico (AAAA-MM-DD); por omissão hoje")
+    comando.add_argument("--pacientes", type=int)
+    comando.add_argument("--medicos", type=int)
+    comando.add_argument("--funcionarios", type=int)
+    comando.add_argument("--servicos", type=int)
+    comando.add_argument("--anos", type=float)
+    comando.add_argument("--marcacoes-dia", dest="marcacoes_dia", type=int)
+    comando.add_argument("--lote", type=int, default=5_000, help="linhas por executemany")
+    comando.add_argument("--linhas-por-transacao", type=int, default=1_000_000)
+    comando.set_defaults(funcao=gerar_dados)
+
+    comando = comandos.add_parser(
+        "verificar-indices", help="confirma com EXPLAIN QUERY PLAN que os filtros e ordenações das listas usam índices"
+    )
+    comando.set_defaults(funcao=verificar_indices)
+
+    comando = comandos.add_parser("arquivar", help="move consultas, marcações e pagamentos antigos para o arquivo")
+    comando.add_argument("--dias", type=int, default=api.ARQUIVO_DIAS, help="idade mínima, em dias, do que é arquivado")
+    comando.add_argument("--lote", type=int, default=1_000, help="consultas movidas por transação")
+    comando.add_argument("--vacuum", action="store_true", help="compacta o ficheiro principal no fim")
+    comando.set_defaults(funcao=arquivar)
+
+    comando = comandos.add_parser("tarefa", help="corre já uma das tarefas noturnas (sem esperar pelo agendador)")
+    comando.add_argument("nome", choices=list(api.TAREFAS))
+    comando.add_argument("--dia", type=date.fromisoformat, default=date.today(), help="dia de referência (AAAA-MM-DD); por omissão hoje")
+    comando.set_defaults(funcao=tarefa)
+
+    comando = comandos.add_parser("migrar", help="aplica as migrações do esquema em falta (antes de arrancar a API)")
+    comando.add_argument("--verificar", action="store_true", help="só mostra as versões; termina com erro se houver migrações pendentes")
+    comando.set_defaults(funcao=migrar)
+
+    comando = comandos.add_parser("copias", help="lista as cópias de segurança da clínica")
+    comando.set_defaults(funcao=copias)
+
+    comando = comandos.add_parser("restaurar", help="verifica uma cópia de segurança e grava-a por cima da base (com a API parada)")
+    comando.add_argument("nome", help="nome da cópia, como copia-20250131T020000.000Z")
+    comando.set_defaults(funcao=restaurar)
+
+    args = parser.parse_args()
+    if args.clinica is not None:
+        if not api.CLINICAS_DIR:
+            sys.exit("--clinica só se usa com CLINICA_CLINICAS_DIR definido")
+        # só gerar-dados cria a pasta de uma clínica nova
+        if not api.NOME_CLINICA_RE.fullmatch(args.clinica) or not (
+            args.comando == "gerar-dados" or api.clinicas.existe(args.clinica)
+        ):
+            sys.exit(f"Clínica não encontrada: {args.clinica}")
+    elif api.CLINICAS_DIR and args.comando != "migrar":
+        sys.exit("Indique a clínica com --clinica")
+    if args.comando == "migrar":
+        # não passa por usar_clinica: preparar() aplicaria logo as migrações
+        return args.funcao(args)
+    with api.usar_clinica(args.clinica, criar=args.comando == "gerar-dados"):
+        args.funcao(args)
+
+
+if __name__ == "__main__":
+    main()
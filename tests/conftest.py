@@ -0,0 +1,122 @@
+"""Configuração comum dos testes.
+
+Cada sessão de testes usa uma base de dados nova numa pasta temporária. As
+variáveis de ambiente são lidas quando api é importado, por isso têm de ser
+definidas aqui, antes do primeiro import.
+"""
+
+import os
+import sys
+import tempfile
+import uuid
+from datetime import date, timedelta
+
+PASTA_TESTES = tempfile.mkdtemp(prefix="clinica-testes-")
+os.environ.setdefault("CLINICA_DB", os.path.join(PASTA_TESTES, "database.db"))
+os.environ.setdefault("CLINICA_TAREFAS", "0")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api
+
+
+@pytest.fixture(scope="session")
+def cliente():
+    with TestClient(api.app) as c:
+        yield c
+
+
+def proxima_segunda():
+    hoje = date.today()
+    return hoje + timedelta(days=7 - hoje.weekday())
+
+
+class Fabrica:
+    """Cria pela API os registos de que os testes precisam, com valores únicos."""
+
+    def __init__(self, cliente):
+        self.cliente = cliente
+
+    def criar(self, caminho, dados):
+        resposta = self.cliente.post(caminho, json=dados)
+        assert resposta.status_code == 200, resposta.text
+        return resposta.json()
+
+    def usuario(self, tipo="medico"):
+        sufixo = uuid.uuid4().hex[:12]
+        return self.criar("/usuarios", {
+            "username": f"u{sufixo}",
+            "senha_has": "segredo",
+            "email": f"u{sufixo}@clinica.test",
+            "tipo_usuario": tipo,
+        })
+
+    def medico(self):
+        usuario = self.usuario("medico")
+        return self.criar("/medicos", {
+            "nome_medico": "Dra. Teste",
+            "especialidade": "clinica geral",
+            "telefone": "923000000",
+            "email": usuario["email"],
+            "usuario_id": usuario["id"],
+        })
+
+    def paciente(self):
+        usuario = self.usuario("paciente")
+        return self.criar("/pacientes", {
+            "nome": "Paciente Teste",
+            "idade": 40,
+            "genero": "F",
+            "num_bi": uuid.uuid4().hex[:14],
+            "telefone": "924000000",
+            "endereco": "Luanda",
+            "email": usuario["email"],
+            "data_registro": "2025-01-01T10:00:00Z",
+            "usuario_id": usuario["id"],
+        })
+
+    def servico(self, preco=20.0):
+        return self.criar("/servicos", {"nome_servico": f"s{uuid.uuid4().hex[:8]}", "descricao": "teste", "preco": preco})
+
+    def marcacao(self, medico, paciente, dia, hora, estado="agendada"):
+        """Devolve a resposta, para os testes verificarem os erros."""
+        return self.cliente.post("/marcacao", json={
+            "data_marcacao": dia.isoformat(),
+            "hora_marcacao": hora,
+            "estado_marcacao": estado,
+            "paciente_id": paciente["id"],
+            "medico_id": medico["id"],
+        })
+
+    def consulta(self, marcacao, servico):
+        return self.criar("/consultas", {
+            "data_consulta": marcacao["data_marcacao"],
+            "hora_consulta": marcacao["hora_marcacao"],
+            "marcacao_id": marcacao["id"],
+            "paciente_id": marcacao["paciente_id"],
+            "medico_id": marcacao["medico_id"],
+            "servico_id": servico["id"],
+        })
+
+    def linha(self, consulta, servico, quantidade=1):
+        return self.criar("/consulta_servico", {
+            "consulta_id": consulta["id"],
+            "servico_id": servico["id"],
+            "quantidade": quantidade,
+        })
+
+    def consulta_com_servico(self, preco=20.0):
+        """Uma consulta com uma linha de um serviço novo; devolve (consulta, servico)."""
+        medico, paciente = self.medico(), self.paciente()
+        marcacao = self.marcacao(medico, paciente, proxima_segunda(), "11:00:00").json()
+        servico = self.servico(preco)
+        consulta = self.consulta(marcacao, servico)
+        self.linha(consulta, servico)
+        return consulta, servico
+
+
+@pytest.fixture
+def fabrica(cliente):
+    return Fabrica(cliente)
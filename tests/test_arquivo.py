@@ -0,0 +1,72 @@
+"""Leituras que juntam o ficheiro principal com o arquivo."""
+
+import json
+import uuid
+from datetime import date, time
+
+from sqlalchemy import insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+import api
+
+# antes de qualquer data criada pelos outros testes
+LIMITE = date(2000, 1, 1)
+
+
+def gravar(modelo, linhas, principal=True, arquivo=True):
+    """Grava as linhas no principal e/ou no arquivo, com o limite do arquivo em LIMITE."""
+    with api.clinica().engine.begin() as ligacao:
+        ligacao.execute(
+            sqlite_insert(api.limite_arquivo)
+            .values(id=1, limite=LIMITE)
+            .on_conflict_do_nothing(index_elements=["id"])
+        )
+        if principal:
+            ligacao.execute(insert(modelo.__table__), linhas)
+        if arquivo:
+            ligacao.execute(insert(api.TABELAS_ARQUIVO[modelo]), linhas)
+
+
+def marcacao(marcacao_id, medico, paciente, dia, hora):
+    return {
+        "id": marcacao_id, "data_marcacao": dia, "hora_marcacao": hora, "estado_marcacao": "concluida",
+        "paciente_id": uuid.UUID(paciente["id"]), "medico_id": uuid.UUID(medico["id"]), "versao": 1,
+    }
+
+
+def test_exportacao_junta_o_arquivo_por_data_e_id(cliente, fabrica):
+    medico, paciente = fabrica.medico(), fabrica.paciente()
+    dia = date(1999, 6, 1)
+    # a mesma data nos dois ficheiros, com horas por ordem inversa à dos ids
+    ids = sorted(uuid.uuid7() for _ in range(4))
+    linhas = [marcacao(ids[k], medico, paciente, dia, time(17 - k)) for k in range(4)]
+    gravar(api.Marcacao, linhas[:2], principal=False)
+    gravar(api.Marcacao, linhas[2:3], arquivo=False)
+    # a meio de ser arquivada: está nos dois ficheiros
+    gravar(api.Marcacao, linhas[3:])
+
+    resposta = cliente.get("/export/marcacao", params={"de": "1999-06-01", "ate": "1999-06-01"})
+    assert resposta.status_code == 200
+    assert [json.loads(linha)["id"] for linha in resposta.text.splitlines()] == [str(i) for i in ids]
+
+
+def test_fatura_de_consulta_arquivada(cliente, fabrica):
+    consulta, servico = fabrica.consulta_com_servico(preco=12.5)
+    arquivada = {
+        "id": uuid.uuid4(), "data_consulta": date(1999, 6, 2), "hora_consulta": time(9),
+        "total": 25.0, "versao": 1,
+        **{c: uuid.UUID(consulta[c]) for c in ("marcacao_id", "paciente_id", "medico_id", "servico_id")},
+    }
+    gravar(api.Consulta, [arquivada], principal=False)
+    gravar(api.ConsultaService, [{
+        "id": uuid.uuid4(), "consulta_id": arquivada["id"], "servico_id": uuid.UUID(servico["id"]),
+        "quantidade": 2, "versao": 1,
+    }], principal=False)
+
+    resposta = cliente.get(f"/consultas/{arquivada['id']}/fatura")
+    assert resposta.status_code == 200, resposta.text
+    fatura = resposta.json()
+    assert fatura["data_consulta"] == "1999-06-02"
+    assert [(l["servico_id"], l["quantidade"], l["subtotal"]) for l in fatura["linhas"]] == [(servico["id"], 2, 25.0)]
+    assert fatura["total"] == 25.0
+    assert cliente.get(f"/consultas/{uuid.uuid4()}/fatura").status_code == 404
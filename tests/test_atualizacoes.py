@@ -0,0 +1,41 @@
+"""PUT e PATCH num só UPDATE, com a versão do registo."""
+
+import uuid
+
+
+def test_patch_com_versao(cliente, fabrica):
+    paciente = fabrica.paciente()
+    assert paciente["versao"] == 1
+
+    resposta = cliente.patch(f"/pacientes/{paciente['id']}", json={"telefone": "921111111"}, headers={"If-Match": '"1"'})
+    assert resposta.status_code == 200, resposta.text
+    assert (resposta.json()["telefone"], resposta.json()["versao"]) == ("921111111", 2)
+
+    # outro cliente ainda com a versão 1
+    resposta = cliente.patch(f"/pacientes/{paciente['id']}", json={"telefone": "922222222"}, headers={"If-Match": '"1"'})
+    assert resposta.status_code == 409
+    resposta = cliente.patch(f"/pacientes/{paciente['id']}", json={"telefone": "922222222", "versao": 1})
+    assert resposta.status_code == 409
+    atual = cliente.get(f"/pacientes/{paciente['id']}").json()
+    assert (atual["telefone"], atual["versao"]) == ("921111111", 2)
+
+    # sem versão, a gravação não é condicional
+    resposta = cliente.patch(f"/pacientes/{paciente['id']}", json={"telefone": "923333333"})
+    assert resposta.json()["versao"] == 3
+
+
+def test_put_com_versao(cliente, fabrica):
+    paciente = fabrica.paciente()
+    alterado = {**paciente, "endereco": "Huambo", "versao": 1}
+    resposta = cliente.put(f"/pacientes/{paciente['id']}", json=alterado)
+    assert resposta.status_code == 200, resposta.text
+    assert resposta.json()["versao"] == 2
+
+    resposta = cliente.put(f"/pacientes/{paciente['id']}", json={**alterado, "endereco": "Lubango"})
+    assert resposta.status_code == 409
+    assert cliente.get(f"/pacientes/{paciente['id']}").json()["endereco"] == "Huambo"
+
+
+def test_versao_de_registo_inexistente(cliente):
+    resposta = cliente.patch(f"/pacientes/{uuid.uuid4()}", json={"telefone": "920000000"}, headers={"If-Match": '"1"'})
+    assert resposta.status_code == 404
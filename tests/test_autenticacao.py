@@ -0,0 +1,104 @@
+"""Login, logout e mudança de senha."""
+
+import os
+import uuid
+
+from sqlmodel import Session, select
+
+import api
+
+
+def entrar(cliente, username, senha):
+    return cliente.post("/auth/login", json={"username": username, "senha": senha})
+
+
+def cabecalho(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_login_senha_e_logout(cliente, fabrica):
+    usuario = fabrica.usuario()
+    assert "senha_has" not in usuario
+    assert entrar(cliente, usuario["username"], "errada").status_code == 401
+
+    resposta = entrar(cliente, usuario["username"], "segredo")
+    assert resposta.status_code == 200, resposta.text
+    token = resposta.json()["access_token"]
+    assert cliente.get("/auth/sessao", headers=cabecalho(token)).json()["usuario_id"] == usuario["id"]
+
+    # a senha nova fecha a sessão aberta com a antiga
+    assert cliente.put(f"/usuarios/{usuario['id']}/senha", json={"senha": "outra"}).status_code == 200
+    assert cliente.get("/auth/sessao", headers=cabecalho(token)).status_code == 401
+    assert entrar(cliente, usuario["username"], "segredo").status_code == 401
+
+    token = entrar(cliente, usuario["username"], "outra").json()["access_token"]
+    assert cliente.post("/auth/logout", headers=cabecalho(token)).status_code == 200
+    assert cliente.get("/auth/sessao", headers=cabecalho(token)).status_code == 401
+
+
+def test_alterar_senha_por_patch(cliente, fabrica):
+    usuario = fabrica.usuario()
+    resposta = cliente.patch(f"/usuarios/{usuario['id']}", json={"senha_has": "nova"})
+    assert resposta.status_code == 200, resposta.text
+    assert "senha_has" not in resposta.json()
+    assert entrar(cliente, usuario["username"], "nova").status_code == 200
+
+
+def test_senha_de_usuario_inexistente(cliente):
+    assert cliente.put(f"/usuarios/{uuid.uuid4()}/senha", json={"senha": "x"}).status_code == 404
+
+
+def test_respostas_sem_hash_da_senha(cliente, fabrica):
+    usuario = fabrica.usuario()
+    assert "senha_has" not in cliente.get(f"/usuarios/{usuario['id']}").json()
+    pagina = cliente.get("/usuarios", params={"username": usuario["username"]}).json()
+    assert [u["id"] for u in pagina["items"]] == [usuario["id"]]
+    assert "senha_has" not in pagina["items"][0]
+    assert cliente.get("/usuarios", params={"fields": "username,senha_has"}).status_code == 422
+    assert "senha_has" not in cliente.put(f"/usuarios/{usuario['id']}", json={**usuario, "senha_has": "x"}).json()
+
+
+def hash_fraco(senha):
+    sal = os.urandom(16)
+    return f"scrypt$16$1$1${sal.hex()}${api.scrypt(senha, sal, 16, 1, 1).hex()}"
+
+
+def senha_guardada(usuario_id):
+    with Session(api.clinica().engine_leitura) as session:
+        return session.exec(select(api.Usuario.senha_has).where(api.Usuario.id == uuid.UUID(usuario_id))).one()
+
+
+def test_hash_enviado_pelo_cliente_e_tratado_como_senha(cliente, fabrica):
+    escolhido = hash_fraco("fraca")
+    sufixo = uuid.uuid4().hex[:12]
+    usuario = fabrica.criar("/usuarios", {
+        "username": f"u{sufixo}", "senha_has": escolhido, "email": f"u{sufixo}@clinica.test", "tipo_usuario": "medico",
+    })
+    assert senha_guardada(usuario["id"]) != escolhido
+    assert not api.hash_desatualizado(senha_guardada(usuario["id"]))
+    assert entrar(cliente, usuario["username"], "fraca").status_code == 401
+    assert entrar(cliente, usuario["username"], escolhido).status_code == 200
+
+
+def test_bulk_so_aceita_hashes_com_os_parametros_atuais(cliente):
+    def linha(senha_has):
+        sufixo = uuid.uuid4().hex[:12]
+        return {"username": f"u{sufixo}", "senha_has": senha_has, "email": f"u{sufixo}@clinica.test", "tipo_usuario": "medico"}
+
+    resposta = cliente.post("/usuarios/bulk", json=[
+        linha(api.gerar_hash_senha("boa")), linha(hash_fraco("fraca")), linha("texto simples"),
+    ])
+    assert resposta.status_code == 200, resposta.text
+    assert resposta.json()["inseridos"] == 1
+    assert [e["indice"] for e in resposta.json()["erros"]] == [1, 2]
+
+
+def test_login_refaz_hash_com_parametros_fracos(cliente, fabrica):
+    usuario = fabrica.usuario()
+    with Session(api.clinica().engine) as session:
+        session.execute(
+            api.update(api.Usuario).where(api.Usuario.id == uuid.UUID(usuario["id"])).values(senha_has=hash_fraco("segredo"))
+        )
+        session.commit()
+    assert entrar(cliente, usuario["username"], "segredo").status_code == 200
+    assert not api.hash_desatualizado(senha_guardada(usuario["id"]))
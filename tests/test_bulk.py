@@ -0,0 +1,66 @@
+"""POST /{recurso}/bulk: erros por linha sem perder as restantes."""
+
+import asyncio
+import json
+import uuid
+
+import api
+
+
+def paciente(usuario, email=None):
+    return {
+        "nome": "Paciente Lote",
+        "idade": 30,
+        "genero": "M",
+        "num_bi": uuid.uuid4().hex[:14],
+        "telefone": "925000000",
+        "endereco": "Benguela",
+        "email": email or f"p{uuid.uuid4().hex[:12]}@clinica.test",
+        "data_registro": "2025-02-01T09:00:00Z",
+        "usuario_id": usuario["id"],
+    }
+
+
+def test_linhas_invalidas_nao_anulam_o_lote(cliente, fabrica):
+    usuario = fabrica.usuario("paciente")
+    primeiro = paciente(usuario)
+    linhas = [
+        json.dumps(primeiro),
+        "{nao e json",
+        json.dumps({"nome": "Sem os outros campos"}),
+        json.dumps(paciente(usuario, email=primeiro["email"])),  # email repetido: falha no INSERT
+        json.dumps(paciente(usuario)),
+    ]
+    resposta = cliente.post(
+        "/pacientes/bulk", content="\n".join(linhas), headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert resposta.status_code == 200, resposta.text
+    resultado = resposta.json()
+    assert resultado["inseridos"] == 2
+    assert [erro["indice"] for erro in resultado["erros"]] == [1, 2, 3]
+    for paciente_id in resultado["ids"]:
+        assert cliente.get(f"/pacientes/{paciente_id}").status_code == 200
+
+
+def test_lote_demasiado_grande(cliente, fabrica, monkeypatch):
+    monkeypatch.setattr(api, "LIMITE_LINHAS_BULK", 2)
+    servico = {"nome_servico": "lote", "descricao": "x", "preco": 1.0}
+    assert cliente.post("/servicos/bulk", json=[servico] * 3).status_code == 413
+
+
+def test_validacao_fora_do_event_loop(cliente, monkeypatch):
+    validar_lote = api.validar_lote
+    no_loop = []
+
+    def espiar(*args):
+        try:
+            asyncio.get_running_loop()
+            no_loop.append(True)
+        except RuntimeError:
+            no_loop.append(False)
+        return validar_lote(*args)
+
+    monkeypatch.setattr(api, "validar_lote", espiar)
+    resposta = cliente.post("/servicos/bulk", json=[{"nome_servico": "lote", "descricao": "x", "preco": 2.0}])
+    assert resposta.json()["inseridos"] == 1
+    assert no_loop == [False]
@@ -0,0 +1,149 @@
+"""Leitores e o escritor único em paralelo, numa base em WAL.
+
+No perfil "producao" as escritas do processo passam todas pela única ligação
+do pool de escrita e os leitores usam o seu próprio pool; nenhum deles deve
+ver "database is locked", por mais que se cruzem.
+"""
+
+import asyncio
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, select
+
+import api
+
+LEITORES = 8
+ESCRITORES = 4
+ESCRITAS = 50  # por escritor
+
+
+@pytest.fixture
+def clinica_wal(tmp_path):
+    atual = api.Clinica(
+        None,
+        str(tmp_path / "database.db"),
+        str(tmp_path / "database-arquivo.db"),
+        str(tmp_path / "database-saida"),
+        str(tmp_path / "database-copias"),
+    )
+    atual.preparar()
+    with atual.engine.connect() as ligacao:
+        assert ligacao.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+    yield atual
+    asyncio.run(atual.fechar())
+
+
+def novo_servico():
+    return api.Servico(nome_servico=f"s{uuid.uuid4().hex[:8]}", descricao="concorrência", preco=10.0)
+
+
+def contar_servicos(atual):
+    with Session(atual.engine_leitura) as session:
+        return session.exec(select(func.count()).select_from(api.Servico)).one()
+
+
+@pytest.mark.skipif(api.NUM_LEITORES == 0, reason="só o perfil com pool de leitura usa WAL")
+def test_leitores_e_escritor_em_threads(clinica_wal):
+    erros = []
+    fim = threading.Event()
+
+    def escrever():
+        try:
+            for _ in range(ESCRITAS):
+                with Session(clinica_wal.engine) as session:
+                    session.add(novo_servico())
+                    session.commit()
+        except OperationalError as erro:
+            erros.append(erro)
+
+    def ler():
+        try:
+            while not fim.is_set():
+                # duas leituras na mesma transação, com commits dos escritores pelo meio
+                with Session(clinica_wal.engine_leitura) as session:
+                    session.exec(select(func.count()).select_from(api.Servico)).one()
+                    session.exec(select(api.Servico).order_by(api.Servico.id.desc()).limit(20)).all()
+        except OperationalError as erro:
+            erros.append(erro)
+
+    with ThreadPoolExecutor(LEITORES + ESCRITORES) as executor:
+        leitores = [executor.submit(ler) for _ in range(LEITORES)]
+        escritores = [executor.submit(escrever) for _ in range(ESCRITORES)]
+        for tarefa in escritores:
+            tarefa.result()
+        fim.set()
+        for tarefa in leitores:
+            tarefa.result()
+
+    assert not erros, erros
+    assert contar_servicos(clinica_wal) == ESCRITORES * ESCRITAS
+
+
+@pytest.mark.skipif(api.NUM_LEITORES == 0, reason="só o perfil com pool de leitura usa WAL")
+def test_leitores_avancam_com_a_escrita_aberta(clinica_wal):
+    antes = contar_servicos(clinica_wal)
+    escrita_aberta, terminar = threading.Event(), threading.Event()
+
+    def escrever():
+        with clinica_wal.engine.connect() as ligacao:
+            ligacao.exec_driver_sql("BEGIN IMMEDIATE")
+            ligacao.execute(api.insert(api.Servico.__table__), [novo_servico().model_dump()])
+            escrita_aberta.set()
+            terminar.wait(30)
+            ligacao.commit()
+
+    with ThreadPoolExecutor(LEITORES + 1) as executor:
+        escritor = executor.submit(escrever)
+        assert escrita_aberta.wait(5)
+        try:
+            # muito abaixo do busy_timeout: um leitor à espera do lock falhava aqui
+            leitores = [executor.submit(contar_servicos, clinica_wal) for _ in range(LEITORES)]
+            assert [leitor.result(timeout=2) for leitor in leitores] == [antes] * LEITORES
+            assert not escritor.done()
+        finally:
+            terminar.set()
+        escritor.result()
+
+    assert contar_servicos(clinica_wal) == antes + 1
+
+
+@pytest.mark.skipif(api.MODO_API != "async", reason="os engines aiosqlite só existem em CLINICA_MODO=async")
+@pytest.mark.skipif(api.NUM_LEITORES == 0, reason="só o perfil com pool de leitura usa WAL")
+def test_leitores_e_escritor_em_tarefas(clinica_wal):
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    erros = []
+
+    async def escrever():
+        try:
+            for _ in range(ESCRITAS):
+                async with AsyncSession(clinica_wal.engine_async) as session:
+                    session.add(novo_servico())
+                    await session.commit()
+        except OperationalError as erro:
+            erros.append(erro)
+
+    async def ler(fim):
+        try:
+            while not fim.is_set():
+                async with AsyncSession(clinica_wal.engine_async_leitura) as session:
+                    (await session.exec(select(func.count()).select_from(api.Servico))).one()
+                    (await session.exec(select(api.Servico).order_by(api.Servico.id.desc()).limit(20))).all()
+        except OperationalError as erro:
+            erros.append(erro)
+
+    async def correr():
+        fim = asyncio.Event()
+        leitores = [asyncio.create_task(ler(fim)) for _ in range(LEITORES)]
+        await asyncio.gather(*(escrever() for _ in range(ESCRITORES)))
+        fim.set()
+        await asyncio.gather(*leitores)
+
+    asyncio.run(correr())
+    assert not erros, erros
+    assert contar_servicos(clinica_wal) == ESCRITORES * ESCRITAS
@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+import api
+from conftest import proxima_segunda
+
+
+@contextmanager
+def contar_instrucoes():
+    contagem = []
+
+    def contar(_ligacao, _cursor, instrucao, _parametros, _contexto, _executemany):
+        contagem.append(instrucao)
+
+    motores = {api.clinica().engine, api.clinica().engine_leitura}
+    for motor in motores:
+        event.listen(motor, "before_cursor_execute", contar)
+    try:
+        yield contagem
+    finally:
+        for motor in motores:
+            event.remove(motor, "before_cursor_execute", contar)
+
+
+def paciente_com_consultas(fabrica, quantas):
+    medico, paciente, servico = fabrica.medico(), fabrica.paciente(), fabrica.servico()
+    inicio = datetime.combine(proxima_segunda(), datetime.min.time()).replace(hour=8)
+    for n in range(quantas):
+        hora = (inicio + timedelta(minutes=30 * n)).time().isoformat()
+        marcacao = fabrica.marcacao(medico, paciente, proxima_segunda(), hora).json()
+        consulta = fabrica.consulta(marcacao, servico)
+        fabrica.linha(consulta, servico, quantidade=2)
+        fabrica.linha(consulta, fabrica.servico(), quantidade=1)
+        fabrica.criar("/pagamentos", {
+            "valor_pagamento": 20.0,
+            "metodo_pagamento": "dinheiro",
+            "data_pagamento": marcacao["data_marcacao"],
+            "estado_pagamento": "pago",
+            "paciente_id": paciente["id"],
+            "consulta_id": consulta["id"],
+        })
+    return paciente
+
+
+def test_historico_com_numero_fixo_de_consultas_sql(cliente, fabrica):
+    pequeno = paciente_com_consultas(fabrica, 1)
+    grande = paciente_com_consultas(fabrica, 12)
+
+    contagens = {}
+    for nome, paciente, esperadas in (("pequeno", pequeno, 1), ("grande", grande, 12)):
+        with contar_instrucoes() as instrucoes:
+            resposta = cliente.get(f"/pacientes/{paciente['id']}/historico")
+        assert resposta.status_code == 200, resposta.text
+        historico = resposta.json()
+        assert len(historico["consultas"]) == esperadas
+        assert all(len(consulta["linhas"]) == 2 for consulta in historico["consultas"])
+        assert len(historico["pagamentos"]) == esperadas
+        contagens[nome] = len(instrucoes)
+
+    assert contagens["pequeno"] > 0
+    assert contagens["pequeno"] == contagens["grande"]
@@ -0,0 +1,78 @@
+"""Idempotency-Key em POST /pagamentos e POST /marcacao."""
+
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+
+import api
+from conftest import proxima_segunda
+
+
+def pagamento(consulta, valor=20.0):
+    return {
+        "valor_pagamento": valor, "metodo_pagamento": "multicaixa", "data_pagamento": consulta["data_consulta"],
+        "estado_pagamento": "pago", "paciente_id": consulta["paciente_id"], "consulta_id": consulta["id"],
+    }
+
+
+def pagamentos_da_consulta(cliente, consulta):
+    return cliente.get("/pagamentos", params={"consulta_id": consulta["id"]}).json()["items"]
+
+
+def test_repeticao_devolve_a_resposta_guardada(cliente, fabrica):
+    consulta, _ = fabrica.consulta_com_servico()
+    chave = {"Idempotency-Key": uuid.uuid4().hex}
+    primeira = cliente.post("/pagamentos", json=pagamento(consulta), headers=chave)
+    assert primeira.status_code == 200, primeira.text
+
+    escritas = []
+
+    def contar(ligacao, cursor, sql, *args):
+        if not sql.lstrip().upper().startswith("SELECT"):
+            escritas.append(sql)
+
+    event.listen(api.clinica().engine, "before_cursor_execute", contar)
+    try:
+        repetida = cliente.post("/pagamentos", json=pagamento(consulta), headers=chave)
+    finally:
+        event.remove(api.clinica().engine, "before_cursor_execute", contar)
+    assert repetida.status_code == 200
+    assert repetida.headers["Idempotent-Replayed"] == "true"
+    assert repetida.json() == primeira.json()
+    # nem as tabelas do negócio nem os resumos são tocados
+    assert not [sql for sql in escritas if "INSERT" in sql.upper() or "UPDATE" in sql.upper()], escritas
+    assert len(pagamentos_da_consulta(cliente, consulta)) == 1
+
+    # a mesma chave com outro corpo é um erro do cliente
+    outro = cliente.post("/pagamentos", json=pagamento(consulta, valor=30.0), headers=chave)
+    assert outro.status_code == 422
+
+
+def test_repeticoes_em_simultaneo_dao_um_pagamento(cliente, fabrica):
+    consulta, _ = fabrica.consulta_com_servico()
+    chave = {"Idempotency-Key": uuid.uuid4().hex}
+    with ThreadPoolExecutor(8) as executor:
+        respostas = list(executor.map(
+            lambda _: cliente.post("/pagamentos", json=pagamento(consulta), headers=chave), range(8)
+        ))
+    # as que chegam com a primeira ainda por gravar recebem 409 e repetem
+    assert {r.status_code for r in respostas} <= {200, 409}
+    assert len({r.json()["id"] for r in respostas if r.status_code == 200}) == 1
+    assert len(pagamentos_da_consulta(cliente, consulta)) == 1
+
+
+def test_marcacao_repetida_nao_da_conflito_de_slot(cliente, fabrica):
+    medico, paciente = fabrica.medico(), fabrica.paciente()
+    corpo = {
+        "data_marcacao": proxima_segunda().isoformat(), "hora_marcacao": "12:00:00", "estado_marcacao": "agendada",
+        "paciente_id": paciente["id"], "medico_id": medico["id"],
+    }
+    chave = {"Idempotency-Key": uuid.uuid4().hex}
+    primeira = cliente.post("/marcacao", json=corpo, headers=chave)
+    assert primeira.status_code == 200, primeira.text
+    repetida = cliente.post("/marcacao", json=corpo, headers=chave)
+    assert repetida.status_code == 200
+    assert repetida.json()["id"] == primeira.json()["id"]
+    # sem a chave é um pedido novo, para o mesmo slot
+    assert cliente.post("/marcacao", json=corpo).status_code == 409
@@ -0,0 +1,49 @@
+"""Planos das consultas de lista numa base gerada.
+
+Corre os mesmos casos que `gerir.py verificar-indices` sobre uma base própria
+povoada pelo gerador (a da sessão de testes não serve: o gerador exige uma
+base vazia e as tabelas quase vazias não dizem nada sobre os planos).
+"""
+
+import asyncio
+from datetime import date
+
+import pytest
+
+import api
+import gerador
+import gerir
+
+
+@pytest.fixture(scope="module")
+def base_gerada(tmp_path_factory):
+    pasta = tmp_path_factory.mktemp("indices")
+    atual = api.Clinica(
+        None,
+        str(pasta / "database.db"),
+        str(pasta / "database-arquivo.db"),
+        str(pasta / "database-saida"),
+        str(pasta / "database-copias"),
+    )
+    token = api.clinica_atual.set(atual)
+    try:
+        atual.preparar()
+        gerador.povoar(gerador.Parametros(pacientes=500, medicos=5, anos=0.25, marcacoes_dia=20, ate=date(2025, 6, 30)))
+        yield atual
+    finally:
+        api.clinica_atual.reset(token)
+        asyncio.run(atual.fechar())
+
+
+def test_listas_sem_percorrer_tabelas(base_gerada):
+    tabelas = set(api.SQLModel.metadata.tables)
+    falhas = []
+    with base_gerada.engine.connect() as ligacao:
+        casos = list(gerir.casos_listas(ligacao))
+        assert casos
+        for descricao, consulta, exige_ordem in casos:
+            principal, problemas = gerir.problemas_plano(ligacao, consulta, exige_ordem)
+            percorridas = [l for l in gerir.plano(ligacao, consulta) if l.startswith("SCAN ") and l.split()[1] in tabelas]
+            if problemas or percorridas:
+                falhas.append(f"{descricao}: {', '.join(problemas) or principal} {percorridas}")
+    assert not falhas, "\n".join(falhas)
@@ -0,0 +1,89 @@
+import json
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from conftest import proxima_segunda
+
+
+def test_marcacao_no_horario_do_medico(fabrica):
+    medico, paciente = fabrica.medico(), fabrica.paciente()
+    resposta = fabrica.marcacao(medico, paciente, proxima_segunda(), "09:00:00")
+    assert resposta.status_code == 200, resposta.text
+
+
+def test_marcacao_fora_do_horario(fabrica):
+    medico, paciente = fabrica.medico(), fabrica.paciente()
+    domingo = proxima_segunda() - timedelta(days=1)
+    assert fabrica.marcacao(medico, paciente, domingo, "03:17:00").status_code == 422
+    assert fabrica.marcacao(medico, paciente, proxima_segunda(), "03:17:00").status_code == 422
+
+
+def test_marcacao_medico_inexistente(fabrica):
+    paciente = fabrica.paciente()
+    resposta = fabrica.marcacao({"id": str(uuid.uuid4())}, paciente, proxima_segunda(), "09:00:00")
+    assert resposta.status_code == 404
+
+
+def test_marcacao_slot_ocupado(fabrica):
+    medico, paciente = fabrica.medico(), fabrica.paciente()
+    assert fabrica.marcacao(medico, paciente, proxima_segunda(), "10:00:00").status_code == 200
+    resposta = fabrica.marcacao(medico, fabrica.paciente(), proxima_segunda(), "10:00:00")
+    assert resposta.status_code == 409
+
+
+def test_slot_disputado_so_tem_uma_marcacao(cliente, fabrica):
+    medico = fabrica.medico()
+    pacientes = [fabrica.paciente() for _ in range(8)]
+    with ThreadPoolExecutor(len(pacientes)) as executor:
+        respostas = list(executor.map(
+            lambda paciente: fabrica.marcacao(medico, paciente, proxima_segunda(), "15:00:00"), pacientes
+        ))
+    assert sorted(r.status_code for r in respostas) == [200] + [409] * (len(pacientes) - 1)
+    pagina = cliente.get("/marcacao", params={"medico_id": medico["id"]}).json()
+    assert len(pagina["items"]) == 1
+
+
+def test_slot_por_medico_e_libertado_ao_cancelar(cliente, fabrica):
+    medico, outro, paciente = fabrica.medico(), fabrica.medico(), fabrica.paciente()
+    dia = proxima_segunda()
+    marcacao = fabrica.marcacao(medico, paciente, dia, "15:30:00").json()
+    # a mesma hora com outro médico não é conflito
+    assert fabrica.marcacao(outro, paciente, dia, "15:30:00").status_code == 200
+
+    livres = cliente.get(f"/medicos/{medico['id']}/disponibilidade", params={"data": dia.isoformat()}).json()["livres"]
+    assert "15:30:00" not in livres and "15:00:00" in livres
+
+    # a mesma hora e dia numa alteração também dá 409
+    segunda = fabrica.marcacao(medico, paciente, dia, "16:30:00").json()
+    resposta = cliente.patch(f"/marcacao/{segunda['id']}", json={"hora_marcacao": "15:30:00"})
+    assert resposta.status_code == 409
+
+    assert cliente.patch(f"/marcacao/{marcacao['id']}", json={"estado_marcacao": "cancelada"}).status_code == 200
+    assert fabrica.marcacao(medico, fabrica.paciente(), dia, "15:30:00").status_code == 200
+
+
+def test_bulk_marcacao_valida_horario(cliente, fabrica):
+    medico, paciente = fabrica.medico(), fabrica.paciente()
+    domingo = proxima_segunda() - timedelta(days=1)
+    linhas = [
+        (proxima_segunda(), "08:00:00", medico["id"]),
+        (domingo, "03:17:00", medico["id"]),
+        (proxima_segunda(), "08:30:00", str(uuid.uuid4())),
+        (proxima_segunda(), "08:00:00", medico["id"]),
+    ]
+    corpo = [
+        {"data_marcacao": dia.isoformat(), "hora_marcacao": hora, "estado_marcacao": "agendada",
+         "paciente_id": paciente["id"], "medico_id": medico_id}
+        for dia, hora, medico_id in linhas
+    ]
+    resposta = cliente.post("/marcacao/bulk", content=json.dumps(corpo), headers={"Content-Type": "application/json"})
+    assert resposta.status_code == 200, resposta.text
+    resultado = resposta.json()
+    assert resultado["inseridos"] == 1
+    assert [(erro["indice"], erro["erro"]) for erro in resultado["erros"][:2]] == [
+        (1, "Fora do horário de trabalho do médico"),
+        (2, "Médico não encontrado"),
+    ]
+    # o slot repetido falha no índice único
+    assert resultado["erros"][2]["indice"] == 3
@@ -0,0 +1,27 @@
+"""Contagens de SQL por rota em /metrics."""
+
+import re
+
+
+def instrucoes(cliente, metodo, rota):
+    texto = cliente.get("/metrics").text
+    padrao = rf'clinica_sql_instrucoes_total\{{metodo="{metodo}",rota="{re.escape(rota)}"\}} (\d+)'
+    encontrado = re.search(padrao, texto)
+    return int(encontrado.group(1)) if encontrado else 0
+
+
+def test_rotas_contam_instrucoes_sql(cliente, fabrica):
+    antes = instrucoes(cliente, "POST", "/relatorios/reconstruir")
+    assert cliente.post("/relatorios/reconstruir").status_code == 200
+    assert instrucoes(cliente, "POST", "/relatorios/reconstruir") > antes
+
+    antes = instrucoes(cliente, "POST", "/{recurso}/bulk")
+    assert cliente.post("/servicos/bulk", json=[{"nome_servico": "bulk", "descricao": "x", "preco": 1.0}]).json()["inseridos"] == 1
+    assert instrucoes(cliente, "POST", "/{recurso}/bulk") > antes
+
+
+def test_exportacao_le_depois_do_handler(cliente, fabrica):
+    servico = fabrica.servico(7.5)
+    linhas = cliente.get("/export/servicos", params={"formato": "csv"}).text.splitlines()
+    assert linhas[0].startswith("id,")
+    assert any(linha.startswith(servico["id"]) for linha in linhas[1:])
@@ -0,0 +1,148 @@
+"""As rotas de CLINICA_MODO=async têm de se comportar como as sync.
+
+Os modelos SQLModel só podem ser definidos uma vez por processo, por isso no
+modo sync este ficheiro volta a correr-se a si próprio num pytest à parte,
+com CLINICA_MODO=async e uma base de dados nova.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import uuid
+from datetime import timedelta
+
+from sqlalchemy import event
+
+import api
+import test_servicos
+from conftest import proxima_segunda
+
+# as mensagens do DELETE das rotas sync; as async têm de ser as mesmas
+MENSAGENS_ELIMINACAO = {
+    "/pagamentos": "Pagamento eliminado com sucesso",
+    "/consulta_servico": "Consulta_Serviço eliminado com sucesso",
+    "/consultas": "Consulta eliminado com sucesso",
+    "/marcacao": "Marcação eliminado com sucesso",
+    "/servicos": "Serviço eliminado com sucesso",
+    "/medicos": "Médico eliminado com sucesso",
+    "/pacientes": "Paciente eliminado com sucesso",
+    "/funcionarios": "Funcionario eliminado com sucesso",
+    "/usuarios": "Usuário eliminado com sucesso",
+}
+
+
+def test_mensagens_de_eliminacao(cliente, fabrica):
+    medico, paciente = fabrica.medico(), fabrica.paciente()
+    marcacao = fabrica.marcacao(medico, paciente, proxima_segunda(), "16:00:00").json()
+    servico = fabrica.servico()
+    consulta = fabrica.consulta(marcacao, servico)
+    usuario = fabrica.usuario("funcionario")
+    ids = {
+        "/pagamentos": fabrica.criar("/pagamentos", {
+            "valor_pagamento": 20.0, "metodo_pagamento": "numerario", "data_pagamento": marcacao["data_marcacao"],
+            "estado_pagamento": "pago", "paciente_id": paciente["id"], "consulta_id": consulta["id"],
+        })["id"],
+        "/consulta_servico": fabrica.linha(consulta, servico)["id"],
+        "/consultas": consulta["id"],
+        "/marcacao": marcacao["id"],
+        "/servicos": servico["id"],
+        "/medicos": medico["id"],
+        "/pacientes": paciente["id"],
+        "/funcionarios": fabrica.criar("/funcionario", {
+            "nome_funcionario": "Funcionário Teste", "cargo": "rececao", "telefone": "926000000",
+            "email": usuario["email"], "usuario_id": usuario["id"],
+        })["id"],
+        "/usuarios": usuario["id"],
+    }
+    for caminho, mensagem in MENSAGENS_ELIMINACAO.items():
+        resposta = cliente.delete(f"{caminho}/{ids[caminho]}")
+        assert resposta.status_code == 200, (caminho, resposta.text)
+        assert resposta.json() == {"mensagem": mensagem}
+
+
+if api.MODO_API != "async":
+
+    def test_modo_async():
+        pasta = tempfile.mkdtemp(prefix="clinica-testes-async-")
+        ambiente = dict(os.environ, CLINICA_MODO="async", CLINICA_DB=os.path.join(pasta, "database.db"))
+        resultado = subprocess.run(
+            [sys.executable, "-m", "pytest", "-q", "-p", "no:cacheprovider", __file__],
+            cwd=os.path.dirname(__file__),
+            env=ambiente,
+            capture_output=True,
+            text=True,
+        )
+        assert resultado.returncode == 0, resultado.stdout + resultado.stderr
+
+else:
+
+    def test_marcacao_fora_do_horario(fabrica):
+        medico, paciente = fabrica.medico(), fabrica.paciente()
+        domingo = proxima_segunda() - timedelta(days=1)
+        assert fabrica.marcacao(medico, paciente, domingo, "03:17:00").status_code == 422
+
+    def test_marcacao_medico_inexistente(fabrica):
+        resposta = fabrica.marcacao({"id": str(uuid.uuid4())}, fabrica.paciente(), proxima_segunda(), "09:00:00")
+        assert resposta.status_code == 404
+
+    def test_marcacao_slot_ocupado(fabrica):
+        medico = fabrica.medico()
+        assert fabrica.marcacao(medico, fabrica.paciente(), proxima_segunda(), "10:00:00").status_code == 200
+        assert fabrica.marcacao(medico, fabrica.paciente(), proxima_segunda(), "10:00:00").status_code == 409
+
+    def test_escritas_so_pela_ligacao_aiosqlite(cliente, fabrica):
+        instrucoes = []
+
+        def contar(ligacao, cursor, sql, *args):
+            instrucoes.append(sql)
+
+        consulta, servico = fabrica.consulta_com_servico()
+        medico = fabrica.medico()
+        event.listen(api.clinica().engine, "before_cursor_execute", contar)
+        try:
+            linha = fabrica.linha(consulta, servico, quantidade=2)
+            assert cliente.patch(f"/consulta_servico/{linha['id']}", json={"quantidade": 3}).status_code == 200
+            assert cliente.delete(f"/consulta_servico/{linha['id']}").status_code == 200
+            horario = [{"dia_semana": 0, "hora_inicio": "08:00:00", "hora_fim": "12:00:00"}]
+            assert cliente.put(f"/medicos/{medico['id']}/horario", json=horario).status_code == 200
+            assert cliente.post("/faturas/recalcular").status_code == 200
+            assert cliente.post("/relatorios/reconstruir").status_code == 200
+            assert cliente.post("/tarefas/limpeza/executar").status_code == 202
+            lote = [{"nome_servico": "lote", "descricao": "x", "preco": 1.0}] * 2
+            assert cliente.post("/servicos/bulk", json=lote).json()["inseridos"] == 2
+        finally:
+            event.remove(api.clinica().engine, "before_cursor_execute", contar)
+        assert instrucoes == []
+
+    # os testes dos serviços, sem alterações, contra as rotas async
+    test_eliminar_servico_acerta_total_das_consultas = test_servicos.test_eliminar_servico_acerta_total_das_consultas
+    test_leituras_de_referencia_em_cache = test_servicos.test_leituras_de_referencia_em_cache
+
+    # leitores e escritor em tarefas, sobre os engines aiosqlite
+    from test_concorrencia import clinica_wal, test_leitores_e_escritor_em_tarefas
+
+    # PUT e PATCH com versão
+    from test_atualizacoes import test_patch_com_versao, test_put_com_versao, test_versao_de_registo_inexistente
+
+    # Idempotency-Key nas rotas async de criação
+    from test_idempotencia import (
+        test_marcacao_repetida_nao_da_conflito_de_slot,
+        test_repeticao_devolve_a_resposta_guardada,
+        test_repeticoes_em_simultaneo_dao_um_pagamento,
+    )
+
+    # resumos mantidos pelas escritas async
+    from test_relatorios import test_resumos_com_bulk_antes_dos_registos_apontados, test_resumos_depois_de_alterar_e_eliminar
+
+    # bulk pela ligação aiosqlite
+    from test_bulk import test_linhas_invalidas_nao_anulam_o_lote
+
+    # login, logout e senha pelas rotas async
+    from test_autenticacao import (
+        test_alterar_senha_por_patch,
+        test_hash_enviado_pelo_cliente_e_tratado_como_senha,
+        test_login_senha_e_logout,
+        test_respostas_sem_hash_da_senha,
+        test_senha_de_usuario_inexistente,
+    )
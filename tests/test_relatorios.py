@@ -0,0 +1,69 @@
+"""Os resumos mantidos a cada escrita têm de ser iguais aos reconstruídos."""
+
+import uuid
+
+from sqlmodel import Session, select
+
+import api
+
+
+def resumos():
+    with Session(api.clinica().engine_leitura) as session:
+        receita = session.exec(select(api.ResumoReceita)).all()
+        consultas = session.exec(select(api.ResumoConsultas)).all()
+    return (
+        sorted((r.dia, r.metodo_pagamento, r.estado_pagamento, r.medico_id, round(r.total, 2), r.quantidade) for r in receita),
+        sorted((r.dia, r.especialidade, r.quantidade) for r in consultas),
+    )
+
+
+def assert_igual_a_reconstruir(cliente):
+    incrementais = resumos()
+    assert cliente.post("/relatorios/reconstruir").status_code == 200
+    assert incrementais == resumos()
+
+
+def pagamento(consulta, valor=20.0, metodo="numerario"):
+    return {
+        "valor_pagamento": valor, "metodo_pagamento": metodo, "data_pagamento": consulta["data_consulta"],
+        "estado_pagamento": "pago", "paciente_id": consulta["paciente_id"], "consulta_id": consulta["id"],
+    }
+
+
+def test_resumos_depois_de_alterar_e_eliminar(cliente, fabrica):
+    assert cliente.post("/relatorios/reconstruir").status_code == 200
+    consulta, _ = fabrica.consulta_com_servico()
+    primeiro = fabrica.criar("/pagamentos", pagamento(consulta))
+    segundo = fabrica.criar("/pagamentos", pagamento(consulta, 35.0, "multicaixa"))
+    assert_igual_a_reconstruir(cliente)
+
+    # muda de balde (método e valor) e muda a consulta de médico
+    assert cliente.patch(f"/pagamentos/{primeiro['id']}", json={"metodo_pagamento": "transferencia", "valor_pagamento": 12.5}).status_code == 200
+    outro = fabrica.medico()
+    assert cliente.patch(f"/consultas/{consulta['id']}", json={"medico_id": outro["id"]}).status_code == 200
+    assert cliente.patch(f"/medicos/{outro['id']}", json={"especialidade": "pediatria"}).status_code == 200
+    assert_igual_a_reconstruir(cliente)
+
+    # os baldes que ficam vazios desaparecem
+    assert cliente.delete(f"/pagamentos/{segundo['id']}").status_code == 200
+    assert cliente.delete(f"/medicos/{outro['id']}").status_code == 200
+    assert_igual_a_reconstruir(cliente)
+
+
+def test_resumos_com_bulk_antes_dos_registos_apontados(cliente, fabrica):
+    assert cliente.post("/relatorios/reconstruir").status_code == 200
+    consulta, _ = fabrica.consulta_com_servico()
+    medico_id, consulta_id = str(uuid.uuid4()), str(uuid.uuid4())
+    nova = {**consulta, "id": consulta_id, "medico_id": medico_id}
+
+    # pagamentos de uma consulta, e a consulta de um médico, que ainda não existem
+    resposta = cliente.post("/pagamentos/bulk", json=[pagamento(nova), pagamento(nova, 15.0)])
+    assert resposta.json()["inseridos"] == 2
+    resposta = cliente.post("/consultas/bulk", json=[{c: v for c, v in nova.items() if c != "total"}])
+    assert resposta.json()["inseridos"] == 1, resposta.text
+    medico = {
+        "id": medico_id, "nome_medico": "Dr. Lote", "especialidade": "cardiologia", "telefone": "927000000",
+        "email": f"m{uuid.uuid4().hex[:12]}@clinica.test", "usuario_id": fabrica.usuario()["id"],
+    }
+    assert cliente.post("/medicos/bulk", json=[medico]).json()["inseridos"] == 1
+    assert_igual_a_reconstruir(cliente)
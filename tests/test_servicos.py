@@ -0,0 +1,23 @@
+def test_eliminar_servico_acerta_total_das_consultas(cliente, fabrica):
+    consulta, servico = fabrica.consulta_com_servico(preco=20.0)
+    assert cliente.get(f"/consultas/{consulta['id']}").json()["total"] == 20.0
+    assert cliente.delete(f"/servicos/{servico['id']}").status_code == 200
+    assert cliente.get(f"/consultas/{consulta['id']}").json()["total"] == 0.0
+
+
+def test_leituras_de_referencia_em_cache(cliente, fabrica):
+    servico = fabrica.servico()
+    for caminho in ("/servicos", f"/servicos/{servico['id']}", "/medicos"):
+        antes = cliente.get("/cache/estatisticas").json()
+        primeira = cliente.get(caminho)
+        assert primeira.status_code == 200
+        assert primeira.headers["ETag"] and primeira.headers["Last-Modified"]
+        repetida = cliente.get(caminho, headers={"If-None-Match": primeira.headers["ETag"]})
+        assert repetida.status_code == 304
+        depois = cliente.get("/cache/estatisticas").json()
+        assert depois["hits"] > antes["hits"]
+    # uma escrita invalida a entrada: o ETag antigo deixa de servir
+    etag = cliente.get(f"/servicos/{servico['id']}").headers["ETag"]
+    assert cliente.patch(f"/servicos/{servico['id']}", json={"preco": 99.0}).status_code == 200
+    nova = cliente.get(f"/servicos/{servico['id']}", headers={"If-None-Match": etag})
+    assert nova.status_code == 200 and nova.json()["preco"] == 99.0
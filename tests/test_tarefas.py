@@ -0,0 +1,80 @@
+"""Agendador de tarefas: o arranque só recupera a noite em falta se pedido."""
+
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlmodel import Session, select
+
+import api
+from conftest import proxima_segunda
+
+
+def passagens_no_arranque(monkeypatch, atrasadas):
+    monkeypatch.setattr(api, "TAREFAS_ATRASADAS", atrasadas)
+    agendador = api.AgendadorTarefas()
+    chamadas = []
+    monkeypatch.setattr(agendador, "verificar", lambda: chamadas.append(datetime.now()))
+
+    async def arrancar_e_parar():
+        agendador.iniciar()
+        await asyncio.sleep(0.2)
+        await agendador.terminar()
+
+    asyncio.run(arrancar_e_parar())
+    return agendador, chamadas
+
+
+def test_arranque_sem_passagem_imediata(monkeypatch):
+    agendador, chamadas = passagens_no_arranque(monkeypatch, False)
+    assert chamadas == []
+    assert agendador.primeiro_dia == api.dia_das_tarefas(datetime.now()) + timedelta(days=1)
+
+
+def test_arranque_com_tarefas_atrasadas(monkeypatch):
+    agendador, chamadas = passagens_no_arranque(monkeypatch, True)
+    assert len(chamadas) == 1
+    assert agendador.primeiro_dia == api.dia_das_tarefas(datetime.now())
+
+
+def execucoes_do_dia(tarefa, dia):
+    with Session(api.clinica().engine_leitura) as session:
+        return session.exec(
+            select(api.ExecucaoTarefa).where(api.ExecucaoTarefa.tarefa == tarefa, api.ExecucaoTarefa.dia == dia)
+        ).all()
+
+
+def test_noite_anterior_ao_arranque_nao_e_agendada(cliente, monkeypatch):
+    feitas = []
+    monkeypatch.setattr(api, "TAREFAS", {"teste-arranque": feitas.append})
+    dia = api.dia_das_tarefas(datetime.now())
+    agendador = api.AgendadorTarefas()
+
+    agendador.primeiro_dia = dia + timedelta(days=1)
+    agendador.verificar()
+    assert execucoes_do_dia("teste-arranque", dia) == []
+    assert feitas == []
+
+    # com CLINICA_TAREFAS_ATRASADAS=1 o primeiro dia é o que está em falta
+    agendador.primeiro_dia = dia
+    agendador.verificar()
+    [execucao] = execucoes_do_dia("teste-arranque", dia)
+    assert execucao.estado == api.EXECUCAO_CONCLUIDA
+    assert len(feitas) == 1
+
+
+def test_fechar_marcacoes_passa_a_concluida_ou_faltou(cliente, fabrica, monkeypatch):
+    monkeypatch.setattr(api, "TAREFAS", {"fechar-marcacoes": api.fechar_marcacoes})
+    medico, paciente = fabrica.medico(), fabrica.paciente()
+    segunda = proxima_segunda()
+    atendida = fabrica.marcacao(medico, paciente, segunda, "14:00:00").json()
+    fabrica.consulta(atendida, fabrica.servico())
+    falta = fabrica.marcacao(medico, paciente, segunda, "14:30:00").json()
+
+    dia = (segunda + timedelta(days=1)).isoformat()
+    assert cliente.post("/tarefas/fechar-marcacoes/executar", params={"dia": dia}).status_code == 202
+    agendador = api.AgendadorTarefas()
+    agendador.primeiro_dia = api.dia_das_tarefas(datetime.now()) + timedelta(days=1)
+    agendador.verificar()
+
+    assert cliente.get(f"/marcacao/{atendida['id']}").json()["estado_marcacao"] == "concluida"
+    assert cliente.get(f"/marcacao/{falta['id']}").json()["estado_marcacao"] == "faltou"